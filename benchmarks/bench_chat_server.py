@@ -0,0 +1,353 @@
+'''
+End-to-end load benchmark for the chat server, runnable offline.
+
+Starts ui_Chatbot_prototype.py as a subprocess with the local fake model (--model fake, and PP_MODEL_BACKEND=fake
+in its environment, so no Google credentials are needed whatever the server does at import), then drives
+--clients concurrent users. Each user runs the browser's flow with its own session cookie:
+/api/handle_focus, /api/init, /api/select_policy, --turns /api/chat streams read the way EventSource
+reads them, and /api/clear. With --fetch-emails DATE each user also fetches that day's emails from the local
+fake Gmail (PP_EMAIL_SOURCE=fake, see handlers/ui_fake_gmail.py), or from a local archive with --mailbox PATH,
+and selects one first; its chats then ask about that email. Add --stream-emails to fetch them from /api/fetch_emails_stream like the page does, timing
+the first row as fetch_emails_first_row.
+
+    python benchmarks/bench_chat_server.py --user user1 --clients 32 --turns 3
+    python benchmarks/bench_chat_server.py --clients 64 --ttft-ms 500 --token-ms 30 --server-arg=--chat-mode=sync
+
+Prints one JSON object, so runs can be saved and diffed between commits. It contains:
+    ttft_ms, response_ms        time to first streamed text and to "DONE", per /api/chat (count, mean, p50/p95/p99)
+    endpoints                   latency of handle_focus, init, select_policy, clear (and fetch_emails, select_email,
+                                fetch_emails_first_row)
+    stream_bytes_per_sec        SSE bytes received by all clients per second of wall time
+    server                      CPU seconds and utilisation, peak and final RSS (from /proc), and the final /api/stats
+Extra server options can be passed with --server-arg (repeatable). The fake model's timing is set with
+--ttft-ms, --token-ms, --reply-tokens, --failure-rate and --prefill-ms-per-kb.
+'''
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "What is my deductible for wind and hail damage?",
+    "Does this policy cover water backup from a sewer?",
+    "Who are the named insureds and what is the policy period?",
+    "Explain the liability limits in plain English.",
+]
+
+
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))], 2)
+    return {"count": len(ordered), "mean": round(sum(ordered) / len(ordered), 2),
+            "p50": pct(50), "p95": pct(95), "p99": pct(99), "max": round(ordered[-1], 2)}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ProcSampler(threading.Thread):
+    '''Samples the server's CPU time and RSS from /proc while the benchmark runs (Linux only).'''
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.peak_rss_mb = 0.0
+        self.last_rss_mb = 0.0
+
+    def cpu_seconds(self):
+        try:
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_mb(self):
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            rss = self.rss_mb()
+            if rss is not None:
+                self.last_rss_mb = rss
+                self.peak_rss_mb = max(self.peak_rss_mb, rss)
+            self.stop_event.wait(self.interval)
+
+
+class Client:
+    '''One browser: a session cookie and the requests the page makes.'''
+
+    def __init__(self, port, timeout):
+        self.port = port
+        self.timeout = timeout
+        self.headers = {}
+
+    def get(self, path):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', path, headers=self.headers)
+            response = conn.getresponse()
+            body = response.read()
+            set_cookie = response.getheader('Set-Cookie')
+            if set_cookie:
+                self.headers = {'Cookie': set_cookie.split(';', 1)[0]}
+            return response.status, body
+        finally:
+            conn.close()
+
+    def chat(self, message, email_index=None):
+        '''Read one /api/chat stream. Returns (status, ttft_ms or None, total_ms, bytes received, completed).'''
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+        start = time.perf_counter()
+        ttft_ms, received, completed = None, 0, False
+        try:
+            path = '/api/chat?message=' + quote(message)
+            if email_index is not None:
+                path += f'&email_index={email_index}'
+            conn.request('GET', path, headers=self.headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                response.read()
+                return response.status, None, (time.perf_counter() - start) * 1000, 0, False
+            while True:
+                line = response.fp.readline()
+                if not line:
+                    break
+                received += len(line)
+                if not line.startswith(b'data: '):
+                    continue
+                if line.strip() == b'data: DONE':
+                    completed = True
+                    break
+                if ttft_ms is None and line[6:].strip():
+                    ttft_ms = (time.perf_counter() - start) * 1000
+            return 200, ttft_ms, (time.perf_counter() - start) * 1000, received, completed
+        finally:
+            conn.close()
+
+
+    def fetch_emails_stream(self, date):
+        '''Read one /api/fetch_emails_stream. Returns (status, first email ms or None, total ms, final event data).'''
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+        start = time.perf_counter()
+        first_ms, event = None, None
+        try:
+            conn.request('GET', '/api/fetch_emails_stream?date=' + quote(date), headers=self.headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                response.read()
+                return response.status, None, (time.perf_counter() - start) * 1000, {}
+            while True:
+                line = response.fp.readline()
+                if not line:
+                    break
+                if line.startswith(b'event: '):
+                    event = line[7:].strip().decode()
+                elif line.startswith(b'data: '):
+                    if event == 'email' and first_ms is None:
+                        first_ms = (time.perf_counter() - start) * 1000
+                    elif event in ('order', 'error'):
+                        data = json.loads(line[6:])
+                        return 200 if event == 'order' else 500, first_ms, (time.perf_counter() - start) * 1000, data
+            return 200, first_ms, (time.perf_counter() - start) * 1000, {}
+        finally:
+            conn.close()
+
+
+def timed(results, name, fn, *a):
+    start = time.perf_counter()
+    status, body = fn(*a)
+    results['endpoints'].setdefault(name, []).append((time.perf_counter() - start) * 1000)
+    if status != 200:
+        results['errors'].append(f"{name}: HTTP {status}")
+    return body
+
+
+def run_client(n, port, args, results, lock):
+    client = Client(port, args.timeout)
+    local = {'endpoints': {}, 'errors': [], 'ttft': [], 'response': [], 'bytes': 0, 'stream_seconds': 0.0,
+             'rejected': 0, 'incomplete': 0}
+    try:
+        timed(local, 'handle_focus', client.get, '/api/handle_focus')
+        init = json.loads(timed(local, 'init', client.get, '/api/init') or b'{}')
+        policies = [p.get('print_name') for p in init.get('policies', []) if p.get('print_name')]
+        policy = args.policy or (policies[n % len(policies)] if policies else 'None')
+        timed(local, 'select_policy', client.get, '/api/select_policy?policy=' + quote(policy))
+        if args.fetch_emails and args.stream_emails:
+            status, first_ms, total_ms, fetched = client.fetch_emails_stream(args.fetch_emails)
+            local['endpoints'].setdefault('fetch_emails', []).append(total_ms)
+            if first_ms is not None:
+                local['endpoints'].setdefault('fetch_emails_first_row', []).append(first_ms)
+            if status != 200:
+                local['errors'].append(f"fetch_emails_stream: {fetched.get('error', status)}")
+        elif args.fetch_emails:
+            fetched = json.loads(timed(local, 'fetch_emails', client.get, '/api/fetch_emails?date=' + args.fetch_emails) or b'{}')
+        email_index = None
+        if args.fetch_emails:
+            if fetched.get('count'):
+                email_index = n % fetched['count']
+                timed(local, 'select_email', client.get, f"/api/select_email?index={email_index}")
+
+        for turn in range(args.turns):
+            status, ttft_ms, total_ms, received, completed = client.chat(QUESTIONS[(n + turn) % len(QUESTIONS)], email_index)
+            if status == 503:
+                local['rejected'] += 1
+                continue
+            if status != 200:
+                local['errors'].append(f"chat: HTTP {status}")
+                continue
+            if ttft_ms is not None:
+                local['ttft'].append(ttft_ms)
+            local['response'].append(total_ms)
+            local['bytes'] += received
+            local['stream_seconds'] += total_ms / 1000
+            if not completed:
+                local['incomplete'] += 1
+
+        timed(local, 'clear', client.get, '/api/clear')
+    except Exception as e:
+        local['errors'].append(f"{type(e).__name__}: {e}")
+
+    with lock:
+        for name, samples in local['endpoints'].items():
+            results['endpoints'].setdefault(name, []).extend(samples)
+        for key in ('errors', 'ttft', 'response'):
+            results[key].extend(local[key])
+        for key in ('bytes', 'stream_seconds', 'rejected', 'incomplete'):
+            results[key] += local[key]
+
+
+def wait_for_server(port, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/stats')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load and latency benchmark for the chat server (fake model).')
+    parser.add_argument('--user', default='user1')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent simulated users')
+    parser.add_argument('--turns', type=int, default=3, help='chat turns per user')
+    parser.add_argument('--policy', default=None, help="policy print name to select (default: rotate over the user's policies)")
+    parser.add_argument('--ttft-ms', type=float, default=300)
+    parser.add_argument('--token-ms', type=float, default=20)
+    parser.add_argument('--reply-tokens', type=int, default=200)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--prefill-ms-per-kb', type=float, default=0.0, help='fake model time to first token per KB of prompt')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fetch-emails', default=None, metavar='YYYY-MM-DD', help='also fetch and select emails (fake Gmail)')
+    parser.add_argument('--stream-emails', action='store_true', help='fetch emails from /api/fetch_emails_stream')
+    parser.add_argument('--mailbox', default=None, metavar='PATH',
+                        help='fetch emails from a local mbox file or Maildir instead of the fake Gmail')
+    parser.add_argument('--gmail-latency-ms', type=float, default=80, help='fake Gmail latency per API call')
+    parser.add_argument('--port', type=int, default=None, help='default: a free port')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--server-arg', action='append', default=[], help='extra ui_Chatbot_prototype.py option (repeatable)')
+    parser.add_argument('--server-log', default=os.devnull, help='file for the server output')
+    args = parser.parse_args()
+
+    port = args.port or free_port()
+    env = dict(os.environ,
+               PP_FAKE_TTFT_MS=str(args.ttft_ms), PP_FAKE_TOKEN_MS=str(args.token_ms),
+               PP_FAKE_REPLY_TOKENS=str(args.reply_tokens), PP_FAKE_FAILURE_RATE=str(args.failure_rate),
+               PP_FAKE_PREFILL_MS_PER_KB=str(args.prefill_ms_per_kb),
+               PP_FAKE_SEED=str(args.seed), PP_EMAIL_SOURCE='fake', PP_MODEL_BACKEND='fake',
+               PP_FAKE_GMAIL_LATENCY_MS=str(args.gmail_latency_ms), PYTHONUNBUFFERED='1')
+    if args.mailbox:
+        env.update(PP_EMAIL_SOURCE='maildir' if os.path.isdir(args.mailbox) else 'mbox',
+                   PP_MAILBOX_PATH=os.path.abspath(args.mailbox))
+    command = [sys.executable, os.path.join(REPO_ROOT, 'ui_Chatbot_prototype.py'), '--user', args.user,
+               '--port', str(port), '--no-browser', '--model', 'fake'] + args.server_arg
+
+    with open(args.server_log, 'w') as log:
+        process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_for_server(port, process)
+            sampler = ProcSampler(process.pid)
+            sampler.start()
+            cpu_before = sampler.cpu_seconds()
+
+            results = {'endpoints': {}, 'errors': [], 'ttft': [], 'response': [], 'bytes': 0,
+                       'stream_seconds': 0.0, 'rejected': 0, 'incomplete': 0}
+            lock = threading.Lock()
+            threads = [threading.Thread(target=run_client, args=(n, port, args, results, lock), daemon=True)
+                       for n in range(args.clients)]
+            wall_start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall_s = time.perf_counter() - wall_start
+
+            cpu_after = sampler.cpu_seconds()
+            sampler.stop_event.set()
+            status, body = Client(port, args.timeout).get('/api/stats')
+            server_stats = json.loads(body) if status == 200 else None
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    cpu_s = (cpu_after - cpu_before) if cpu_before is not None and cpu_after is not None else None
+    print(json.dumps({
+        "config": {k: v for k, v in vars(args).items() if k not in ('server_log', 'timeout')},
+        "wall_seconds": round(wall_s, 3),
+        "chats": len(results['response']),
+        "rejected_chats": results['rejected'],
+        "incomplete_chats": results['incomplete'],
+        "errors": results['errors'][:20],
+        "error_count": len(results['errors']),
+        "ttft_ms": summarize(results['ttft']),
+        "response_ms": summarize(results['response']),
+        "endpoints": {name: summarize(samples) for name, samples in sorted(results['endpoints'].items())},
+        "stream_bytes": results['bytes'],
+        "stream_bytes_per_sec": round(results['bytes'] / wall_s, 1) if wall_s else None,
+        "server": {
+            "cpu_seconds": round(cpu_s, 3) if cpu_s is not None else None,
+            "cpu_percent": round(100 * cpu_s / wall_s, 1) if cpu_s is not None and wall_s else None,
+            "peak_rss_mb": round(sampler.peak_rss_mb, 1),
+            "final_rss_mb": round(sampler.last_rss_mb, 1),
+            "stats": server_stats,
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
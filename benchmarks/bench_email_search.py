@@ -0,0 +1,74 @@
+'''
+Email search latency over a large cache, inverted index vs scanning every message:
+
+    python benchmarks/bench_email_search.py --messages 30000
+
+Synthetic messages (Zipf-distributed words, so some query terms are in most emails and some in a handful) are
+indexed with EmailSearchIndex, then each query is timed with the whole cache in scope and with one day's worth
+of emails in scope. "scan" is the naive alternative: a lowercase substring check of every query word against
+every message. One JSON line is printed per query.
+'''
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers.ui_email_search import EmailSearchIndex
+
+
+def timed(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return round(statistics.median(times), 3), round(times[int(len(times) * 0.95) - 1], 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Email search latency, inverted index vs scan')
+    parser.add_argument('--messages', type=int, default=30000)
+    parser.add_argument('--body-words', type=int, default=300)
+    parser.add_argument('--vocabulary', type=int, default=30000)
+    parser.add_argument('--day-size', type=int, default=300, help='emails in scope for the day searches')
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words = [f"word{n}" for n in range(args.vocabulary)]
+    weights = [1 / (n + 1) for n in range(args.vocabulary)]
+    messages = []
+    for n in range(args.messages):
+        metadata = {'id': f"m{n}", 'sender': f"Sender {n % 500} <sender{n % 500}@example.com>",
+                    'subject': ' '.join(rng.choices(words, weights, k=6))}
+        messages.append((metadata, ' '.join(rng.choices(words, weights, k=args.body_words))))
+
+    index = EmailSearchIndex()
+    start = time.perf_counter()
+    for metadata, body in messages:
+        index.add(metadata, body)
+    print(json.dumps({'indexed': args.messages, 'index_s': round(time.perf_counter() - start, 2), **index.stats()}))
+
+    texts = [(metadata['id'], f"{metadata['sender']} {metadata['subject']} {body}".lower()) for metadata, body in messages]
+    day = [metadata['id'] for metadata, _ in messages[:args.day_size]]
+    queries = ['word0 word1 word2', 'word5', 'word300 word4000', 'sender42 word10', 'word29999']
+
+    for query in queries:
+        terms = query.split()
+        index_ms = timed(lambda: index.search(query, 20), args.repeats)
+        day_ms = timed(lambda: index.search(query, 20, within=day), args.repeats)
+        scan_ms = timed(lambda: [i for i, text in texts if any(term in text for term in terms)], max(1, args.repeats // 10))
+        print(json.dumps({'query': query, 'index_median_ms': index_ms[0], 'index_p95_ms': index_ms[1],
+                          'day_median_ms': day_ms[0], 'scan_median_ms': scan_ms[0]}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+'''
+Microbenchmark for the SSE flush policies in handlers/ui_stream_flush.py. No server or model needed:
+
+    python benchmarks/bench_flush_policy.py
+    python benchmarks/bench_flush_policy.py --policies passthrough threshold:50 latency:30 --kb 2048
+
+For each policy it prints one JSON line with:
+    cpu_us_per_kb   CPU time to coalesce a synthetic model stream and write it to a socket, per KB streamed
+    events          number of SSE events (= socket writes) for that stream
+    ttfb_ms         time from the first model chunk to the first byte sent, with a realistic chunk cadence
+"legacy" is the old handle_query loop that re-joined the pending buffer on every chunk and sent 50-char pieces.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers.ui_stream_flush import SSECoalescer, acoalesce, coalesce, flush_policy_from_spec
+
+
+def synthetic_chunks(total_chars, seed=7, min_size=2, max_size=120):
+    '''Model-like chunks: mostly short, occasionally long, with newlines sprinkled in.'''
+    rng = random.Random(seed)
+    words = ['policy', 'coverage', 'premium', 'the', 'of', 'and', 'beneficiary', 'term', 'rider', 'exclusion\n']
+    chunks, produced = [], 0
+    while produced < total_chars:
+        size = rng.randint(min_size, max_size) if rng.random() < 0.8 else rng.randint(max_size, max_size * 4)
+        text = []
+        n = 0
+        while n < size:
+            w = rng.choice(words) + ' '
+            text.append(w)
+            n += len(w)
+        chunk = ''.join(text)
+        chunks.append(chunk)
+        produced += len(chunk)
+    return chunks
+
+
+def legacy_rejoin(contents):
+    buffer_chunks = []
+    for content in contents:
+        buffer_chunks.append(content)
+        buffer = ''.join(buffer_chunks)
+        while len(buffer) >= 50:
+            send_chunk = buffer[:50]
+            buffer = buffer[50:]
+            buffer_chunks = [buffer]
+            yield send_chunk.replace('\n', '\\n')
+    if buffer_chunks:
+        yield ''.join(buffer_chunks).replace('\n', '\\n')
+
+
+def drain(sock):
+    while sock.recv(1 << 16):
+        pass
+
+
+def measure_cpu(policy_spec, chunks, total_kb):
+    writer, reader = socket.socketpair()
+    drainer = threading.Thread(target=drain, args=(reader,), daemon=True)
+    drainer.start()
+
+    if policy_spec == 'legacy':
+        payloads = legacy_rejoin(iter(chunks))
+    else:
+        payloads = coalesce(iter(chunks), SSECoalescer(flush_policy_from_spec(policy_spec)))
+
+    events = 0
+    start = time.process_time()
+    for payload in payloads:
+        writer.sendall(f"data: {payload}\n\n".encode('utf-8'))
+        events += 1
+    cpu = time.process_time() - start
+
+    writer.close()
+    drainer.join()
+    reader.close()
+    return cpu * 1e6 / total_kb, events
+
+
+async def timed_model(first_chunk_delay, inter_chunk_delay, chunks):
+    await asyncio.sleep(first_chunk_delay)
+    for chunk in chunks:
+        yield chunk
+        await asyncio.sleep(inter_chunk_delay)
+
+
+async def measure_ttfb(policy_spec, inter_chunk_delay, chunks):
+    '''Time from the first model chunk to the first SSE event, through the async path the server uses.'''
+    ttft = 0.05
+    start = time.perf_counter()
+    contents = timed_model(ttft, inter_chunk_delay, chunks)
+    if policy_spec == 'legacy':
+        async def legacy():
+            buffered = []
+            async for c in contents:
+                buffered.append(c)
+                if len(''.join(buffered)) >= 50:
+                    yield ''.join(buffered)
+                    return
+        payloads = legacy()
+    else:
+        payloads = acoalesce(contents, SSECoalescer(flush_policy_from_spec(policy_spec)))
+    async for _ in payloads:
+        first = time.perf_counter()
+        break
+    await payloads.aclose()
+    return (first - start - ttft) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU per streamed KB and time-to-first-byte for each SSE flush policy')
+    parser.add_argument('--policies', nargs='+', default=['legacy', 'passthrough', 'threshold:50', 'threshold:256', 'latency:30'])
+    parser.add_argument('--kb', type=int, default=1024, help='KB of synthetic model output for the CPU pass')
+    parser.add_argument('--inter-chunk-ms', type=float, default=15, help='Delay between model chunks for the TTFB pass')
+    args = parser.parse_args()
+
+    cpu_chunks = synthetic_chunks(args.kb * 1024)
+    # Streams typically open with a few short chunks, which is what a size threshold has to wait on
+    ttfb_chunks = synthetic_chunks(4096, seed=11, min_size=2, max_size=12)
+
+    for spec in args.policies:
+        cpu_us_per_kb, events = measure_cpu(spec, cpu_chunks, args.kb)
+        ttfb_ms = asyncio.run(measure_ttfb(spec, args.inter_chunk_ms / 1000.0, ttfb_chunks))
+        print(json.dumps({
+            'policy': spec,
+            'kb_streamed': args.kb,
+            'cpu_us_per_kb': round(cpu_us_per_kb, 1),
+            'events': events,
+            'ttfb_ms': round(ttfb_ms, 2),
+        }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Per-turn history preparation cost as a conversation grows, old way vs incremental:
+
+    python benchmarks/bench_history_prep.py --turns 500
+
+"old" is what handle_query used to do each turn: three load_memory_variables() reads plus
+format_history_for_gemini over the whole conversation, then save_context.
+"incremental" is SessionConversationMemory: one history_messages() snapshot plus save_context.
+One JSON line is printed per checkpoint turn; the incremental column should stay flat.
+Turns carry an email-sized user message, since the browser prepends the selected email to each query.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.memory import ConversationBufferMemory
+
+from handlers.ui_conversation_memory import SessionConversationMemory
+
+
+def format_history_for_gemini(history):
+    # copy of the original per-turn formatter in handlers/ui_handler_functions.py
+    seen_messages = set()
+    formatted_messages = []
+    for msg in history:
+        content = str(msg.content)
+        if content not in seen_messages:
+            formatted_messages.append(msg)
+            seen_messages.add(content)
+    return formatted_messages
+
+
+def old_turn(memory, user_input, answer):
+    start = time.perf_counter()
+    history = memory.load_memory_variables({})["history"]
+    stream_history = memory.load_memory_variables({})["history"]
+    formatted = format_history_for_gemini(memory.load_memory_variables({})["history"])
+    elapsed = time.perf_counter() - start
+    memory.save_context({"input": user_input}, {"output": answer})
+    return elapsed
+
+
+def incremental_turn(memory, user_input, answer):
+    start = time.perf_counter()
+    history = memory.history_messages()
+    elapsed = time.perf_counter() - start
+    save_start = time.perf_counter()
+    memory.save_context({"input": user_input}, {"output": answer})
+    return elapsed, time.perf_counter() - save_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-turn history preparation cost vs conversation length')
+    parser.add_argument('--turns', type=int, default=500)
+    parser.add_argument('--input-chars', type=int, default=6000, help='Size of each user message (email context + question)')
+    parser.add_argument('--answer-chars', type=int, default=1500)
+    parser.add_argument('--checkpoints', type=int, nargs='+', default=[1, 10, 50, 100, 250, 500])
+    args = parser.parse_args()
+
+    old_memory = ConversationBufferMemory(return_messages=True)
+    new_memory = SessionConversationMemory()
+    filler = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+
+    for turn in range(1, args.turns + 1):
+        user_input = f"[turn {turn}] " + (filler * (args.input_chars // len(filler) + 1))[:args.input_chars]
+        answer = f"[answer {turn}] " + (filler * (args.answer_chars // len(filler) + 1))[:args.answer_chars]
+
+        old_s = old_turn(old_memory, user_input, answer)
+        new_s, new_save_s = incremental_turn(new_memory, user_input, answer)
+
+        if turn in args.checkpoints:
+            print(json.dumps({
+                'turn': turn,
+                'old_prep_us': round(old_s * 1e6, 1),
+                'incremental_prep_us': round(new_s * 1e6, 2),
+                'incremental_save_us': round(new_save_s * 1e6, 1),
+            }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Load test: does /api/handle_focus stay fast while chat streams are open?
+
+Start the server first (e.g. `python ui_Chatbot_prototype.py --user user1`), then run:
+
+    python benchmarks/load_focus_latency.py --streams 0 4 8 16
+
+For each N in --streams, N /api/chat EventSource-style streams are opened and kept reading, and
+--requests sequential GETs to /api/handle_focus are timed while they are open. p50/p95/p99 latency
+is printed per N as one JSON line, so runs can be diffed between commits.
+With --server-mode single the p99 grows with the length of a model response; with the threaded
+server it should stay flat as N grows (until N reaches --max-streams, after which extra streams get a 503).
+'''
+
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import quote, urlparse
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def start_session(host, port):
+    '''Start a server-side session and return the Cookie header that selects it, as a browser would.'''
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    conn.request('GET', '/api/handle_focus')
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    set_cookie = response.getheader('Set-Cookie', '')
+    return {'Cookie': set_cookie.split(';', 1)[0]} if set_cookie else {}
+
+
+def open_chat_stream(host, port, message, stop_event, stats):
+    '''Hold one /api/chat stream open, reading it the way EventSource would, until DONE or stop_event.'''
+    headers = start_session(host, port)  # every stream is a different user
+    conn = http.client.HTTPConnection(host, port, timeout=300)
+    try:
+        conn.request('GET', '/api/chat?message=' + quote(message), headers=headers)
+        response = conn.getresponse()
+        if response.status != 200:
+            stats['rejected'] += 1
+            return
+        stats['opened'] += 1
+        while not stop_event.is_set():
+            line = response.fp.readline()
+            if not line or line.strip() == b'data: DONE':
+                break
+    except Exception:
+        stats['errors'] += 1
+    finally:
+        conn.close()
+
+
+def time_focus_requests(host, port, count):
+    headers = start_session(host, port)
+    latencies_ms = []
+    for _ in range(count):
+        conn = http.client.HTTPConnection(host, port, timeout=60)
+        start = time.perf_counter()
+        conn.request('GET', '/api/handle_focus', headers=headers)
+        conn.getresponse().read()
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+        conn.close()
+    return latencies_ms
+
+
+def run_level(host, port, n_streams, n_requests, message, warmup_s):
+    stop_event = threading.Event()
+    stats = {'opened': 0, 'rejected': 0, 'errors': 0}
+    threads = [threading.Thread(target=open_chat_stream, args=(host, port, message, stop_event, stats), daemon=True)
+               for _ in range(n_streams)]
+    for t in threads:
+        t.start()
+    time.sleep(warmup_s if n_streams else 0)  # let the streams get going before measuring
+
+    latencies_ms = time_focus_requests(host, port, n_requests)
+
+    stop_event.set()
+    return {
+        'open_streams': n_streams,
+        'streams_opened': stats['opened'],
+        'streams_rejected': stats['rejected'],
+        'stream_errors': stats['errors'],
+        'requests': n_requests,
+        'p50_ms': round(percentile(latencies_ms, 50), 2),
+        'p95_ms': round(percentile(latencies_ms, 95), 2),
+        'p99_ms': round(percentile(latencies_ms, 99), 2),
+        'max_ms': round(max(latencies_ms), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure /api/handle_focus latency with N open chat streams')
+    parser.add_argument('--url', default='http://localhost:8000', help='Base URL of a running server')
+    parser.add_argument('--streams', type=int, nargs='+', default=[0, 2, 4, 8], help='Open chat stream counts to test')
+    parser.add_argument('--requests', type=int, default=200, help='handle_focus requests timed per level')
+    parser.add_argument('--message', default='Please write a long, detailed answer about term life insurance.')
+    parser.add_argument('--warmup', type=float, default=1.0, help='Seconds to let streams start before timing')
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    for n_streams in args.streams:
+        result = run_level(url.hostname, url.port or 80, n_streams, args.requests, args.message, args.warmup)
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
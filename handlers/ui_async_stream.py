@@ -0,0 +1,191 @@
+import asyncio
+import json
+import queue
+import select
+import socket
+import threading
+from typing import AsyncIterator, Callable, NamedTuple
+
+from handlers.ui_text_utils import estimate_tokens
+
+
+####################################
+# Asyncio SSE streaming
+####################################
+# The HTTP server runs each request on its own thread, but the model is streamed with chain.astream on one
+# shared background event loop. The handler thread pulls chunks from a small bounded queue and writes them
+# to the socket:
+#   - if the socket is slow, the queue fills and the producer stops pulling from the model (backpressure)
+#   - if the browser goes away (EventSource.close(), tab closed, /api/clear), the next write fails or the
+#     idle-time socket check sees EOF, and the producer task is cancelled, which cancels the upstream call
+#     so no more tokens are generated or billed for an answer nobody will read.
+
+_END = object()
+
+
+class SSEEvent(NamedTuple):
+    '''A named event in a chat stream (e.g. "extracting" progress while a policy is extracted), as opposed to a chunk
+    of the answer, which goes out as a plain data: line.'''
+    event: str
+    data: dict
+
+
+def sse_message(item) -> bytes:
+    if isinstance(item, SSEEvent):
+        return f"event: {item.event}\ndata: {json.dumps(item.data)}\n\n".encode('utf-8')
+    return f"data: {item}\n\n".encode('utf-8')
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_stream_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared event loop that runs model streams, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='sse-stream-loop', daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+class ClientDisconnected(Exception):
+    """Raised when the client at the other end of an SSE stream has gone away."""
+    pass
+
+
+def client_disconnected(sock: socket.socket) -> bool:
+    '''True if the peer has closed the connection. An EventSource never sends anything after its request,
+    so a readable socket that yields no data means EOF.'''
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+class StreamStats:
+    '''Counters for /api/stats. Tokens are estimated from streamed characters. The tokens saved by an
+    abandoned stream are estimated as the average length of completed answers minus what was already sent.
+    Streams that end in an error are counted as failed, not abandoned: nobody cancelled them.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = 0
+        self.completed = 0
+        self.abandoned = 0
+        self.failed = 0
+        self.completed_tokens = 0
+        self.abandoned_tokens_streamed = 0
+        self.estimated_tokens_saved = 0
+
+    def record_started(self) -> None:
+        with self._lock:
+            self.started += 1
+
+    def record_completed(self, tokens_streamed: int) -> None:
+        with self._lock:
+            self.completed += 1
+            self.completed_tokens += tokens_streamed
+
+    def record_abandoned(self, tokens_streamed: int) -> None:
+        with self._lock:
+            self.abandoned += 1
+            self.abandoned_tokens_streamed += tokens_streamed
+            if self.completed:
+                average_answer = self.completed_tokens / self.completed
+                self.estimated_tokens_saved += max(0, round(average_answer) - tokens_streamed)
+
+    def record_failed(self) -> None:
+        with self._lock:
+            self.failed += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "completed": self.completed,
+                "abandoned": self.abandoned,
+                "failed": self.failed,
+                "in_flight": self.started - self.completed - self.abandoned - self.failed,
+                "abandoned_tokens_streamed": self.abandoned_tokens_streamed,
+                "estimated_tokens_saved": self.estimated_tokens_saved,
+            }
+
+
+stream_stats = StreamStats()
+
+
+def stream_sse(chunks: AsyncIterator[str],
+               write_event: Callable[[str], None],
+               sock: socket.socket,
+               queue_size: int = 8,
+               poll_interval: float = 0.25) -> bool:
+    '''
+    Drive the async generator `chunks` on the shared loop and hand each chunk to write_event on the calling thread.
+
+    Args:
+        chunks: async generator of SSE payloads (e.g. ahandle_query(...))
+        write_event: writes one payload to the client; raises BrokenPipeError/ConnectionResetError if it is gone
+        sock: the client socket, checked for EOF while waiting on the model
+        queue_size: chunks the producer may run ahead of the socket before it pauses
+        poll_interval: how often (seconds) to check for a dropped client while no chunk is ready
+
+    Returns:
+        True if the stream ran to completion, False if the client disconnected and generation was cancelled.
+    '''
+    loop = get_stream_loop()
+    handoff = queue.Queue(maxsize=queue_size)
+
+    async def put(item):
+        while True:
+            try:
+                handoff.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)  # socket is behind: stop pulling from the model until it catches up
+
+    async def pump():
+        try:
+            async for chunk in chunks:
+                await put(chunk)
+            await put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await put(e)
+        finally:
+            await chunks.aclose()
+
+    stream_stats.record_started()
+    pump_future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    tokens_streamed = 0
+    try:
+        while True:
+            try:
+                item = handoff.get(timeout=poll_interval)
+            except queue.Empty:
+                if client_disconnected(sock):
+                    raise ClientDisconnected()
+                continue
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            write_event(item)
+            if isinstance(item, str):
+                tokens_streamed += estimate_tokens(item)
+    except (ClientDisconnected, BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+        pump_future.cancel()  # cancels the astream task, and with it the upstream model call
+        stream_stats.record_abandoned(tokens_streamed)
+        return False
+    except BaseException:  # the producer raised, or this thread was interrupted
+        pump_future.cancel()
+        stream_stats.record_failed()
+        raise
+
+    stream_stats.record_completed(tokens_streamed)
+    return True
@@ -0,0 +1,225 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from langchain.memory import ConversationBufferMemory
+from langchain.schema import BaseMessage, HumanMessage
+
+from handlers.ui_text_utils import CHARS_PER_TOKEN, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Per-session conversation memory
+####################################
+# Each turn used to read memory.load_memory_variables({})["history"] several times and then run
+# format_history_for_gemini over the whole conversation, re-hashing every message's content to drop duplicates.
+# That made the per-turn cost grow with the length of the conversation. Here the Gemini-ready history is kept
+# alongside the buffer and extended in save_context, so each turn only processes the two new messages.
+
+
+class FormattedHistory:
+    '''The conversation as format_history_for_gemini would return it (messages whose content has already
+    appeared are dropped), maintained incrementally. The message list is append-only; clearing the memory
+    replaces the whole FormattedHistory, so a list handed to an in-flight prompt never changes under it.'''
+
+    def __init__(self):
+        self.messages: List[BaseMessage] = []
+        self._seen_contents = set()
+
+    def extend(self, new_messages: List[BaseMessage]) -> None:
+        for msg in new_messages:
+            content = str(msg.content)
+            # Only add message if we haven't seen it before
+            if content not in self._seen_contents:
+                self.messages.append(msg)  # Keep the original message object
+                self._seen_contents.add(content)
+
+
+class SessionConversationMemory:
+    '''Drop-in replacement for the ConversationBufferMemory each session used to hold. The full transcript still
+    lives in a ConversationBufferMemory (chat_memory is what /api/get_conversation_history shows); history_messages()
+    returns the formatted history for the prompt without rebuilding it.'''
+
+    def __init__(self):
+        self.buffer = ConversationBufferMemory(return_messages=True)
+        self.formatted_history = FormattedHistory()
+
+    @property
+    def chat_memory(self):
+        return self.buffer.chat_memory
+
+    def load_memory_variables(self, inputs: Dict) -> Dict:
+        return self.buffer.load_memory_variables(inputs)
+
+    def save_context(self, inputs: Dict, outputs: Dict) -> None:
+        already_saved = len(self.buffer.chat_memory.messages)
+        self.buffer.save_context(inputs, outputs)
+        self.formatted_history.extend(self.buffer.chat_memory.messages[already_saved:])
+
+    def history_messages(self) -> List[BaseMessage]:
+        """The history to send with the next turn. O(1): the list is shared, not copied, so don't modify it."""
+        return self.formatted_history.messages
+
+    def clear(self) -> None:
+        self.buffer.clear()
+        self.formatted_history = FormattedHistory()
+
+
+####################################
+# Token-budgeted memory
+####################################
+# SessionConversationMemory sends the whole conversation every turn, so prompts grow without bound.
+# TokenBudgetMemory sends at most token_budget tokens of history: the most recent messages verbatim, preceded by a
+# running summary of everything older. When a turn pushes messages out of the verbatim window they are folded into
+# the summary by a model call on a background thread, never on the request path. Until that finishes, those
+# messages are left out rather than sent verbatim, so the budget is never exceeded.
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='memory-summary')
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+class MemoryBudgetStats:
+    """Process-wide totals for /api/stats: history tokens left out of prompts by token-budgeted memories."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.tokens_saved = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    def record_turn(self, tokens_saved: int) -> None:
+        with self._lock:
+            self.turns += 1
+            self.tokens_saved += tokens_saved
+
+    def record_summary(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.summaries += 1
+            else:
+                self.summary_failures += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "tokens_saved": self.tokens_saved,
+                "tokens_saved_per_turn": round(self.tokens_saved / self.turns, 1) if self.turns else 0,
+                "summaries": self.summaries,
+                "summary_failures": self.summary_failures,
+            }
+
+
+memory_budget_stats = MemoryBudgetStats()
+
+
+class TokenBudgetMemory(SessionConversationMemory):
+    '''Drop-in replacement for SessionConversationMemory with a hard token budget for the history sent each turn.
+
+    Args:
+        token_budget: most history tokens (summary plus verbatim messages) sent with a turn
+        summarizer: summarizer(previous_summary, messages, max_tokens) -> new summary. Called off the request path.
+        summary_fraction: share of the budget the summary may use; the rest is for verbatim messages
+    '''
+
+    def __init__(self, token_budget: int,
+                 summarizer: Callable[[str, List[BaseMessage], int], str],
+                 summary_fraction: float = 0.25):
+        super().__init__()
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.max_summary_tokens = int(token_budget * summary_fraction)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summarized_upto = 0  # formatted messages before this index are folded into the summary
+        self.window_start = 0     # formatted messages from this index on are sent verbatim
+        self.window_tokens = 0
+        self.total_tokens = 0     # tokens of the whole formatted history, i.e. what SessionConversationMemory would send
+        self.message_tokens: List[int] = []
+        self.last_tokens_saved = 0
+        self._unrecorded_turn = False  # history_messages was read for a turn save_context hasn't recorded yet
+        self._summarizing = False
+        self._prepared: Optional[List[BaseMessage]] = None
+
+    def save_context(self, inputs: Dict, outputs: Dict) -> None:
+        super().save_context(inputs, outputs)
+        with self._lock:
+            if self._unrecorded_turn:
+                memory_budget_stats.record_turn(self.last_tokens_saved)
+                self._unrecorded_turn = False
+            messages = self.formatted_history.messages
+            for msg in messages[len(self.message_tokens):]:
+                tokens = estimate_tokens(str(msg.content))
+                self.message_tokens.append(tokens)
+                self.total_tokens += tokens
+                self.window_tokens += tokens
+            self._shrink_window_locked()
+            self._prepared = None
+            self._schedule_summary_locked()
+
+    def _shrink_window_locked(self) -> None:
+        verbatim_budget = self.token_budget - self.summary_tokens
+        while self.window_tokens > verbatim_budget and self.window_start < len(self.message_tokens):
+            self.window_tokens -= self.message_tokens[self.window_start]
+            self.window_start += 1
+
+    def _schedule_summary_locked(self) -> None:
+        if self._summarizing or self.window_start <= self.summarized_upto:
+            return
+        self._summarizing = True
+        job = (self._generation, self.summary, self.formatted_history.messages[self.summarized_upto:self.window_start], self.window_start)
+        _summary_executor.submit(self._summarize, *job)
+
+    def _summarize(self, generation: int, previous_summary: str, messages: List[BaseMessage], upto: int) -> None:
+        try:
+            new_summary = self.summarizer(previous_summary, messages,
+                                          max(1, self.max_summary_tokens - estimate_tokens(SUMMARY_PREFIX)))
+            ok = bool(new_summary)
+        except Exception as e:
+            logger.warning(f"Conversation summary failed: {e}")
+            new_summary, ok = None, False
+        memory_budget_stats.record_summary(ok)
+
+        with self._lock:
+            if generation != self._generation:
+                return  # the conversation was cleared while we were summarizing
+            self._summarizing = False
+            if not ok:
+                return  # try again after the next turn
+            # the summary is sent as SUMMARY_PREFIX + summary, and the prefix counts against the budget too
+            self.summary = new_summary[:max(0, self.max_summary_tokens * CHARS_PER_TOKEN - len(SUMMARY_PREFIX))]
+            self.summary_tokens = estimate_tokens(SUMMARY_PREFIX + self.summary) if self.summary else 0
+            self.summarized_upto = upto
+            self._shrink_window_locked()  # a longer summary leaves less room for verbatim messages
+            self._prepared = None
+            self._schedule_summary_locked()
+
+    def history_messages(self) -> List[BaseMessage]:
+        """Summary (if any) plus the verbatim window, built once per change. The tokens it leaves out are counted
+        towards the stats once per turn, when the turn is saved."""
+        with self._lock:
+            if self._prepared is None:
+                prepared = []
+                if self.summary:
+                    prepared.append(HumanMessage(content=SUMMARY_PREFIX + self.summary))
+                prepared.extend(self.formatted_history.messages[self.window_start:])
+                self._prepared = prepared
+            self.last_tokens_saved = max(0, self.total_tokens - self.window_tokens - self.summary_tokens)
+            self._unrecorded_turn = True
+            return self._prepared
+
+    def clear(self) -> None:
+        super().clear()
+        with self._lock:
+            self._generation += 1
+            self._reset_window()
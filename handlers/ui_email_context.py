@@ -0,0 +1,250 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from html import unescape
+from html.parser import HTMLParser
+from typing import List, Optional
+
+from handlers.ui_policy_retrieval import USER_QUESTION_MARKER
+
+
+####################################
+# Server-side email context
+####################################
+# script.js used to prepend the selected email (sender, subject, date and the whole body) to every question and send
+# it through the /api/chat query string, so a long email was URL-encoded, sent and parsed again on every turn, and
+# could push the URL past proxy limits. The page now sends only a reference to the email (its index and id), and
+# the context is built here from the body the server already has (session list, email cache or prefetcher).
+#
+# HTML bodies are reduced to text, and the body is cut to PP_EMAIL_CONTEXT_MAX_CHARS (default 20000), so how much
+# of an email reaches the model no longer depends on what fits in a URL.
+# The conversation memory keeps only a one-line header for the email (not its body), so the body isn't carried
+# forward in the history of later turns; each turn that refers to the email gets the body again.
+#
+# The context keeps the layout the browser used ([EMAIL CONTEXT] ... [USER QUESTION]), so question_from_query and
+# the policy retrieval see the same thing as before.
+#
+# Long emails (job digests) are map-reduced instead of cut off or sent as one huge prompt: an email whose text is
+# longer than PP_LONG_EMAIL_CHARS (default 12000, 0 turns it off) is split at paragraph breaks into segments of
+# about PP_LONG_EMAIL_SEGMENT_CHARS (default 6000), the handler has the model pull the relevant parts out of every
+# segment at once (model.batch, at most PP_LONG_EMAIL_CONCURRENCY calls in flight, default 4), and the answer is
+# streamed from those notes. Up to PP_LONG_EMAIL_MAX_CHARS of the email (default 200000) is read this way.
+# Turn latencies in /api/stats carry an email=single or email=map_reduce label, so the two modes can be compared.
+
+EMAIL_CONTEXT_MARKER = "[EMAIL CONTEXT]"
+
+_HTML_HINT = re.compile(r"<\s*(html|body|div|p|br|table|td|span|a)\b", re.IGNORECASE)
+_BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table", "ul", "ol",
+               "blockquote", "section", "article", "header", "footer", "hr"}
+_SKIPPED_TAGS = {"script", "style", "head", "title"}
+
+
+class _TextExtractor(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def html_to_text(body: str) -> str:
+    """Plain text of an HTML body: tags, scripts and styles dropped, entities decoded, whitespace tidied."""
+    parser = _TextExtractor()
+    try:
+        parser.feed(body)
+        parser.close()
+        text = "".join(parser.parts)
+    except Exception:
+        text = unescape(re.sub(r"<[^>]+>", " ", body))  # badly broken markup: just strip the tags
+    return normalize_whitespace(text)
+
+
+def normalize_whitespace(text: str) -> str:
+    lines = [re.sub(r"[ \t\r\f\v\u00a0]+", " ", line).strip() for line in text.split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def email_body_text(body: Optional[str]) -> str:
+    if not body:
+        return ""
+    return html_to_text(body) if _HTML_HINT.search(body) else normalize_whitespace(body)
+
+
+def split_segments(text: str, segment_chars: int) -> List[str]:
+    '''Split text into segments of at most segment_chars, at paragraph breaks where possible.'''
+    segments, current = [], ""
+    for paragraph in text.split("\n\n"):
+        while len(paragraph) > segment_chars:  # a paragraph too long on its own is cut where it must be
+            if current:
+                segments.append(current)
+                current = ""
+            segments.append(paragraph[:segment_chars])
+            paragraph = paragraph[segment_chars:]
+        if current and len(current) + 2 + len(paragraph) > segment_chars:
+            segments.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        segments.append(current)
+    return segments
+
+
+NOTHING_RELEVANT = "NOTHING RELEVANT"
+
+
+@dataclass
+class EmailTurn:
+    '''One chat turn's input, with or without an email.'''
+    model_input: str
+    memory_input: str
+    mode: str = "none"   # "none" (no email), "single" (whole email in the prompt), "map_reduce" or "jobs"
+    email: Optional[dict] = None
+    question: str = ""
+    segments: List[str] = field(default_factory=list)  # map_reduce: the parts of the email to take notes from
+
+
+def email_header(email: dict) -> str:
+    """The one line the conversation memory keeps for an email the question was about."""
+    return f"[EMAIL] From: {email.get('sender', '')} | Subject: {email.get('subject', '')} | Date: {email.get('date', '')}"
+
+
+class EmailContextBuilder:
+    '''Builds the email context for a chat turn. Normalized bodies of recent emails are kept, since follow-up
+    questions about the same email are the common case.'''
+
+    def __init__(self, max_chars: int = 20000, cached_emails: int = 32, long_chars: int = 12000,
+                 segment_chars: int = 6000, long_max_chars: int = 200000):
+        self.max_chars = max_chars
+        self.cached_emails = cached_emails
+        self.long_chars = long_chars
+        self.segment_chars = segment_chars
+        self.long_max_chars = long_max_chars
+        self._texts: "OrderedDict[str, str]" = OrderedDict()  # message id -> normalized body
+        self._lock = threading.Lock()
+        self.built = 0
+        self.truncated = 0
+        self.normalized = 0
+        self.raw_chars = 0
+        self.sent_chars = 0
+        self.map_reduced = 0
+        self.segments = 0
+        self.from_jobs = 0
+
+    def _text(self, email: dict, body: str) -> str:
+        message_id = email.get('id')
+        with self._lock:
+            text = self._texts.get(message_id) if message_id else None
+            if text is not None:
+                self._texts.move_to_end(message_id)
+                return text
+        text = email_body_text(body)
+        with self._lock:
+            self.normalized += 1
+            if message_id:
+                self._texts[message_id] = text
+                while len(self._texts) > self.cached_emails:
+                    self._texts.popitem(last=False)
+        return text
+
+    def build(self, email: dict, body: str, question: str) -> EmailTurn:
+        '''
+        The turn's input for the model (the question with the email's context) and for the conversation memory (the
+        question with only the email's header). A long email comes back as mode "map_reduce" with its segments:
+        model_input is filled in by reduce() once the notes on them are in.
+        '''
+        text = self._text(email, body)
+        memory_input = f"{email_header(email)}\n{USER_QUESTION_MARKER}\n{question}"
+
+        if self.long_chars and len(text) > self.long_chars:
+            shown = text[:self.long_max_chars]
+            segments = split_segments(shown, self.segment_chars)
+            with self._lock:
+                self.built += 1
+                self.map_reduced += 1
+                self.segments += len(segments)
+                self.truncated += len(shown) != len(text)
+                self.raw_chars += len(body or "")
+            return EmailTurn("", memory_input, "map_reduce", email, question, segments)
+
+        shown = text
+        if len(text) > self.max_chars:
+            shown = text[:self.max_chars].rstrip() + f"\n\n[... {len(text) - self.max_chars} more characters not shown]"
+
+        with self._lock:
+            self.built += 1
+            self.truncated += len(shown) != len(text)
+            self.raw_chars += len(body or "")
+            self.sent_chars += len(shown)
+
+        return EmailTurn(self._context(email, shown, question), memory_input, "single", email, question)
+
+    def build_from_jobs(self, email: dict, jobs_text: str, question: str) -> EmailTurn:
+        '''Like build, with the job postings extracted from the email (ui_job_extraction.py) in place of its body.'''
+        memory_input = f"{email_header(email)}\n{USER_QUESTION_MARKER}\n{question}"
+        with self._lock:
+            self.built += 1
+            self.from_jobs += 1
+            self.sent_chars += len(jobs_text)
+        return EmailTurn(self._context(email, jobs_text, question), memory_input, "jobs", email, question)
+
+    def reduce(self, turn: EmailTurn, notes: List[str]) -> None:
+        '''Fill in a map_reduce turn's model_input from the notes taken on each of its segments.'''
+        parts = [f"Part {n} of {len(notes)}:\n{note.strip()}" for n, note in enumerate(notes, 1)
+                 if note.strip() and not note.strip().upper().startswith(NOTHING_RELEVANT)]
+        body = (f"(This email is too long to include whole. Below are notes taken from each of its {len(notes)} "
+                "parts, in order, with everything relevant to the question.)\n\n")
+        body += "\n\n".join(parts) if parts else "(No part of the email had anything relevant to the question.)"
+        with self._lock:
+            self.sent_chars += len(body)
+        turn.model_input = self._context(turn.email, body, turn.question)
+
+    def _context(self, email: dict, body: str, question: str) -> str:
+        return f"""{EMAIL_CONTEXT_MARKER}
+From: {email.get('sender', '')}
+Subject: {email.get('subject', '')}
+Date: {email.get('date', '')}
+
+Body:
+{body}
+
+{USER_QUESTION_MARKER}
+{question}"""
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "built": self.built,
+                "truncated": self.truncated,
+                "normalized": self.normalized,
+                "cached_emails": len(self._texts),
+                "raw_body_chars": self.raw_chars,
+                "sent_body_chars": self.sent_chars,
+                "map_reduced": self.map_reduced,
+                "segments": self.segments,
+                "from_jobs": self.from_jobs,
+            }
+
+
+long_email_concurrency = int(os.getenv('PP_LONG_EMAIL_CONCURRENCY', '4'))
+email_context = EmailContextBuilder(max_chars=int(os.getenv('PP_EMAIL_CONTEXT_MAX_CHARS', '20000')),
+                                    long_chars=int(os.getenv('PP_LONG_EMAIL_CHARS', '12000')),
+                                    segment_chars=int(os.getenv('PP_LONG_EMAIL_SEGMENT_CHARS', '6000')),
+                                    long_max_chars=int(os.getenv('PP_LONG_EMAIL_MAX_CHARS', '200000')))
@@ -0,0 +1,192 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, ContextManager, Dict, Iterable, Optional
+
+from handlers.ui_gmail_fetch import call_with_retries
+from handlers.ui_latency_stats import latency_stats
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Email body prefetch
+####################################
+# Bodies used to be fetched only when the user clicked an email, so every click paid a Gmail round trip before
+# anything could be asked about it. After a list fetch, the bodies of the newest PP_PREFETCH_TOP_K emails are
+# fetched in the background; after each selection, the PP_PREFETCH_NEIGHBOURS emails either side of it are queued
+# ahead of those. Fetched bodies go into the persistent email cache, where handle_select_email looks first.
+# A click on an email whose body is still being fetched waits for that fetch instead of starting another one.
+#
+#     PP_PREFETCH_TOP_K        newest emails to prefetch after a list fetch (default 10, 0 turns prefetch off)
+#     PP_PREFETCH_NEIGHBOURS   emails either side of the selection to prefetch (default 2)
+#     PP_PREFETCH_WORKERS      concurrent body fetches (default 4); requests share the Gmail rate limiter
+# /api/stats reports how many selections found their body warm (hit), waited for a prefetch in flight, or had to
+# fetch it themselves (miss).
+
+PRIORITY_SELECTION = 0   # neighbours of the email the user is reading
+PRIORITY_LIST = 1        # newest emails of a fresh list
+
+
+class BodyPrefetcher:
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._pending: Dict[str, Future] = {}   # message id -> Future, queued or running
+        self._queued: Dict[str, tuple] = {}     # message id -> (priority, order) of its latest queue entry
+        self._generations: Dict[str, int] = {}  # session key -> generation of its current list, while it has entries queued
+        self._outstanding: Dict[str, int] = {}  # session key -> queue entries not taken off the queue yet
+        self._lock = threading.Lock()
+        self._order = itertools.count()
+        self._threads = []
+        self.prefetched = 0
+        self.failed = 0
+        self.skipped = 0
+        self.hits = 0
+        self.inflight_waits = 0
+        self.misses = 0
+
+    def _start_workers(self) -> None:
+        # started lazily so importing the module doesn't start threads
+        if not self._threads:
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'body-prefetch-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def new_list(self, session_key: str) -> None:
+        '''A session fetched a new email list: its queued prefetches for the old list are dropped. A session with
+        nothing queued has no generation to move on; its entries are dropped as soon as its last one is taken.'''
+        with self._lock:
+            if session_key in self._generations:
+                self._generations[session_key] += 1
+
+    def schedule(self, session_key: str, message_ids: Iterable[str], priority: int,
+                 fetch_body: Callable[[object, str], str], client: Callable[[], ContextManager],
+                 is_cached: Callable[[str], bool], store_body: Callable[[str, str], None]) -> None:
+        '''
+        Queue message_ids for prefetch, skipping any already cached, queued or running.
+
+        fetch_body: get_message_body(service, message_id)
+        client: gmail_pool.client - lends each worker a Gmail service of its own
+        is_cached / store_body: look up and store bodies in the persistent email cache
+        '''
+        with self._lock:
+            self._start_workers()
+            generation = self._generations.get(session_key, 0)
+            queued = 0
+            for message_id in message_ids:
+                future = self._pending.get(message_id)
+                if future is None:
+                    if is_cached(message_id):
+                        continue
+                    future = self._pending[message_id] = Future()
+                elif future.running() or self._queued[message_id][0] <= priority:
+                    continue
+                # new, or queued behind less urgent work: (re)queue it; whichever entry is popped first runs it
+                entry = (priority, next(self._order))
+                self._queued[message_id] = entry
+                self._queue.put(entry + (message_id, future, session_key, generation,
+                                         fetch_body, client, store_body))
+                queued += 1
+            if queued:
+                self._generations[session_key] = generation
+                self._outstanding[session_key] = self._outstanding.get(session_key, 0) + queued
+
+    def _taken_locked(self, session_key: str) -> None:
+        '''One of the session's queue entries was taken off the queue. Called with the lock held.'''
+        self._outstanding[session_key] -= 1
+        if not self._outstanding[session_key]:
+            del self._outstanding[session_key]
+            del self._generations[session_key]
+
+    def _work(self) -> None:
+        while True:
+            (priority, order, message_id, future, session_key, generation,
+             fetch_body, client, store_body) = self._queue.get()
+            with self._lock:
+                stale = self._generations[session_key] != generation
+                self._taken_locked(session_key)
+                if future.done() or future.running():
+                    continue  # an earlier entry for the same message ran it
+                if stale:
+                    if self._queued.get(message_id) == (priority, order):  # no newer entry will come for it
+                        self._pending.pop(message_id, None)
+                        self._queued.pop(message_id, None)
+                        self.skipped += 1
+                        future.cancel()
+                    continue
+                future.set_running_or_notify_cancel()
+
+            started = time.perf_counter()
+            try:
+                with client() as service:
+                    body = call_with_retries(lambda: fetch_body(service, message_id))
+                store_body(message_id, body)
+                future.set_result(body)
+                with self._lock:
+                    self.prefetched += 1
+                latency_stats.record("email_body_prefetch_ms", (time.perf_counter() - started) * 1000)
+            except Exception as e:
+                logger.info(f"Prefetch of email {message_id} failed: {e}")
+                future.set_exception(e)
+                with self._lock:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self._pending.pop(message_id, None)
+                    self._queued.pop(message_id, None)
+
+    def get_body(self, message_id: str, cached_body: Callable[[str], Optional[str]],
+                 fetch_now: Callable[[], str], timeout: float = 30) -> str:
+        '''The body for a selection: from the cache, from a prefetch in flight, or fetched right now (fetch_now).'''
+        body = cached_body(message_id)
+        if body is not None:
+            with self._lock:
+                self.hits += 1
+            return body
+
+        with self._lock:
+            future = self._pending.get(message_id)
+            if future is not None and not future.running():
+                # still queued behind other prefetches: fetching it now is quicker than waiting our turn
+                future.cancel()
+                self._pending.pop(message_id, None)
+                self._queued.pop(message_id, None)
+                future = None
+        if future is not None:
+            try:
+                body = future.result(timeout=timeout)
+                with self._lock:
+                    self.inflight_waits += 1
+                return body
+            except Exception:
+                pass  # failed or too slow: fetch it ourselves
+
+        with self._lock:
+            self.misses += 1
+        return fetch_now()
+
+    def stats(self) -> dict:
+        with self._lock:
+            selections = self.hits + self.inflight_waits + self.misses
+            return {
+                "prefetched": self.prefetched,
+                "failed": self.failed,
+                "skipped_stale": self.skipped,
+                "queued": len(self._pending),
+                "hits": self.hits,
+                "inflight_waits": self.inflight_waits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.inflight_waits) / selections, 3) if selections else None,
+            }
+
+
+prefetch_top_k = int(os.getenv('PP_PREFETCH_TOP_K', '10'))
+prefetch_neighbours = int(os.getenv('PP_PREFETCH_NEIGHBOURS', '2'))
+body_prefetcher = BodyPrefetcher(workers=int(os.getenv('PP_PREFETCH_WORKERS', '4')))
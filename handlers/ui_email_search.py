@@ -0,0 +1,285 @@
+import logging
+import heapq
+import math
+import os
+import threading
+import time
+from collections import Counter
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from handlers.ui_email_context import email_body_text
+from handlers.ui_latency_stats import latency_stats
+from handlers.ui_text_utils import tokenize
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Email search
+####################################
+# Finding something in a day's mail meant clicking through the sidebar, paying a body fetch (and often a model call)
+# on every wrong email. This is an in-process inverted index over the sender, subject and body of every message in
+# the email cache, ranked with BM25 like the policy retrieval (ui_policy_retrieval.py), behind /api/search_emails.
+#
+# It is incremental: metadata is indexed as listings and history syncs bring it in, and a body is added to its
+# message's entry as soon as it is fetched or prefetched. What the cache already had when the server started is
+# loaded on a background thread the first time the index is used; searches during that load cover what is in so far.
+# A match in the subject counts for PP_EMAIL_SEARCH_SUBJECT_WEIGHT (default 3) matches in the body, a match in the
+# sender for PP_EMAIL_SEARCH_SENDER_WEIGHT (default 2). Only the first PP_EMAIL_SEARCH_BODY_CHARS (default 20000)
+# characters of a body are indexed.
+#
+# Deleted messages are only marked dead at first. A search drops the dead documents from the postings of the terms
+# it looks up, each only once per term. After compact_after deletions, the dead documents are dropped from every
+# posting list and the live ones are renumbered. Neither the index nor the cost of a search grows with the number
+# of messages ever deleted.
+
+
+class EmailSearchIndex:
+
+    def __init__(self, subject_weight: float = 3.0, sender_weight: float = 2.0, body_chars: int = 20000,
+                 k1: float = 1.2, b: float = 0.75, compact_after: int = 1024):
+        self.compact_after = compact_after
+        self.subject_weight = subject_weight
+        self.sender_weight = sender_weight
+        self.body_chars = body_chars
+        self.k1 = k1
+        self.b = b
+        self.load_messages: Callable[[], Iterable[Tuple[Dict, Optional[str]]]] = None  # every cached (metadata, body)
+        self._docs: Dict[str, int] = {}    # message id -> document number
+        self._ids: List[Optional[str]] = []  # document number -> message id, None once deleted
+        self._lengths: List[float] = []    # weighted token count of each document
+        self._norms: List[float] = []      # BM25 length normalisation of each document, k1 * (1 - b + b * length / average)
+        self._average = 0.0                # the average length the norms were computed with
+        self._dead: List[int] = []         # document numbers of deleted messages since the last compaction, in order
+        self._purged: Dict[str, int] = {}  # term -> how much of _dead has been dropped from its postings
+        self._has_body: List[bool] = []
+        self._postings: Dict[str, Dict[int, float]] = {}  # term -> {document number: weighted term frequency}
+        self._total_length = 0.0
+        self._live = 0
+        self._lock = threading.Lock()
+        self._loader = None
+        self.loaded = False
+        self.searches = 0
+        self.bodies = 0
+
+    def configure(self, load_messages) -> None:
+        self.load_messages = load_messages
+
+    def _ensure_loading(self) -> None:
+        '''Start indexing what the email cache already has, once. Called with the lock held.'''
+        if self._loader is None and self.load_messages is not None:
+            self._loader = threading.Thread(target=self._load, name='email-search-load', daemon=True)
+            self._loader.start()
+
+    def _load(self) -> None:
+        started = time.perf_counter()
+        try:
+            for metadata, body in self.load_messages():
+                self.add(metadata, body)
+        except Exception as e:
+            logger.warning(f"Loading the email search index failed: {e}")
+        self.loaded = True
+        latency_stats.record("email_search_load_ms", (time.perf_counter() - started) * 1000)
+
+    # --- updates ---
+
+    def add(self, metadata: Dict, body: Optional[str] = None) -> None:
+        '''Index a message's sender and subject, and its body if given. Known messages only gain a body they lacked:
+        metadata and bodies don't change once Gmail has them.'''
+        message_id = metadata['id']
+        with self._lock:
+            self._ensure_loading()
+            doc = self._docs.get(message_id)
+            if doc is not None and (body is None or self._has_body[doc]):
+                return
+        # tokenized outside the lock, so searches don't wait on a long body
+        meta_terms = Counter()
+        if doc is None:
+            for term in tokenize(metadata.get('subject') or ''):
+                meta_terms[term] += self.subject_weight
+            for term in tokenize(metadata.get('sender') or ''):
+                meta_terms[term] += self.sender_weight
+        body_terms = Counter()
+        if body is not None:
+            body_terms.update(tokenize(email_body_text(body[:self.body_chars * 2])[:self.body_chars]))
+
+        with self._lock:
+            doc = self._docs.get(message_id)  # the loader may have got there first
+            if doc is None:
+                doc = len(self._ids)
+                self._docs[message_id] = doc
+                self._ids.append(message_id)
+                self._lengths.append(0.0)
+                self._norms.append(0.0)
+                self._has_body.append(False)
+                self._live += 1
+                terms = meta_terms + body_terms
+            elif body is not None and not self._has_body[doc]:
+                terms = body_terms
+            else:
+                return
+            for term, tf in terms.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    self._postings[term] = {doc: tf}
+                    self._purged[term] = len(self._dead)  # no dead document can be in a new term's postings
+                else:
+                    postings[doc] = postings.get(doc, 0.0) + tf
+            length = sum(terms.values())
+            self._lengths[doc] += length
+            self._total_length += length
+            if body is not None:
+                self._has_body[doc] = True
+                self.bodies += 1
+            self._update_norms(doc)
+
+    def _update_norms(self, doc: Optional[int] = None) -> None:
+        '''Keep the length normalisation current without redoing it for every document on every change: only when
+        the average length has drifted by more than 5% are all of them recomputed. Called with the lock held.'''
+        average = self._total_length / self._live if self._live else 0.0
+        if not self._average or abs(average - self._average) > 0.05 * self._average:
+            self._average = average or 1.0
+            k1, b = self.k1, self.b
+            self._norms = [k1 * (1 - b + b * length / self._average) for length in self._lengths]
+        elif doc is not None:
+            self._norms[doc] = self.k1 * (1 - self.b + self.b * self._lengths[doc] / self._average)
+
+    def add_body(self, message_id: str, body: str) -> None:
+        '''Add a fetched body to a message already indexed by its metadata (unknown messages are left alone).'''
+        with self._lock:
+            known = message_id in self._docs
+        if known:
+            self.add({'id': message_id}, body)
+
+    def remove(self, message_ids: Iterable[str]) -> None:
+        with self._lock:
+            for message_id in message_ids:
+                doc = self._docs.pop(message_id, None)
+                if doc is None:
+                    continue
+                self._ids[doc] = None
+                self._dead.append(doc)
+                self._total_length -= self._lengths[doc]
+                self._live -= 1
+                self.bodies -= self._has_body[doc]
+            if len(self._dead) >= self.compact_after:
+                self._compact()
+            self._update_norms()
+
+    def _purge(self, term: str) -> Optional[Dict[int, float]]:
+        '''The term's postings without dead documents, or None if none are left. Called with the lock held.'''
+        postings = self._postings.get(term)
+        if postings is None:
+            return None
+        purged = self._purged.get(term, 0)
+        if purged < len(self._dead):
+            for doc in self._dead[purged:]:
+                postings.pop(doc, None)
+            self._purged[term] = len(self._dead)
+        if not postings:
+            del self._postings[term]
+            del self._purged[term]
+            return None
+        return postings
+
+    def _compact(self) -> None:
+        '''Drop dead documents from every posting list and renumber the live ones. Called with the lock held.'''
+        started = time.perf_counter()
+        renumbered = {}
+        for doc, message_id in enumerate(self._ids):
+            if message_id is not None:
+                renumbered[doc] = len(renumbered)
+        live = list(renumbered)
+        self._ids = [self._ids[doc] for doc in live]
+        self._lengths = [self._lengths[doc] for doc in live]
+        self._norms = [self._norms[doc] for doc in live]
+        self._has_body = [self._has_body[doc] for doc in live]
+        self._docs = {message_id: doc for doc, message_id in enumerate(self._ids)}
+        postings_by_term = {}
+        for term, postings in self._postings.items():
+            postings = {renumbered[doc]: tf for doc, tf in postings.items() if doc in renumbered}
+            if postings:
+                postings_by_term[term] = postings
+        self._postings = postings_by_term
+        self._purged = dict.fromkeys(postings_by_term, 0)
+        self._dead = []
+        latency_stats.record("email_search_compact_ms", (time.perf_counter() - started) * 1000)
+
+    # --- search ---
+
+    def search(self, query: str, limit: int = 20, within: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        '''Up to limit (message id, score) pairs for the query, best first. within restricts the search to those ids.'''
+        started = time.perf_counter()
+        terms = list(dict.fromkeys(tokenize(query)))
+        results = []
+        with self._lock:
+            self._ensure_loading()
+            self.searches += 1
+            if terms and self._live:
+                docs = None
+                if within is not None:
+                    docs = {self._docs[i] for i in within if i in self._docs}
+                n, ids, norms = self._live, self._ids, self._norms
+                found = []  # (postings, weight), rarest term first
+                for term in terms:
+                    postings = self._purge(term)
+                    if postings is None:
+                        continue
+                    found.append((postings, math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5)) * (self.k1 + 1)))
+                found.sort(key=lambda item: len(item[0]))
+
+                # Words in more than half the emails say little about which ones are wanted, and a pass over their
+                # postings is a pass over most of the cache. Across the whole cache, when the rarer words already
+                # found at least limit emails, the common words only add to the scores of the best of those. A
+                # search within a set of emails (a day) is small enough to score every word, and so is one whose
+                # rarer words found too few emails: emails matching only the common words are results too.
+                common = n // 2
+                leading = [item for item in found if len(item[0]) <= common] or found[:1]
+                scores = {}
+
+                def add_scores(postings, weight):
+                    if docs is not None and len(docs) < len(postings):
+                        matches = [(doc, postings[doc]) for doc in docs if doc in postings]
+                    elif docs is not None:
+                        matches = [(doc, tf) for doc, tf in postings.items() if doc in docs]
+                    else:
+                        matches = postings.items()
+                    get = scores.get
+                    for doc, tf in matches:
+                        scores[doc] = get(doc, 0.0) + weight * tf / (tf + norms[doc])
+
+                for postings, weight in leading:
+                    add_scores(postings, weight)
+                rest = found[len(leading):]
+                if docs is not None or len(scores) < limit:
+                    for postings, weight in rest:
+                        add_scores(postings, weight)
+                else:
+                    if len(scores) > limit * 50:
+                        scores = dict(heapq.nlargest(limit * 50, scores.items(), key=itemgetter(1)))
+                    for postings, weight in rest:
+                        for doc in scores:
+                            tf = postings.get(doc)
+                            if tf is not None:
+                                scores[doc] += weight * tf / (tf + norms[doc])
+                best = heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+                results = [(ids[doc], score) for doc, score in best]
+        latency_stats.record("email_search_ms", (time.perf_counter() - started) * 1000)
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "messages": self._live,
+                "bodies": self.bodies,
+                "terms": len(self._postings),
+                "dead": len(self._dead),
+                "searches": self.searches,
+            }
+
+
+email_search = EmailSearchIndex(subject_weight=float(os.getenv('PP_EMAIL_SEARCH_SUBJECT_WEIGHT', '3')),
+                                sender_weight=float(os.getenv('PP_EMAIL_SEARCH_SENDER_WEIGHT', '2')),
+                                body_chars=int(os.getenv('PP_EMAIL_SEARCH_BODY_CHARS', '20000')))
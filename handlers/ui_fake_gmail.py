@@ -0,0 +1,249 @@
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from handlers.ui_gmail_fetch import replay_history
+
+
+####################################
+# Local fake Gmail
+####################################
+# Drop-in stand-ins for the Gmail functions taken from Multi_Agent_Email_tool/V0.4.py (gmail_authenticate,
+# fetch_messages, get_message_metadata, get_message_body, generate_gmail_search_query), build_gmail_service and the
+# listing and history calls of ui_gmail_fetch.py, so email fetching can be exercised and measured without a Google
+# account or network.
+# Selected with PP_EMAIL_SOURCE=fake. Its knobs:
+#     PP_FAKE_GMAIL_MESSAGES     messages per day (default 300)
+#     PP_FAKE_GMAIL_LATENCY_MS   latency of each API call (default 80)
+#     PP_FAKE_GMAIL_MAX_INFLIGHT concurrent calls accepted before answering 429 like Gmail's rate limiter (default 25)
+#     PP_FAKE_GMAIL_AUTH_MS      cost of gmail_authenticate: loading token.json and checking it (default 150)
+#     PP_FAKE_GMAIL_BUILD_MS     cost of building a service from the discovery document (default 60)
+# Each day's mailbox is generated from the date, so every run sees the same messages. mailbox.add_message and
+# mailbox.delete_message, mailbox.trash_message and mailbox.untrash_message change it afterwards, and show up in the
+# history like real deliveries, deletions and TRASH label changes.
+
+_SENDERS = ["Acme Recruiting <jobs@acme.example>", "LinkedIn Job Alerts <jobalerts-noreply@linkedin.example>",
+            "Indeed <alert@indeed.example>", "Dana Whitfield <dana@startup.example>", "GitHub <noreply@github.example>",
+            "Lincoln Financial <service@lincoln.example>", "Calendar <calendar-noreply@google.example>"]
+_TITLES = ["Senior Backend Engineer", "Staff Data Scientist", "ML Platform Engineer", "Engineering Manager",
+           "Site Reliability Engineer", "Product Analyst", "Frontend Developer"]
+_PLACES = ["Remote (US)", "Seattle, WA (hybrid)", "New York, NY (onsite)", "Austin, TX (remote)", "Boston, MA (hybrid)"]
+_WORDS = """team platform build scale customers data pipeline reliability services product roadmap experience
+ownership python distributed systems cloud mentoring collaborate design reviews impact growth benefits""".split()
+
+
+class FakeHttpError(Exception):
+    '''Quacks like googleapiclient.errors.HttpError for the parts callers look at (resp.status).'''
+
+    def __init__(self, status: int, reason: str):
+        super().__init__(f"<HttpError {status}: {reason}>")
+        self.resp = type('FakeResponse', (), {'status': status, 'reason': reason})()
+        self.status_code = status
+
+
+class FakeCredentials:
+    valid = True
+    expired = False
+    refresh_token = "fake-refresh-token"
+
+    def refresh(self, request=None):
+        pass
+
+
+class FakeGmailService:
+    '''One "HTTP connection": counts the calls made through it.'''
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.calls = 0
+
+
+class _FakeMailbox:
+
+    def __init__(self):
+        self.messages_per_day = int(os.getenv('PP_FAKE_GMAIL_MESSAGES', '300'))
+        self.latency_s = float(os.getenv('PP_FAKE_GMAIL_LATENCY_MS', '80')) / 1000
+        self.max_inflight = int(os.getenv('PP_FAKE_GMAIL_MAX_INFLIGHT', '25'))
+        self.auth_s = float(os.getenv('PP_FAKE_GMAIL_AUTH_MS', '150')) / 1000
+        self.build_s = float(os.getenv('PP_FAKE_GMAIL_BUILD_MS', '60')) / 1000
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._messages = {}  # id -> message dict
+        self._days = {}      # date -> [ids]
+        self.history_id = 1000
+        self._history = []   # (history id, 'added', 'deleted', 'trashed' or 'untrashed', message id)
+        self._trash = {}     # id -> date of each trashed message
+        self.calls = 0
+        self.rate_limited = 0
+        self.authentications = 0
+        self.builds = 0
+
+    def call(self, service):
+        '''Simulate one API round trip: latency, and 429 when too many calls are in flight at once.'''
+        with self._lock:
+            self.calls += 1
+            if service is not None:
+                service.calls += 1
+            if self._inflight >= self.max_inflight:
+                self.rate_limited += 1
+                raise FakeHttpError(429, "Too many concurrent requests for user")
+            self._inflight += 1
+        try:
+            time.sleep(self.latency_s)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def day(self, date):
+        with self._lock:
+            ids = self._days.get(date)
+            if ids is None:
+                ids = self._generate_day(date)
+                self._days[date] = ids
+            return ids
+
+    def _generate_day(self, date):
+        rng = random.Random(date.isoformat())
+        start = datetime(date.year, date.month, date.day, tzinfo=timezone.utc)
+        ids = []
+        for n in range(self.messages_per_day):
+            sent = start + timedelta(seconds=rng.randrange(24 * 3600))
+            message_id = f"{date.strftime('%Y%m%d')}{n:05d}{rng.randrange(16 ** 6):06x}"
+            title, place = rng.choice(_TITLES), rng.choice(_PLACES)
+            paragraphs = [' '.join(rng.choice(_WORDS) for _ in range(rng.randint(40, 160)))
+                          for _ in range(rng.randint(2, 12))]
+            self._messages[message_id] = {
+                'id': message_id,
+                'sender': rng.choice(_SENDERS),
+                'subject': f"{title} - {place}",
+                'date': sent.strftime('%a, %d %b %Y %H:%M:%S +0000'),
+                'internal_date': str(int(sent.timestamp() * 1000)),
+                'body': f"{title}\nLocation: {place}\n\n" + '\n\n'.join(paragraphs),
+            }
+            ids.append(message_id)
+        return ids
+
+    def message(self, message_id):
+        with self._lock:
+            return self._messages.get(message_id)
+
+    def add_message(self, date, sender, subject, body):
+        """Deliver a new message on date (a datetime.date), recorded in the history like Gmail would."""
+        ids = self.day(date)
+        with self._lock:
+            sent = datetime(date.year, date.month, date.day, 23, 59, 59, tzinfo=timezone.utc)
+            message_id = f"{date.strftime('%Y%m%d')}{len(ids):05d}new{self.history_id:06d}"
+            self._messages[message_id] = {'id': message_id, 'sender': sender, 'subject': subject,
+                                          'date': sent.strftime('%a, %d %b %Y %H:%M:%S +0000'),
+                                          'internal_date': str(int(sent.timestamp() * 1000)), 'body': body}
+            ids.append(message_id)
+            self.history_id += 1
+            self._history.append((self.history_id, 'added', message_id))
+            return message_id
+
+    def delete_message(self, message_id):
+        with self._lock:
+            message = self._messages.pop(message_id, None)
+            if message is None:
+                return
+            self._trash.pop(message_id, None)
+            for ids in self._days.values():
+                if message_id in ids:
+                    ids.remove(message_id)
+            self.history_id += 1
+            self._history.append((self.history_id, 'deleted', message_id))
+
+    def trash_message(self, message_id):
+        """Move a message to the trash: it stays readable, but is no longer listed."""
+        with self._lock:
+            for date, ids in self._days.items():
+                if message_id in ids:
+                    ids.remove(message_id)
+                    self._trash[message_id] = date
+                    self.history_id += 1
+                    self._history.append((self.history_id, 'trashed', message_id))
+                    return
+
+    def untrash_message(self, message_id):
+        with self._lock:
+            date = self._trash.pop(message_id, None)
+            if date is None:
+                return
+            self._days[date].append(message_id)
+            self.history_id += 1
+            self._history.append((self.history_id, 'untrashed', message_id))
+
+    def changes_since(self, start_history_id):
+        with self._lock:
+            return [(kind, message_id) for hid, kind, message_id in self._history if hid > start_history_id], self.history_id
+
+
+mailbox = _FakeMailbox()
+
+
+def gmail_authenticate():
+    with mailbox._lock:
+        mailbox.authentications += 1
+    time.sleep(mailbox.auth_s)
+    return FakeCredentials()
+
+
+def build_gmail_service(creds):
+    with mailbox._lock:
+        mailbox.builds += 1
+    time.sleep(mailbox.build_s)
+    return FakeGmailService(creds)
+
+
+def generate_gmail_search_query(start_date, end_date):
+    end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+    return f"after:{start_date.replace('-', '/')} before:{end.strftime('%Y/%m/%d')}"
+
+
+def list_message_pages(service, query, page_size=100):
+    '''Every message between the query's after: (inclusive) and before: (exclusive) dates, a list call per page.'''
+    dates = re.findall(r"(\d{4})/(\d{2})/(\d{2})", query)
+    first = datetime(*map(int, dates[0])).date()
+    last = datetime(*map(int, dates[1])).date() if len(dates) > 1 else first + timedelta(days=1)
+    day = first
+    while day < last:
+        ids = mailbox.day(day)
+        for page_start in range(0, len(ids), page_size):
+            mailbox.call(service)
+            yield [{'id': i, 'threadId': i} for i in ids[page_start:page_start + page_size]]
+        day += timedelta(days=1)
+
+
+def fetch_messages(service, query):
+    return [message for page in list_message_pages(service, query) for message in page]
+
+
+def get_message_metadata(service, message_id):
+    mailbox.call(service)
+    message = mailbox.message(message_id)
+    if message is None:
+        raise FakeHttpError(404, "Requested entity was not found.")
+    return {key: message[key] for key in ('id', 'sender', 'subject', 'date', 'internal_date')}
+
+
+def get_message_body(service, message_id):
+    mailbox.call(service)
+    message = mailbox.message(message_id)
+    if message is None:
+        raise FakeHttpError(404, "Requested entity was not found.")
+    return message['body']
+
+
+def get_history_id(service):
+    mailbox.call(service)
+    return str(mailbox.history_id)
+
+
+def list_history_changes(service, start_history_id):
+    mailbox.call(service)
+    changes, latest = mailbox.changes_since(int(start_history_id))
+    added, removed = replay_history((message_id, kind in ('added', 'untrashed')) for kind, message_id in changes)
+    return added, removed, str(latest)
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from handlers.ui_prefix_cache import PrefixRegistrar
+
+
+####################################
+# Local fake chat model
+####################################
+# Streams deterministic text with a configurable time to first token, delay between tokens and failure rate,
+# so the serving stack (threads, SSE, flush policies, caches) can be measured without network calls.
+# Selected with PP_MODEL_BACKEND=fake or --model fake (see ui_model_backends.py). Its knobs:
+#     PP_FAKE_TTFT_MS         delay before the first token (default 300)
+#     PP_FAKE_TOKEN_MS        delay between tokens (default 20)
+#     PP_FAKE_REPLY_TOKENS    tokens per reply (default 200)
+#     PP_FAKE_FAILURE_RATE    fraction of calls that raise part way through the stream (default 0)
+#     PP_FAKE_SEED            seed for the replies and failures (default 0)
+# Call N of a process always produces the same reply and the same failure decision for a given seed.
+# It also honours cached_content from FakeContextCacheRegistrar, and counts the prompt and prefix bytes it
+# was sent, so prefix caching can be checked offline.
+
+_WORDS = """the policy covers damage to your dwelling caused by fire wind hail or theft subject to the deductible
+shown on the declarations page and any exclusions listed in section two of the contract including flood earthquake
+and wear and tear so please review the limits with your agent before making any important decisions""".split()
+
+
+class FakeModelStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.prompt_bytes = 0
+        self.prefix_bytes = 0  # bytes of the first (system/policy) message actually sent
+        self.cached_calls = 0  # calls that named a cached prefix instead of sending it
+
+    def next_call(self) -> int:
+        with self._lock:
+            self.calls += 1
+            return self.calls
+
+    def record(self, prompt_bytes: int, prefix_bytes: int, cached: bool) -> None:
+        with self._lock:
+            self.prompt_bytes += prompt_bytes
+            self.prefix_bytes += prefix_bytes
+            self.cached_calls += cached
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "failures": self.failures,
+                "prompt_bytes": self.prompt_bytes,
+                "prefix_bytes": self.prefix_bytes,
+                "cached_calls": self.cached_calls,
+            }
+
+
+fake_model_stats = FakeModelStats()
+
+_fake_context_caches: Dict[str, str] = {}  # cache name -> prefix text, shared with FakeContextCacheRegistrar
+_fake_context_lock = threading.Lock()
+
+
+class FakeModelError(RuntimeError):
+    pass
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    ttft_ms: float = 300
+    token_ms: float = 20
+    reply_tokens: int = 200
+    failure_rate: float = 0.0
+    seed: int = 0
+    prefill_ms_per_kb: float = 0.0  # extra time to first token per KB of prompt sent, like a real model's prefill
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _plan(self, messages: List[BaseMessage], cached_content: Optional[str]):
+        '''Record what was sent and decide this call's reply.
+        Returns (seconds to first token, tokens, index of the token to fail at or None).'''
+        call = fake_model_stats.next_call()
+        prompt_bytes = sum(len(str(m.content).encode('utf-8')) for m in messages)
+        if cached_content:
+            with _fake_context_lock:
+                if cached_content not in _fake_context_caches:
+                    raise FakeModelError(f"Unknown cached content '{cached_content}'")
+            prefix_bytes = 0
+        else:
+            prefix_bytes = len(str(messages[0].content).encode('utf-8')) if messages else 0
+        fake_model_stats.record(prompt_bytes, prefix_bytes, bool(cached_content))
+
+        last = str(messages[-1].content) if messages else ""
+        rng = random.Random(f"{self.seed}:{call}:{hashlib.sha256(last.encode('utf-8')).hexdigest()}")
+        tokens = [rng.choice(_WORDS) + " " for _ in range(self.reply_tokens)]
+        fail_at = rng.randrange(self.reply_tokens + 1) if rng.random() < self.failure_rate else None
+        ttft_s = (self.ttft_ms + self.prefill_ms_per_kb * prompt_bytes / 1024) / 1000
+        return ttft_s, tokens, fail_at
+
+    def _fail(self):
+        fake_model_stats.record_failure()
+        raise FakeModelError("Fake model failure (PP_FAKE_FAILURE_RATE)")
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        ttft_s, tokens, fail_at = self._plan(messages, kwargs.get("cached_content"))
+        time.sleep(ttft_s)
+        for i, token in enumerate(tokens):
+            if i == fail_at:
+                self._fail()
+            if i:
+                time.sleep(self.token_ms / 1000)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        if fail_at == len(tokens):
+            self._fail()
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        # asyncio.sleep, not time.sleep, so thousands of fake streams can share the event loop
+        ttft_s, tokens, fail_at = self._plan(messages, kwargs.get("cached_content"))
+        await asyncio.sleep(ttft_s)
+        for i, token in enumerate(tokens):
+            if i == fail_at:
+                self._fail()
+            if i:
+                await asyncio.sleep(self.token_ms / 1000)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        if fail_at == len(tokens):
+            self._fail()
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        text = ''.join(str(chunk.message.content) for chunk in self._stream(messages, stop, None, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+class FakeContextCacheRegistrar(PrefixRegistrar):
+    """Context cache for FakeStreamingChatModel: remembers registered prefixes in-process."""
+
+    def __init__(self, ttl_seconds: int = 3600, min_tokens: int = 0):
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+
+    def register(self, prefix_text):
+        name = "cachedContents/fake-" + hashlib.sha256(prefix_text.encode('utf-8')).hexdigest()[:16]
+        with _fake_context_lock:
+            _fake_context_caches[name] = prefix_text
+        return name, time.time() + self.ttl_seconds
+
+    def release(self, handle):
+        with _fake_context_lock:
+            _fake_context_caches.pop(handle, None)
@@ -0,0 +1,247 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, ContextManager, Iterable, Iterator, List, Tuple
+
+from handlers.ui_latency_stats import latency_stats
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Concurrent Gmail metadata fetch
+####################################
+# handle_fetch_emails used to call get_message_metadata once per message in a plain loop, so a busy day of a few
+# hundred messages took a few hundred sequential round trips. Here they are spread over a bounded thread pool.
+# googleapiclient service objects are not thread-safe (each wraps one httplib2 connection), so every request
+# borrows a service of its own from the Gmail client pool (ui_gmail_pool.py). Calls are paced by a shared token
+# bucket to stay under Gmail's per-user quota, and 429/5xx answers are retried with exponential backoff and jitter.
+# Results come back in the order of the message list, so the sorted email list is the same as before.
+#
+#     PP_GMAIL_FETCH_WORKERS   concurrent metadata requests (default 8)
+#     PP_GMAIL_MAX_QPS         most requests started per second (default 40; messages.get costs 5 of the 250
+#                              quota units per user per second; 0 for no limit)
+#     PP_GMAIL_MAX_RETRIES     retries per request for 429 and 5xx answers (default 5)
+# Every request is timed into /api/stats as gmail_metadata_ms (including rate limit waits and retries), and each
+# whole fetch as gmail_fetch_ms.
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    '''Token bucket: at most rate acquisitions per second on average, in bursts of up to burst. A rate of 0 is unlimited.'''
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def http_status(error: Exception):
+    """The HTTP status of a googleapiclient HttpError (or anything shaped like one), else None."""
+    resp = getattr(error, 'resp', None)
+    return getattr(resp, 'status', None) or getattr(error, 'status_code', None)
+
+
+fetch_workers = int(os.getenv('PP_GMAIL_FETCH_WORKERS', '8'))
+max_retries = int(os.getenv('PP_GMAIL_MAX_RETRIES', '5'))
+gmail_rate_limiter = RateLimiter(float(os.getenv('PP_GMAIL_MAX_QPS', '40')))
+_fetch_executor = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='gmail-fetch')
+
+
+def call_with_retries(request: Callable[[], object], limiter: RateLimiter = None, retries: int = None):
+    '''Run one Gmail request under the rate limiter, retrying 429 and 5xx answers with backoff.'''
+    limiter = limiter or gmail_rate_limiter
+    retries = max_retries if retries is None else retries
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            return request()
+        except Exception as e:
+            status = http_status(e)
+            if status not in RETRYABLE_STATUSES or attempt == retries:
+                raise
+            delay = min(8.0, 0.25 * 2 ** attempt) * (0.5 + random.random() / 2)
+            logger.info(f"Gmail request got HTTP {status}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+
+def fetch_metadata_concurrently(message_ids: List[str], client: Callable[[], ContextManager],
+                                get_metadata: Callable[[object, str], dict]) -> List[dict]:
+    '''
+    Fetch metadata for every id, a bounded number at a time.
+
+    Args:
+        message_ids: ids in the order the results should come back in
+        client: gmail_pool.client - lends a Gmail service to the calling thread
+        get_metadata: get_message_metadata(service, message_id)
+
+    Returns:
+        metadata dicts in the same order as message_ids
+    '''
+    started = time.perf_counter()
+
+    def fetch_one(message_id):
+        return _fetch_one(message_id, client, get_metadata)
+
+    if len(message_ids) <= 1:
+        results = [fetch_one(message_id) for message_id in message_ids]
+    else:
+        results = list(_fetch_executor.map(fetch_one, message_ids))  # map keeps input order, re-raises the first error
+    latency_stats.record("gmail_fetch_ms", (time.perf_counter() - started) * 1000)
+    return results
+
+
+def _fetch_one(message_id: str, client: Callable[[], ContextManager], get_metadata: Callable[[object, str], dict]) -> dict:
+    started = time.perf_counter()
+    try:
+        with client() as service:
+            return call_with_retries(lambda: get_metadata(service, message_id))
+    finally:
+        latency_stats.record("gmail_metadata_ms", (time.perf_counter() - started) * 1000)
+
+
+class MetadataStream:
+    '''
+    Metadata fetches queued a page at a time while a listing comes in, collected as they complete (in no particular
+    order), so the first emails can be shown before the listing has finished. Same pool, rate limit and retries as
+    fetch_metadata_concurrently.
+    '''
+
+    def __init__(self, client: Callable[[], ContextManager], get_metadata: Callable[[object, str], dict]):
+        self.client = client
+        self.get_metadata = get_metadata
+        self._pending = []
+        self._started = time.perf_counter()
+
+    def add(self, message_ids: List[str]) -> None:
+        self._pending.extend(_fetch_executor.submit(_fetch_one, message_id, self.client, self.get_metadata)
+                             for message_id in message_ids)
+
+    def completed(self) -> List[dict]:
+        '''Metadata fetched since the last call, without waiting. Re-raises the first failed fetch.'''
+        done = [future for future in self._pending if future.done()]
+        self._pending = [future for future in self._pending if not future.done()]
+        return [future.result() for future in done]
+
+    def remaining(self) -> Iterator[dict]:
+        '''Wait for everything still in flight, yielding each as it completes.'''
+        pending, self._pending = self._pending, []
+        for future in as_completed(pending):
+            yield future.result()
+        latency_stats.record("gmail_fetch_ms", (time.perf_counter() - self._started) * 1000)
+
+
+####################################
+# Message listing, a page at a time
+####################################
+
+def list_message_pages(service, query: str, page_size: int = 100) -> Iterator[List[dict]]:
+    '''Like fetch_messages, but yields each page of users.messages.list as it arrives.'''
+    page_token = None
+    while True:
+        def request():
+            return service.users().messages().list(userId='me', q=query, pageToken=page_token,
+                                                   maxResults=page_size).execute()
+        response = call_with_retries(request)
+        yield response.get('messages', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+
+####################################
+# Gmail history (incremental sync for the email cache)
+####################################
+
+class HistoryExpired(Exception):
+    """Gmail no longer has history back to the requested id (it keeps roughly a week), so a full resync is needed."""
+
+
+def get_history_id(service) -> str:
+    """The mailbox's current history id."""
+    return str(service.users().getProfile(userId='me').execute()['historyId'])
+
+
+# Besides messages added and deleted for good, the history records labels being added and removed. A message moved
+# to the trash or marked as spam is only relabelled, and drops out of the day's listing (messages.list leaves out
+# TRASH and SPAM), so it is treated like a deletion; taking it out of the trash again is treated like a delivery.
+HIDDEN_LABELS = {'TRASH', 'SPAM'}
+
+
+def replay_history(changes: Iterable[Tuple[str, bool]]) -> Tuple[List[str], List[str]]:
+    '''
+    The net effect of a run of history changes, oldest first: (message id, whether it is listed after the change).
+
+    Returns:
+        (ids listed at the end, in the order first seen; ids not listed at the end, sorted)
+    '''
+    listed = {}
+    for message_id, visible in changes:
+        listed[message_id] = visible
+    return [i for i, visible in listed.items() if visible], sorted(i for i, visible in listed.items() if not visible)
+
+
+def _history_changes(record: dict) -> Iterator[Tuple[str, bool]]:
+    for item in record.get('messagesAdded', []):
+        yield item['message']['id'], not HIDDEN_LABELS.intersection(item['message'].get('labelIds', []))
+    for item in record.get('labelsAdded', []):
+        if HIDDEN_LABELS.intersection(item.get('labelIds', [])):
+            yield item['message']['id'], False
+    for item in record.get('labelsRemoved', []):
+        if HIDDEN_LABELS.intersection(item.get('labelIds', [])):
+            # the message's labels after the change: spam taken out of the trash is still spam
+            yield item['message']['id'], not HIDDEN_LABELS.intersection(item['message'].get('labelIds', []))
+    for item in record.get('messagesDeleted', []):
+        yield item['message']['id'], False
+
+
+def list_history_changes(service, start_history_id: str):
+    '''
+    Messages that appeared in and disappeared from the mailbox's listings since start_history_id: delivered or
+    restored from the trash or spam, and deleted or moved to the trash or spam.
+
+    Returns:
+        (added ids, removed ids, history id the changes run up to). Only the latest change to a message counts.
+    '''
+    changes = []
+    latest = start_history_id
+    page_token = None
+    while True:
+        def request():
+            return service.users().history().list(
+                userId='me', startHistoryId=start_history_id, pageToken=page_token,
+                historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']).execute()
+        try:
+            response = call_with_retries(request)
+        except Exception as e:
+            if http_status(e) == 404:
+                raise HistoryExpired(str(e)) from e
+            raise
+        for record in response.get('history', []):
+            changes.extend(_history_changes(record))
+        latest = str(response.get('historyId', latest))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    added, removed = replay_history(changes)
+    return added, removed, latest
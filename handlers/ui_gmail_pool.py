@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+from handlers.ui_latency_stats import latency_stats
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Gmail client pool
+####################################
+# Every fetch used to run gmail_authenticate() (load token.json, check or refresh the token) and
+# build("gmail", "v1", ...) (construct the API surface from the discovery document) before asking Gmail anything.
+# The pool keeps one set of credentials per account for the life of the process, refreshing them only once they
+# have expired, and keeps the built service objects for reuse. googleapiclient services aren't thread-safe,
+# so a service is lent to one thread at a time: client() hands out an idle one or builds another.
+# The real backend builds services from the discovery document bundled with google-api-python-client
+# (static_discovery=True), so no build ever downloads it.
+#
+# Stage timings go to /api/stats: gmail_auth_ms, gmail_refresh_ms and gmail_build_ms are only recorded when that
+# work actually happens, next to gmail_list_ms, gmail_history_ms and gmail_fetch_ms for the queries themselves.
+
+
+def _refresh_google_credentials(creds) -> None:
+    from google.auth.transport.requests import Request
+    creds.refresh(Request())
+
+
+class _AccountClients:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.credentials = None
+        self.authenticated = False  # credentials can be None once authenticated (mailbox files need none)
+        self.idle: List[object] = []
+
+
+class GmailClientPool:
+
+    def __init__(self, max_idle: int = 16):
+        self.max_idle = max_idle
+        self.authenticate: Callable[[], object] = None        # gmail_authenticate
+        self.build_service: Callable[[object], object] = None  # build_gmail_service(credentials)
+        self.refresh: Callable[[object], None] = _refresh_google_credentials
+        self._accounts: Dict[str, _AccountClients] = {}
+        self._lock = threading.Lock()
+        self.authentications = 0
+        self.refreshes = 0
+        self.builds = 0
+        self.reuses = 0
+
+    def configure(self, authenticate: Callable[[], object], build_service: Callable[[object], object],
+                  refresh: Callable[[object], None] = None) -> None:
+        """Set the Gmail backend functions (real or fake); drops anything built with the previous ones."""
+        with self._lock:
+            self.authenticate = authenticate
+            self.build_service = build_service
+            self.refresh = refresh or _refresh_google_credentials
+            self._accounts.clear()
+
+    def _account(self, account: str) -> _AccountClients:
+        with self._lock:
+            clients = self._accounts.get(account)
+            if clients is None:
+                clients = self._accounts[account] = _AccountClients()
+            return clients
+
+    def credentials(self, account: str = 'default'):
+        '''The account's credentials, authenticating the first time and refreshing only once they have expired.'''
+        clients = self._account(account)
+        with clients.lock:
+            creds = clients.credentials
+            if clients.authenticated and (creds is None or getattr(creds, 'valid', True)):
+                return creds
+            if creds is not None and getattr(creds, 'refresh_token', None):
+                started = time.perf_counter()
+                try:
+                    self.refresh(creds)  # in place, so services already built keep working
+                    self.refreshes += 1
+                    latency_stats.record("gmail_refresh_ms", (time.perf_counter() - started) * 1000)
+                    return creds
+                except Exception as e:
+                    logger.warning(f"Gmail token refresh failed, authenticating again: {e}")
+            started = time.perf_counter()
+            clients.credentials = self.authenticate()
+            clients.authenticated = True
+            clients.idle.clear()  # built on the old credentials
+            self.authentications += 1
+            latency_stats.record("gmail_auth_ms", (time.perf_counter() - started) * 1000)
+            return clients.credentials
+
+    @contextmanager
+    def client(self, account: str = 'default'):
+        '''Lend a Gmail service to the calling thread for the duration of the with block.'''
+        creds = self.credentials(account)
+        clients = self._account(account)
+        with clients.lock:
+            service = clients.idle.pop() if clients.idle else None
+            if service is not None:
+                self.reuses += 1
+        if service is None:
+            started = time.perf_counter()
+            service = self.build_service(creds)
+            latency_stats.record("gmail_build_ms", (time.perf_counter() - started) * 1000)
+            with clients.lock:
+                self.builds += 1
+        try:
+            yield service
+        finally:
+            with clients.lock:
+                if clients.credentials is creds and len(clients.idle) < self.max_idle:
+                    clients.idle.append(service)
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = sum(len(clients.idle) for clients in self._accounts.values())
+        return {
+            "authentications": self.authentications,
+            "refreshes": self.refreshes,
+            "services_built": self.builds,
+            "services_reused": self.reuses,
+            "idle_services": idle,
+        }
+
+
+gmail_pool = GmailClientPool()
@@ -2,7 +2,10 @@ import sys
 import os
 # import psutil  # Commented out - only used for debugging utilities we don't need
 import time
+import threading
 import logging
+import asyncio
+from datetime import datetime
 
 # Add path to Multi_Agent_Email_tool for email fetching functions
 # Go up from handlers/ to Prompt_Playground/, then up to All_Coding_Projects/, then into Multi_Agent_Email_tool/
@@ -13,9 +16,30 @@ sys.path.insert(0, email_tool_path)
 from persistent_data.ui_session_data_mgmt import *
 from typing import Optional, Tuple, List
 from server_data.ui_server_side_data import *
-
-# Commented out - PDF processing not needed for prompt playground
-# from pdf_processor_service.pdf_processor import *
+from handlers.ui_stream_flush import coalesce, acoalesce
+from handlers.ui_conversation_memory import SessionConversationMemory, TokenBudgetMemory
+from handlers.ui_text_cache import extracted_text_cache
+from handlers.ui_policy_retrieval import (select_policy_content, question_from_query, chunk_policy_text,
+                                         policy_index_cache, SECTION_TARGET_CHARS)
+from handlers.ui_latency_stats import latency_stats
+from handlers.ui_prefix_cache import prefix_cache
+from handlers.ui_model_backends import create_model, create_prefix_registrar, get_model_backend
+from handlers.ui_gmail_fetch import fetch_metadata_concurrently, call_with_retries, HistoryExpired, MetadataStream
+from handlers.ui_gmail_pool import gmail_pool
+from handlers.ui_email_context import email_context, long_email_concurrency, EmailTurn, NOTHING_RELEVANT
+from handlers.ui_job_extraction import job_extractor, format_jobs
+from handlers.ui_email_search import email_search
+from handlers.ui_pdf_extraction import (pdf_extraction_queue, extraction_progress_seconds, provisional_after_seconds,
+                                        EXTRACTION_PRIORITY_QUERY,
+                                        EXTRACTION_PRIORITY_SELECTION, EXTRACTION_PRIORITY_FOCUS)
+from handlers.ui_policy_warmup import policy_warmup
+from handlers.ui_async_stream import SSEEvent
+from persistent_data.ui_email_cache import email_cache
+from persistent_data.ui_text_store import text_store
+from handlers.ui_email_prefetch import (body_prefetcher, prefetch_top_k, prefetch_neighbours,
+                                        PRIORITY_LIST, PRIORITY_SELECTION)
+
+# PDFProcessingService is imported by the extraction worker processes only (see ui_pdf_extraction.py)
 
 # Import email fetching functions from Multi_Agent_Email_tool
 # TODO [Future Enhancement]: Extract shared Gmail functions into a separate gmail-utils library
@@ -25,26 +49,46 @@ from server_data.ui_server_side_data import *
 #       - Separate credentials management per project
 #       - Shared core functions: authenticate_user(), get_message_metadata(), get_message_body()
 # TODO [Update]: Change import from V0.4.py to email_objects.py once that module is finalized
-try:
-    # Read and extract only the function definitions from V0.4.py
-    # Skip module-level code that causes errors
-    v0_4_path = os.path.join(email_tool_path, "V0.4.py")
-    with open(v0_4_path, 'r') as f:
-        lines = f.readlines()
-
-    # Find line 79 where authenticate_user starts (first function we need)
-    # Skip everything before that to avoid module-level instantiation errors
-    start_line = 0
-    for i, line in enumerate(lines):
-        if line.strip().startswith('def authenticate_user'):
-            start_line = i
-            break
-
-    # Execute only from line 79 onwards
-    v0_4_source = ''.join(lines[start_line:])
-
-    # Need to add necessary imports back
-    v0_4_imports = """
+# PP_EMAIL_SOURCE picks where emails come from. These functions are the email source interface: every source
+# provides the same set, and handle_fetch_emails / handle_select_email only go through them.
+#     gmail           the Gmail API, with the functions from V0.4.py below (default)
+#     fake            local deterministic stand-ins (ui_fake_gmail.py), for offline runs and benchmarks
+#     mbox, maildir   a local archive at PP_MAILBOX_PATH, indexed once (ui_mailbox_source.py)
+# PP_GMAIL_BACKEND is the older name of the same setting.
+email_source = (os.getenv('PP_EMAIL_SOURCE') or os.getenv('PP_GMAIL_BACKEND', 'gmail')).strip().lower()
+if email_source == 'fake':
+    from handlers.ui_fake_gmail import (gmail_authenticate, build_gmail_service, fetch_messages,
+                                        get_message_metadata, get_message_body, generate_gmail_search_query,
+                                        get_history_id, list_history_changes, list_message_pages)
+    GMAIL_AVAILABLE = True
+elif email_source in ('mbox', 'maildir'):
+    from handlers.ui_mailbox_source import (gmail_authenticate, build_gmail_service, fetch_messages,
+                                            get_message_metadata, get_message_body, generate_gmail_search_query,
+                                            get_history_id, list_history_changes, list_message_pages)
+    from handlers.ui_gmail_fetch import gmail_rate_limiter
+    gmail_rate_limiter.rate = 0  # a local archive has no quota
+    GMAIL_AVAILABLE = True
+else:
+    try:
+        # Read and extract only the function definitions from V0.4.py
+        # Skip module-level code that causes errors
+        v0_4_path = os.path.join(email_tool_path, "V0.4.py")
+        with open(v0_4_path, 'r') as f:
+            lines = f.readlines()
+
+        # Find line 79 where authenticate_user starts (first function we need)
+        # Skip everything before that to avoid module-level instantiation errors
+        start_line = 0
+        for i, line in enumerate(lines):
+            if line.strip().startswith('def authenticate_user'):
+                start_line = i
+                break
+
+        # Execute only from line 79 onwards
+        v0_4_source = ''.join(lines[start_line:])
+
+        # Need to add necessary imports back
+        v0_4_imports = """
 import os.path
 from datetime import datetime, timedelta
 from google.auth.transport.requests import Request
@@ -56,27 +100,37 @@ from googleapiclient.errors import HttpError
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 """
 
-    v0_4_namespace = {}
-    exec(v0_4_imports + v0_4_source, v0_4_namespace)
+        v0_4_namespace = {}
+        exec(v0_4_imports + v0_4_source, v0_4_namespace)
 
-    # Extract the functions we need
-    gmail_authenticate = v0_4_namespace.get('authenticate_user')
-    fetch_messages = v0_4_namespace.get('fetch_messages')
-    get_message_metadata = v0_4_namespace.get('get_message_metadata')
-    get_message_body = v0_4_namespace.get('get_message_body')
-    generate_gmail_search_query = v0_4_namespace.get('generate_gmail_search_query')
+        # Extract the functions we need
+        gmail_authenticate = v0_4_namespace.get('authenticate_user')
+        fetch_messages = v0_4_namespace.get('fetch_messages')
+        get_message_metadata = v0_4_namespace.get('get_message_metadata')
+        get_message_body = v0_4_namespace.get('get_message_body')
+        generate_gmail_search_query = v0_4_namespace.get('generate_gmail_search_query')
 
-    # Verify we got all the functions
-    if not all([gmail_authenticate, fetch_messages, get_message_metadata, get_message_body, generate_gmail_search_query]):
-        raise ImportError("Failed to extract required functions from V0.4.py")
+        # Verify we got all the functions
+        if not all([gmail_authenticate, fetch_messages, get_message_metadata, get_message_body, generate_gmail_search_query]):
+            raise ImportError("Failed to extract required functions from V0.4.py")
 
-    from googleapiclient.discovery import build
-    from google.oauth2.credentials import Credentials
-    GMAIL_AVAILABLE = True
-    print("Gmail functions loaded successfully")
-except Exception as e:
-    print(f"Warning: Could not import Gmail functions: {e}")
-    GMAIL_AVAILABLE = False
+        from googleapiclient.discovery import build
+        from google.oauth2.credentials import Credentials
+
+        def build_gmail_service(creds):
+            # The discovery document bundled with google-api-python-client, never downloaded
+            return build("gmail", "v1", credentials=creds, static_discovery=True, cache_discovery=False)
+
+        from handlers.ui_gmail_fetch import get_history_id, list_history_changes, list_message_pages
+
+        GMAIL_AVAILABLE = True
+        print("Gmail functions loaded successfully")
+    except Exception as e:
+        print(f"Warning: Could not import Gmail functions: {e}")
+        GMAIL_AVAILABLE = False
+
+if GMAIL_AVAILABLE:
+    gmail_pool.configure(gmail_authenticate, build_gmail_service)
 
 import langchain
 
@@ -96,10 +150,10 @@ from langchain.globals import set_debug
 #################################
 # For Gemini, use the following:
 #################################
-from langchain_google_genai import ChatGoogleGenerativeAI
+# from langchain_google_genai import ChatGoogleGenerativeAI  # now imported by the gemini backend (ui_model_backends.py)
 
 from langchain.memory import ConversationBufferMemory
-from langchain_core.runnables import RunnableWithMessageHistory
+from langchain_core.runnables import RunnableWithMessageHistory, RunnableLambda
 from langchain.schema import HumanMessage, AIMessage
 
 # import pdfplumber  # Commented out - PDF processing not needed
@@ -123,7 +177,7 @@ import logging
 # logging.getLogger('google').setLevel(logging.WARNING)    # If using Google/Gemini
 
 # # Create our conversation-specific debug logger
-# conversation_logger = logging.getLogger(__name__)
+conversation_logger = logging.getLogger(__name__) # used by the chat stream handlers to report model errors
 # conversation_logger.setLevel(logging.DEBUG)
 
 
@@ -196,8 +250,17 @@ policy_instructions = ""
 policy_extracted_content = ""
 
 # Set up the memory
-memory = ConversationBufferMemory(return_messages=True) #ConversationBuffer
-'''ConversationBufferMemory is a Langchain class that automajically stores the conversation history as a buffer. It labels which strings belong to "HumanMessage" (user) input and which belong to "AIMessage" (bot) output. return_messages=True configures the memory to return the history as a list of messages, which is compatible with chat models.'''
+# Each session gets its own memory (stored on its SessionData by handle_focus), so users never see each other's history
+# PP_MEMORY_MODE=buffer (default) keeps and sends the whole conversation; PP_MEMORY_MODE=budget sends at most
+# PP_MEMORY_TOKEN_BUDGET tokens of history per turn, summarizing older turns in the background (TokenBudgetMemory).
+memory_mode = os.getenv('PP_MEMORY_MODE', 'buffer').strip().lower()
+memory_token_budget = int(os.getenv('PP_MEMORY_TOKEN_BUDGET', '4000'))
+
+def create_session_memory() -> SessionConversationMemory:
+    if memory_mode == 'budget':
+        return TokenBudgetMemory(memory_token_budget, summarize_conversation)
+    return SessionConversationMemory()
+'''SessionConversationMemory wraps a ConversationBufferMemory, a Langchain class that automajically stores the conversation history as a buffer. It labels which strings belong to "HumanMessage" (user) input and which belong to "AIMessage" (bot) output. The wrapper also keeps the history already formatted for Gemini (see format_history_for_gemini), updated as each turn is saved, so a turn never has to rebuild it.'''
 
 
 
@@ -220,14 +283,16 @@ memory = ConversationBufferMemory(return_messages=True) #ConversationBuffer
 #       Options to consider:
 #       - UI dropdown to select model (gemini-2.5-pro, gemini-2.5-flash, gemini-2.5-flash-lite)
 #       - YAML config file with model selection
-#       - Environment variable override
 #       Once optimal model is determined, pin to specific version (e.g., gemini-2.5-pro-001)
-model = ChatGoogleGenerativeAI(
-    model="gemini-2.5-pro",
-    temperature=0.7,
-    convert_messages_to_prompt=False, # We are managing the convo history ourselves
-    streaming=True
-)
+# The model now comes from a named backend (ui_model_backends.py): PP_MODEL_BACKEND=gemini (default) builds
+# ChatGoogleGenerativeAI(model=$PP_GEMINI_MODEL or "gemini-2.5-pro", temperature=0.7, streaming=True);
+# PP_MODEL_BACKEND=fake builds the local fake streaming model used for offline measurements.
+# The model is built on first use (current_model), not at import: the --model server option is applied after this
+# module is imported, and building the Gemini client needs Google credentials that an offline run doesn't have.
+model_backend = os.getenv('PP_MODEL_BACKEND', 'gemini').strip().lower()
+model = None
+chain = None
+_model_lock = threading.Lock()
 
 #################################
 # For OpenAI, use the following:
@@ -248,9 +313,13 @@ model = ChatGoogleGenerativeAI(
 #################################
 # Create the prompt template
 # But we need to modify how we structure the prompt and chain to keep system/policy content separate
+# The first message (system content and instructions) is the stable prompt prefix: it only changes when the policy
+# selection does, so it is kept out of the per-turn template and prepared once by prefix_cache (ui_prefix_cache.py).
+prefix_template = "System Instructions:\n{system_template}\n\nPolicy Instructions:\n{policy_instructions}\n\nPolicy Content:\n{policy_content}"
+
 prompt = ChatPromptTemplate.from_messages([
-    # First message combines system content and instructions
-    ("human", "System Instructions:\n{system_template}\n\nPolicy Instructions:\n{policy_instructions}\n\nPolicy Content:\n{policy_content}"),
+    # First, the prepared prefix message - left out when the provider already holds it in its context cache
+    MessagesPlaceholder(variable_name="prefix"),
     # Then include conversation history
     MessagesPlaceholder(variable_name="history"),
     # Finally, the current user query
@@ -273,22 +342,93 @@ prompt = ChatPromptTemplate.from_messages([
 
 # Create the runnable chain
 # Modified chain to separate system prompt, policy instructions & content
+# The chain holds no conversation state: each call is handed the calling session's history in x["history"],
+# already formatted for Gemini, so one chain is shared by every session.
 def create_chain():
     """Create a new chain with current global settings."""
-    return (
+    turn_chain = (
         {
-            "system_template": lambda x: system_message,  # Constant system message
-            "policy_instructions": lambda x: x["policy_instructions"],
-            "policy_content": lambda x: x["policy_content"],
+            "prefix": lambda x: [] if x["cached_content"] else [x["prefix_message"]],
             "input": lambda x: x["input"],
-            "history": lambda x: format_history_for_gemini(memory.load_memory_variables({})["history"])
+            "history": lambda x: x["history"]  # session_state.memory.history_messages(), formatted incrementally
         }
         | prompt
-        | model
     )
 
-# Initial chain creation
-chain = create_chain()
+    def route_to_model(x):
+        # When the provider holds the prefix, name its cache entry instead of sending the prefix again
+        turn_model = current_model()
+        if x["cached_content"]:
+            return turn_chain | turn_model.bind(cached_content=x["cached_content"])
+        return turn_chain | turn_model
+
+    return RunnableLambda(route_to_model)
+
+
+def current_model():
+    '''The model of the current backend, built on first use.'''
+    global model, chain
+    if model is None:
+        with _model_lock:
+            if model is None:
+                built = create_model(model_backend)
+                prefix_cache.registrar = create_prefix_registrar(model_backend, built)
+                chain = create_chain()
+                model = built
+    return model
+
+
+def current_chain():
+    current_model()
+    return chain
+
+
+def set_model_backend(name: str) -> None:
+    '''Switch every session to another model backend (used by the --model server option).
+    Turns already streaming keep the model they started with. The new model is built on first use.'''
+    global model_backend, model, chain
+    get_model_backend(name)  # raises ValueError for an unknown name before anything changes
+    with _model_lock:
+        model_backend = name
+        model = None
+        chain = None
+        prefix_cache.registrar = None
+
+
+def run_extraction_batch(prompts: List[str], max_concurrency: int) -> list:
+    '''Job extraction calls (ui_job_extraction.py), on whichever model is current.'''
+    return current_model().batch(prompts, config={"max_concurrency": max_concurrency}, return_exceptions=True)
+
+
+def load_email_for_extraction(message_id: str):
+    body = email_cache.get_body(message_id, count=False)
+    if body is None:
+        return None
+    return email_cache.metadata_for([message_id]).get(message_id, {}), body
+
+
+job_extractor.configure(run_extraction_batch, load_email_for_extraction, email_cache.has_jobs, email_cache.put_jobs)
+email_search.configure(email_cache.iter_messages)
+
+
+summary_template = """Update the running summary of a conversation between a user and an AI assistant that helps with emails and job listings.
+Fold the new messages into the earlier summary. Keep every fact the assistant may need later: names, employers, job titles, locations, remote/hybrid/onsite status, dates, numbers and open questions. Write plain prose of at most {max_words} words.
+
+Earlier summary:
+{summary}
+
+New messages:
+{messages}"""
+
+def summarize_conversation(previous_summary: str, messages: List, max_tokens: int) -> str:
+    '''Summarizer for TokenBudgetMemory. Runs on the memory's background thread, never while the user waits.'''
+    transcript = "\n\n".join(
+        f"{'User' if isinstance(msg, HumanMessage) else 'Assistant'}: {msg.content}" for msg in messages)
+    response = current_model().invoke(summary_template.format(
+        max_words=max(50, int(max_tokens * 0.75)),
+        summary=previous_summary or "(none)",
+        messages=transcript))
+    return str(response.content).strip()
 
 
 ####################################
@@ -346,6 +486,8 @@ def handle_focus(session_state: SessionData,
 """
     session_state.user_id = user_id
     session_state.session_id = session_id
+    if session_state.memory is None:
+        session_state.memory = create_session_memory() # per-session conversation history
     # the following is only executed the fist time the Chatbot receives focus or when the session is restarted by the tester
     if session_state.get_is_initialized() == False:
         session_state.selected_policy = "None"
@@ -362,6 +504,13 @@ def handle_focus(session_state: SessionData,
     
     transfer_server_data_for_current_user(session_state, server_users) 
 
+    # Get every policy ready in the background before it is asked about (see ui_policy_warmup.py)
+    for policy in session_state.policy_list:
+        try:
+            warm_up_policy(policy, EXTRACTION_PRIORITY_FOCUS)
+        except OSError as e:
+            conversation_logger.warning(f"Can't warm up {policy.print_name}: {e}")
+
 
 
 
@@ -395,6 +544,11 @@ def get_policy_file_info(session_state: SessionData,
     session_state.policy_list=[] # initialize as empty list
     
     for policy in server_user.policies:  # Number of policies uploaded can be 0 
+        if not policy.is_extracted:
+            try:
+                use_stored_text(policy) # recorded on the server's copy, so later sessions and other owners find it
+            except OSError as e:
+                conversation_logger.warning(f"Can't look up the text of {policy.print_name}: {e}")
         sesh_policy = Policy() # create a fresh Policy instance
         sesh_policy.file_id = policy.file_id # Unique identifier for the policy file
         sesh_policy.path = policy.path # URL or file path
@@ -418,72 +572,393 @@ def get_policy_file_info(session_state: SessionData,
 ####################################
 # Query Handler
 ####################################
-def handle_query(user_input: str, session_state: SessionData, user_id: str) -> None:
+def handle_query(user_input: str, session_state: SessionData, user_id: str,
+                 email_index: Optional[int] = None, email_id: Optional[str] = None) -> None:
+    '''Stream the answer to user_input. email_index/email_id refer to one of the session's fetched emails the
+    question is about: its context is added here from the body the server holds (see ui_email_context.py).'''
+    started = time.perf_counter()
+    # A policy that isn't extracted yet is extracted in the background; say so while the question waits on it
+    job = selected_policy_extraction(session_state)
+    record_first_policy_query(session_state, job)
+    turn = None
+    provisional = False
+    if job is not None:
+        if not job.finished:
+            yield SSEEvent("extracting", job.to_dict())
+            while not pdf_extraction_queue.wait(job, extraction_progress_seconds):
+                yield SSEEvent("extracting", job.to_dict())
+                # A page-streaming extraction that is taking a while: answer from the pages read so far meanwhile
+                if not provisional and provisional_answer_due(job, started):
+                    provisional = True
+                    try:
+                        if turn is None:
+                            turn = email_turn(session_state, user_input, email_index, email_id)
+                    except Exception as e:  # the answer from the whole policy tries again, and reports it
+                        conversation_logger.error(f"Error in provisional answer: {str(e)}", exc_info=True)
+                    else:
+                        yield from provisional_answer(turn, session_state, job, started)
+            yield SSEEvent("extracting", job.to_dict())
+        if not finish_policy_extraction(session_state, job):
+            yield f"I couldn't read the selected policy document ({job.error}). Please try again later."
+            yield "DONE"
+            return
+        if provisional:
+            yield SSEEvent("final", job.to_dict())  # the answer from the whole policy follows
+
+    full_response_chunks = []  # Use list instead of string concatenation, IMPORTANT! Strings cause very long lag
+    query_inputs = None
+
+    def response_text():
+        # Streaming chunks of the response
+        for chunk in current_chain().stream(query_inputs):
+            # This line is used to extract the content of the chunk, which could either be directly an attribute of chunk itself (chunk.content), or it could be nested within another attribute (chunk.message.content). The goal is to safely access these fields without throwing an error if they don't exist.
+            content = getattr(chunk, 'content', None) or getattr(chunk.message, 'content', None)
+            if content:
+                if not full_response_chunks:
+                    record_turn_latency("ttft_ms", query_inputs, started)
+                full_response_chunks.append(content)
+                yield content
+
+    try:
+        if turn is None:
+            turn = email_turn(session_state, user_input, email_index, email_id)
+        query_inputs = prepare_query_inputs(turn.model_input, session_state)
+        query_inputs["email_mode"] = turn.mode
+
+        # Chunks are coalesced into SSE events by the deployment's flush policy (see ui_stream_flush.py)
+        for send_chunk in coalesce(response_text()):
+            yield send_chunk
+
+        record_turn_latency("response_ms", query_inputs, started)
+        save_query_turn(session_state, turn.memory_input, full_response_chunks)
+
+        
+    except Exception as e:
+        conversation_logger.error(f"Error in chat stream: {str(e)}", exc_info=True)
+        yield "I apologize, but I encountered an error. Please try again."
+
+    yield "DONE"
 
+
+async def ahandle_query(user_input: str, session_state: SessionData, user_id: str,
+                        email_index: Optional[int] = None, email_id: Optional[str] = None):
+    '''Async version of handle_query, streaming with chain.astream. Used by the asyncio SSE path (ui_async_stream.py):
+    cancelling the task that iterates this generator cancels the upstream model call, and the turn is not saved to memory,
+    just as when the sync generator is closed by a dropped connection.
+    '''
+    started = time.perf_counter()
+    job = await asyncio.to_thread(selected_policy_extraction, session_state)
+    record_first_policy_query(session_state, job)
+    turn = None
+    provisional = False
+    if job is not None:
+        if not job.finished:
+            yield SSEEvent("extracting", job.to_dict())
+            while not await asyncio.to_thread(pdf_extraction_queue.wait, job, extraction_progress_seconds):
+                yield SSEEvent("extracting", job.to_dict())
+                if not provisional and provisional_answer_due(job, started):
+                    provisional = True
+                    try:
+                        if turn is None:
+                            turn = await aemail_turn(session_state, user_input, email_index, email_id)
+                    except Exception as e:
+                        conversation_logger.error(f"Error in provisional answer: {str(e)}", exc_info=True)
+                    else:
+                        answer = aprovisional_answer(turn, session_state, job, started)
+                        try:
+                            async for item in answer:
+                                yield item
+                        finally:
+                            await answer.aclose()
+            yield SSEEvent("extracting", job.to_dict())
+        if not finish_policy_extraction(session_state, job):
+            yield f"I couldn't read the selected policy document ({job.error}). Please try again later."
+            yield "DONE"
+            return
+        if provisional:
+            yield SSEEvent("final", job.to_dict())
+
+    full_response_chunks = []
+    query_inputs = None
+
+    async def response_text():
+        async for chunk in current_chain().astream(query_inputs):
+            content = getattr(chunk, 'content', None) or getattr(chunk.message, 'content', None)
+            if content:
+                if not full_response_chunks:
+                    record_turn_latency("ttft_ms", query_inputs, started)
+                full_response_chunks.append(content)
+                yield content
+
+    send_chunks = acoalesce(response_text())
+    try:
+        # Reading the policy file and the email body is blocking I/O, keep it off the event loop
+        if turn is None:
+            turn = await aemail_turn(session_state, user_input, email_index, email_id)
+        query_inputs = await asyncio.to_thread(prepare_query_inputs, turn.model_input, session_state)
+        query_inputs["email_mode"] = turn.mode
+
+        async for send_chunk in send_chunks:
+            yield send_chunk
+
+        record_turn_latency("response_ms", query_inputs, started)
+        save_query_turn(session_state, turn.memory_input, full_response_chunks)
+
+    except Exception as e: # asyncio.CancelledError is not an Exception, so cancellation passes straight through
+        conversation_logger.error(f"Error in chat stream: {str(e)}", exc_info=True)
+        yield "I apologize, but I encountered an error. Please try again."
+    finally:
+        await send_chunks.aclose()
+
+    yield "DONE"
+
+
+def prepare_query_inputs(user_input: str, session_state: SessionData,
+                         provisional: Optional[Tuple[str, int]] = None) -> dict:
+    '''Build the chain input for one turn: the user's query, the prompt prefix (system message plus the selected policy's instructions and text, if any), and the session's history.
+    For long policies only the sections relevant to the question are sent (see ui_policy_retrieval.py).
+    The prefix comes from prefix_cache, so an unchanged prefix is not rebuilt, and is not re-sent at all once the provider caches it.
+    provisional is (text, pages) of a policy still being extracted, for an answer from the pages read so far.'''
     policy_instructions = ""
     policy_content = ""
+    policy_context_mode = "none"
+    history = session_state.memory.history_messages() # one snapshot per turn, already deduplicated
 
     # First check if there are any policies uploaded or selected
     if(policy_is_selected(session_state)):
         index = session_state.selected_policy_index
         policy = session_state.policy_list[index] 
 
-        if (not (policy.is_extracted)):
-            process_pdf_file(policy, session_state)
-            
-        policy_content = read_from_extracted_file(policy.extracted_file_path) 
+        if provisional is not None:
+            text, pages = provisional
+            policy_content, _ = select_policy_content(None, text, question_from_query(user_input),
+                                                      previous_user_question(history), cache=False)
+            policy_content = (f"[Only the first {pages} pages of this policy have been read so far. If the answer "
+                              f"may depend on the rest of it, say so.]\n\n{policy_content}")
+            policy_context_mode = "provisional"
+        else:
+            if (not (policy.is_extracted)):
+                process_pdf_file(policy, session_state)
+
+            policy_text = read_from_extracted_file(policy.extracted_file_path) 
+            policy_content, policy_context_mode = select_policy_content(
+                policy.extracted_file_path, policy_text,
+                question_from_query(user_input), previous_user_question(history))
         policy_instructions = saved_policy_instructions
+
+    current_model()  # the prefix cache registers with the model's provider, so the model must exist by now
+    if provisional is not None:
+        # Kept out of prefix_cache: the session's next prefix has the whole policy in it
+        prefix_message, cached_content = HumanMessage(content=prefix_template.format(
+            system_template=system_message, policy_instructions=policy_instructions, policy_content=policy_content)), None
+    else:
+        prefix_message, cached_content = prefix_cache.prepare(
+            session_state.session_id, prefix_template,
+            system_template=system_message, policy_instructions=policy_instructions, policy_content=policy_content)
     
-    history = memory.load_memory_variables({})["history"]
+    return {
+        "input": user_input,
+        "prefix_message": prefix_message,
+        "cached_content": cached_content, # provider context cache name, or None to send prefix_message
+        "history": history,
+        "policy_context_mode": policy_context_mode # not used by the prompt, only to label latency stats
+    }
 
-    buffer_chunks = []  # Use list instead of string concatenation, IMPORTANT! Strings cause very long lag
-    full_response_chunks = []  # Use list instead of string concatenation, IMPORTANT! Strings cause very long lag
 
-    try:
-        # Streaming chunks of the response
-        for chunk in chain.stream({
-            "input": user_input,
-            "policy_instructions": policy_instructions,
-            "policy_content": policy_content,
-            "history": memory.load_memory_variables({})["history"]
-        }):
+def provisional_answer_due(job, started: float) -> bool:
+    '''Whether a question waiting on job has waited long enough to be answered from the pages extracted so far.'''
+    return (provisional_after_seconds >= 0 and job.page_table is not None
+            and time.perf_counter() - started >= provisional_after_seconds and job.pages_done() > 0)
 
-            
-            # This line is used to extract the content of the chunk, which could either be directly an attribute of chunk itself (chunk.content), or it could be nested within another attribute (chunk.message.content). The goal is to safely access these fields without throwing an error if they don't exist.
+
+def provisional_policy_text(job) -> Optional[Tuple[str, int]]:
+    table = job.page_table
+    if table is None:  # finished meanwhile
+        return None
+    pages = table.refresh()
+    return table.text(), pages
+
+
+def provisional_answer(turn: EmailTurn, session_state: SessionData, job, started: float):
+    '''Stream an answer from the pages of the selected policy extracted so far, after a "provisional" event. It isn't
+    saved to the conversation memory: the answer from the whole policy that follows is.'''
+    provisional = provisional_policy_text(job)
+    if provisional is None:
+        return
+    yield SSEEvent("provisional", {"job_id": job.job_id, "pages": provisional[1]})
+    query_inputs = prepare_query_inputs(turn.model_input, session_state, provisional)
+    query_inputs["email_mode"] = turn.mode
+    chunks = []
+
+    def response_text():
+        for chunk in current_chain().stream(query_inputs):
             content = getattr(chunk, 'content', None) or getattr(chunk.message, 'content', None)
-            
             if content:
-                buffer_chunks.append(content)
-                full_response_chunks.append(content)
+                if not chunks:
+                    record_turn_latency("ttft_ms", query_inputs, started)
+                chunks.append(content)
+                yield content
 
-                # Send buffer in chunks of 50 characters
-                buffer = ''.join(buffer_chunks)
-                while len(buffer) >= 50:
-                    send_chunk = buffer[:50]
-                    buffer = buffer[50:]
-                    buffer_chunks = [buffer]  # Reset buffer_chunks with remaining content
-                    send_chunk = send_chunk.replace('\n', '\\n')
-                    yield send_chunk
+    try:
+        for send_chunk in coalesce(response_text()):
+            yield send_chunk
+    except Exception as e:
+        conversation_logger.error(f"Error in provisional answer: {str(e)}", exc_info=True)
 
-        # Handle any remaining buffer content
-        if buffer_chunks:
-            final_buffer = ''.join(buffer_chunks).replace('\n', '\\n')
-            yield final_buffer
 
-        # Join full response chunks only once at the end
-        full_response = ''.join(full_response_chunks)
+async def aprovisional_answer(turn: EmailTurn, session_state: SessionData, job, started: float):
+    '''Async version of provisional_answer.'''
+    provisional = await asyncio.to_thread(provisional_policy_text, job)
+    if provisional is None:
+        return
+    yield SSEEvent("provisional", {"job_id": job.job_id, "pages": provisional[1]})
+    query_inputs = await asyncio.to_thread(prepare_query_inputs, turn.model_input, session_state, provisional)
+    query_inputs["email_mode"] = turn.mode
+    chunks = []
 
-        if not full_response:
-            full_response = "I apologize, but I encountered an error processing your request. Please try again."
+    async def response_text():
+        async for chunk in current_chain().astream(query_inputs):
+            content = getattr(chunk, 'content', None) or getattr(chunk.message, 'content', None)
+            if content:
+                if not chunks:
+                    record_turn_latency("ttft_ms", query_inputs, started)
+                chunks.append(content)
+                yield content
 
-        memory.save_context({"input": user_input}, {"output": full_response})
+    send_chunks = acoalesce(response_text())
+    try:
+        async for send_chunk in send_chunks:
+            yield send_chunk
+    except Exception as e: # cancellation passes straight through, as in ahandle_query
+        conversation_logger.error(f"Error in provisional answer: {str(e)}", exc_info=True)
+    finally:
+        await send_chunks.aclose()
 
-        
+
+def email_query(session_state: SessionData, user_input: str, email_index: Optional[int] = None,
+                email_id: Optional[str] = None) -> EmailTurn:
+    '''
+    The turn's input for the model and for the conversation memory. With an email reference, the model gets the
+    email's context (built from its cached body, capped and reduced to text) and the memory only its header.
+    Without one, if the reference doesn't match the session's list any more, or if the body can't be fetched,
+    both are just user_input.
+    A long email comes back in map_reduce mode: map_long_email / amap_long_email fill in its model input.
+    An email whose job postings have been extracted is sent as those postings instead (mode "jobs").
+    '''
+    email = find_fetched_email(session_state, email_index, email_id)
+    if email is None:
+        return EmailTurn(user_input, user_input)
+
+    # Job postings already extracted from the whole email stand in for its body
+    jobs = email_cache.get_jobs(email['id'])
+    if jobs is not None and jobs['complete'] and jobs['jobs']:
+        return email_context.build_from_jobs(email, format_jobs(jobs), user_input)
+
+    try:
+        body = fetched_email_body(email)
     except Exception as e:
-        conversation_logger.error(f"Error in chat stream: {str(e)}", exc_info=True)
-        yield "I apologize, but I encountered an error. Please try again."
+        conversation_logger.error(f"Could not fetch the body of email {email['id']}: {str(e)}")
+        return EmailTurn(user_input, user_input)  # as the page did when it had no body to send
+    job_extractor.schedule([email['id']])  # for the next question about it
+    return email_context.build(email, body, user_input)
+
+
+email_map_template = """You are reading part {part} of {parts} of a long email, for an assistant that will answer the user's question about the whole email from notes on every part.
+From this part only, write down everything relevant to the question. Include every job listing that involves AI Product Management or AI Product Strategy, with the job title, employer, location, whether it is remote, hybrid or onsite, and any link. Keep the email's own wording where you can, and don't answer the question itself.
+If nothing in this part is relevant, answer exactly: {nothing}
+
+User's question: {question}
+
+Email from {sender}, subject "{subject}", part {part} of {parts}:
+{segment}"""
 
-    yield "DONE"
+
+def email_map_prompts(turn: EmailTurn) -> List[str]:
+    return [email_map_template.format(part=n, parts=len(turn.segments), nothing=NOTHING_RELEVANT,
+                                      question=question_from_query(turn.question), sender=turn.email.get('sender', ''),
+                                      subject=turn.email.get('subject', ''), segment=segment)
+            for n, segment in enumerate(turn.segments, 1)]
+
+
+def email_map_notes(turn: EmailTurn, responses: list) -> List[str]:
+    notes = []
+    for n, response in enumerate(responses, 1):
+        if isinstance(response, Exception):
+            conversation_logger.error(f"Notes on part {n} of email {turn.email.get('id')} failed: {response}")
+            notes.append("[This part of the email could not be read.]")
+        else:
+            notes.append(str(response.content))
+    return notes
+
+
+def email_turn(session_state: SessionData, user_input: str, email_index: Optional[int] = None,
+               email_id: Optional[str] = None) -> EmailTurn:
+    '''email_query, with the map step done for a long email.'''
+    turn = email_query(session_state, user_input, email_index, email_id)
+    if turn.mode == "map_reduce":
+        map_long_email(turn)
+    return turn
+
+
+async def aemail_turn(session_state: SessionData, user_input: str, email_index: Optional[int] = None,
+                      email_id: Optional[str] = None) -> EmailTurn:
+    turn = await asyncio.to_thread(email_query, session_state, user_input, email_index, email_id)
+    if turn.mode == "map_reduce":
+        await amap_long_email(turn)
+    return turn
+
+
+def map_long_email(turn: EmailTurn) -> None:
+    '''Map step for a long email: notes on every segment, a bounded number of model calls at once, then reduce.'''
+    started = time.perf_counter()
+    responses = current_model().batch(email_map_prompts(turn), config={"max_concurrency": long_email_concurrency},
+                            return_exceptions=True)
+    email_context.reduce(turn, email_map_notes(turn, responses))
+    latency_stats.record("email_map_ms", (time.perf_counter() - started) * 1000)
+
+
+async def amap_long_email(turn: EmailTurn) -> None:
+    started = time.perf_counter()
+    responses = await current_model().abatch(email_map_prompts(turn),
+                                             config={"max_concurrency": long_email_concurrency}, return_exceptions=True)
+    email_context.reduce(turn, email_map_notes(turn, responses))
+    latency_stats.record("email_map_ms", (time.perf_counter() - started) * 1000)
+
+
+def find_fetched_email(session_state: SessionData, email_index: Optional[int], email_id: Optional[str]) -> Optional[dict]:
+    emails = session_state.fetched_emails  # one snapshot: a new fetch replaces the list, it doesn't change it
+    if email_index is not None and 0 <= email_index < len(emails):
+        if email_id is None or emails[email_index]['id'] == email_id:
+            return emails[email_index]
+    if email_id is not None:
+        return next((email for email in emails if email['id'] == email_id), None)
+    return None
+
+
+def previous_user_question(history) -> Optional[str]:
+    for msg in reversed(history):
+        if isinstance(msg, HumanMessage):
+            return question_from_query(str(msg.content))
+    return None
+
+
+def record_turn_latency(metric: str, query_inputs: dict, started: float) -> None:
+    # Labelled by policy context mode so full-text and retrieval answers can be compared in /api/stats,
+    # and for turns about an email by how it was sent (single prompt or map-reduce, see ui_email_context.py)
+    labels = f"policy_context={query_inputs['policy_context_mode']}"
+    if query_inputs.get("email_mode", "none") != "none":
+        labels += f",email={query_inputs['email_mode']}"
+    latency_stats.record(f"{metric}[{labels}]", (time.perf_counter() - started) * 1000)
+
+
+def save_query_turn(session_state: SessionData, user_input: str, full_response_chunks: List[str]) -> None:
+    # Join full response chunks only once at the end
+    full_response = ''.join(full_response_chunks)
+
+    if not full_response:
+        full_response = "I apologize, but I encountered an error processing your request. Please try again."
+
+    session_state.memory.save_context({"input": user_input}, {"output": full_response})
 
 def policy_is_selected(session_state: SessionData) -> bool:
     return (session_state.number_policies is not None and 
@@ -493,7 +968,8 @@ def policy_is_selected(session_state: SessionData) -> bool:
         
 
 def format_history_for_gemini(history):
-    """Format conversation history while maintaining message objects"""
+    """Format conversation history while maintaining message objects.
+    Turns no longer call this: SessionConversationMemory keeps the same result up to date incrementally (ui_conversation_memory.py)."""
     seen_messages = set()  # Track unique messages
     formatted_messages = []
     
@@ -514,40 +990,125 @@ def process_pdf_file(policy: Policy, session_state: SessionData):
             3) Store the path to the converted file in the session_state
             4) Set is_extracted to True in the session_state
 
+    The extraction runs in the background extraction pool (ui_pdf_extraction.py), this waits for it. A PDF with the
+    same bytes as one extracted before is not extracted again (see ui_text_store.py).
     '''
-    txt_file_path = create_txt_file_path(policy.path)
-    file_contents = extract_text_from_pdf(policy.path, txt_file_path) # in subdir pdf_processor
-    #txt_file_path = write_text_to_txt_file (file_contents, policy)
-    policy.extracted_file_path = txt_file_path
+    if use_stored_text(policy):
+        return
+    job = start_policy_extraction(policy)
+    pdf_extraction_queue.wait(job)
+    if job.status != "done":
+        raise PDFExtractionError(f"Failed to extract text from PDF {policy.path}: {job.error}")
+    policy.extracted_file_path = job.txt_file_path
     policy.is_extracted = True
 
-def extract_text_from_pdf(policy, txt_file_path):
-    # Initialize the service
-    pdf_service = PDFProcessingService(base_temp_dir="processing_tmp")
 
-    # Check dependencies first
-    if not pdf_service.check_dependencies():
-        print("Missing dependencies. Please install required packages.")
-        exit(1)
+def start_policy_extraction(policy: Policy, priority: int = EXTRACTION_PRIORITY_QUERY):
+    '''Queue the policy's PDF for extraction into the extracted text store, or join the job already doing it
+    (for this PDF or any other with the same bytes).'''
+    digest = text_store.digest(policy.path)
+    return pdf_extraction_queue.submit(policy.path, text_store.new_text_path(digest), priority, key=("sha256", digest))
 
-    # Process a document
-    result = pdf_service.process_document(
-        pdf_path=policy,
-        output_file=txt_file_path,
-        languages=["eng"]
-    )
 
-    # Check result and use the extracted text
-    if result["success"]:
-        print(f"Document processed successfully as {result['document_type']}")
-        print(f"Text available at: {result['text_file_path']}")
-        
-    else:
-        print(f"Processing failed: {result['error']}")
+def use_stored_text(policy) -> bool:
+    '''Point a Policy or ServerPolicyFile at the stored text of its PDF, if a PDF with the same bytes has been
+    extracted. False if none has.'''
+    stored = text_store.lookup(policy.path)
+    if stored is None:
+        return False
+    policy.extracted_file_path = stored.text_path
+    policy.is_extracted = True
+    return True
+
+
+def store_extracted_text(job) -> None:
+    '''Record a finished extraction in the text store, with the page offsets and retrieval sections of its text.'''
+    if job.key[0] != "sha256":
+        return
+    text = read_from_extracted_file(job.txt_file_path)
+    if not text.replace('\f', '').strip():
+        # Stored text is reused by every session for good, and an empty extraction is never the right text
+        conversation_logger.warning(f"Not storing the empty text extracted from {job.pdf_path}")
+        return
+    sections = [section.spans for section in chunk_policy_text(text, SECTION_TARGET_CHARS)]
+    text_store.put(job.key[1], job.document_type, text, sections, SECTION_TARGET_CHARS)
+
+
+# Stored before the warm-up runs (ui_policy_warmup.py), so the retrieval index is built from the stored sections
+pdf_extraction_queue.on_done.insert(0, store_extracted_text)
+policy_index_cache.configure(text_store.stored_sections)
+
+
+def warm_up_policy(policy: Policy, priority: int) -> None:
+    '''Queue the policy's extraction if it isn't extracted yet, and the loading and indexing of its text. A policy
+    being extracted is warmed when its job finishes.'''
+    if policy.is_extracted or use_stored_text(policy):
+        if policy.extracted_file_path:
+            policy_warmup.warm(policy.extracted_file_path, priority)
+        return
+    previous = pdf_extraction_queue.job_for(policy.path)
+    if priority == EXTRACTION_PRIORITY_FOCUS and previous is not None and previous.status == "failed":
+        return  # not retried on every focus; selecting the policy or asking about it tries again
+    job = start_policy_extraction(policy, priority)
+    if job.status == "done":
+        policy_warmup.warm(job.txt_file_path, priority)
+
+
+def record_first_policy_query(session_state: SessionData, job) -> None:
+    '''Count whether the selected policy was warm for the session's first question about it (see ui_policy_warmup.py).'''
+    if not policy_is_selected(session_state):
+        return
+    policy = session_state.policy_list[session_state.selected_policy_index]
+    txt_file_path = job.txt_file_path if job is not None else policy.extracted_file_path
+    policy_warmup.record_first_query(session_state.session_id, policy.path, txt_file_path or None,
+                                     job is not None and not job.finished)
+
+
+def selected_policy_extraction(session_state: SessionData):
+    '''The extraction job the selected policy is waiting on, or None if there is no policy or it is extracted.'''
+    if not policy_is_selected(session_state):
+        return None
+    policy = session_state.policy_list[session_state.selected_policy_index]
+    if policy.is_extracted or use_stored_text(policy):
+        return None
+    return start_policy_extraction(policy)
+
+
+def finish_policy_extraction(session_state: SessionData, job) -> bool:
+    '''Point the session's policy at the text a finished job extracted. False if the extraction failed.'''
+    if job.status != "done":
+        return False
+    for policy in session_state.policy_list:
+        if not policy.is_extracted and os.path.abspath(policy.path) == os.path.abspath(job.pdf_path):
+            policy.extracted_file_path = job.txt_file_path
+            policy.is_extracted = True
+    return True
+
+
+def handle_extraction_status(session_state: SessionData, job_id: Optional[str] = None):
+    """
+    Status of PDF extraction jobs, for /api/extraction_status.
 
-    # Optional: Clean up temporary files when done
-    if "job_id" in result:
-        pdf_service.cleanup_job(result["job_id"])
+    Args:
+        session_state: Current session state
+        job_id: A job's id, as sent in the chat stream's "extracting" events. Without one, the latest job for each
+                of the session's policies is reported.
+
+    Returns:
+        dict with the jobs' status (queued, running, done or failed), error and elapsed time
+    """
+    if job_id:
+        job = pdf_extraction_queue.job(job_id)
+        if job is None:
+            return {"success": False, "error": f"No extraction job {job_id}"}
+        return {"success": True, "jobs": [job.to_dict()]}
+
+    jobs = []
+    for policy in session_state.policy_list:
+        job = pdf_extraction_queue.job_for(policy.path) if policy.path else None
+        if job is not None:
+            jobs.append(dict(job.to_dict(), policy=policy.print_name))
+    return {"success": True, "jobs": jobs}
 
 #####################################################################
 # Deprecated by PDFProcessingService
@@ -633,9 +1194,9 @@ def create_txt_file_path(pdf_file_path: str) -> str:
 
 
 def read_from_extracted_file(file_path: str) -> str:
+    # Served from the process-wide extracted text cache; the file is only read again if its mtime or size changes
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return file.read()
+        return extracted_text_cache.read(file_path)
     except FileNotFoundError:
         raise FileNotFoundError("Error: The file was not found.")
     except IOError:
@@ -662,6 +1223,16 @@ def handle_policy_selection(session_state: SessionData, user_id: str, selected_p
                 break
         else:
             print(f"Warning: Selected policy '{selected_policy}' not found")
+
+    # Move the selected policy's extraction and warm-up ahead of the rest, so it is likely ready by the first question
+    if policy_is_selected(session_state):
+        try:
+            warm_up_policy(session_state.policy_list[session_state.selected_policy_index], EXTRACTION_PRIORITY_SELECTION)
+        except OSError as e:
+            conversation_logger.warning(f"Can't extract the selected policy: {e}")  # reported again when it is asked about
+
+    # The prompt prefix carries the policy, so the session's cached prefix is stale now
+    prefix_cache.invalidate_session(session_state.session_id)
     
 
             
@@ -677,6 +1248,8 @@ def handle_policy_selection(session_state: SessionData, user_id: str, selected_p
 def handle_fetch_emails(session_state: SessionData, date_str: str):
     """
     Fetch emails from Gmail for the specified date.
+    The persistent email cache is brought up to date from the Gmail history first (at most every
+    PP_EMAIL_SYNC_SECONDS), so a day that was listed before is served from disk without listing it again.
 
     Args:
         session_state: Current session state to store fetched emails
@@ -689,39 +1262,17 @@ def handle_fetch_emails(session_state: SessionData, date_str: str):
         return {"success": False, "error": "Gmail functions not available"}
 
     try:
-        # Authenticate with Gmail
-        creds = gmail_authenticate()
-        service = build("gmail", "v1", credentials=creds)
+        sync_email_history(session_state)
 
-        # Generate query for the specified date
-        query = generate_gmail_search_query(date_str, date_str)
-
-        # Fetch all messages
-        messages = fetch_messages(service, query)
+        if email_cache.is_day_synced(date_str):
+            email_list = email_cache.messages_for_day(date_str)
+        else:
+            email_list = list_email_day(session_state, date_str)
 
-        if not messages:
+        if not email_list:
             return {"success": True, "count": 0, "message": f"No emails found for {date_str}"}
 
-        # Fetch metadata only (lazy load bodies when user views each email)
-        email_list = []
-        for msg in messages:
-            metadata = get_message_metadata(service, msg['id'])
-            email_list.append({
-                'id': metadata['id'],
-                'sender': metadata['sender'],
-                'subject': metadata['subject'],
-                'date': metadata['date'],
-                'internal_date': metadata['internal_date'],  # Include for sorting
-                'body': None  # Will be fetched lazily
-            })
-
-        # Sort emails by internal_date (newest first)
-        email_list.sort(key=lambda x: int(x.get('internal_date', 0)), reverse=True)
-
-        # Store in session state
-        session_state.fetched_emails = email_list
-        session_state.current_email_index = 0
-        session_state.gmail_service = service  # Store service for later body fetching
+        store_fetched_emails(session_state, email_list)
 
         # Return ALL email metadata (sorted by date)
         emails_metadata = []
@@ -744,6 +1295,205 @@ def handle_fetch_emails(session_state: SessionData, date_str: str):
         return {"success": False, "error": str(e)}
 
 
+def handle_fetch_emails_stream(session_state: SessionData, date_str: str):
+    """
+    Streaming version of handle_fetch_emails, for /api/fetch_emails_stream.
+    Yields (event, data) pairs: an 'email' event with each message's metadata (and id) as soon as it is known, in no
+    particular order, then one 'order' event with the ids newest first once the day is complete. The session's
+    email list only changes at the 'order' event, so email indices mean the same thing on both sides.
+    Failures end the stream with an 'error' event.
+    """
+    if not GMAIL_AVAILABLE:
+        yield 'error', {"success": False, "error": "Gmail functions not available"}
+        return
+
+    try:
+        sync_email_history(session_state)
+
+        if email_cache.is_day_synced(date_str):
+            email_list = email_cache.messages_for_day(date_str)
+            for email in email_list:
+                yield 'email', email_row(email)
+        else:
+            for email in stream_email_day(date_str):
+                yield 'email', email_row(email)
+            email_list = email_cache.messages_for_day(date_str)
+    except Exception as e:
+        yield 'error', {"success": False, "error": str(e)}
+        return
+
+    with session_state.lock:
+        store_fetched_emails(session_state, email_list)
+    message = f"Fetched {len(email_list)} emails from {date_str}" if email_list else f"No emails found for {date_str}"
+    yield 'order', {"success": True, "count": len(email_list), "message": message,
+                    "ids": [email['id'] for email in email_list]}
+
+
+def email_row(email: dict) -> dict:
+    """The metadata the sidebar shows for an email."""
+    return {key: email[key] for key in ('id', 'sender', 'subject', 'date', 'internal_date')}
+
+
+def store_fetched_emails(session_state: SessionData, email_list: List[dict]) -> None:
+    """Make email_list the session's fetched emails, and start prefetching the newest bodies."""
+    for email in email_list:
+        email['body'] = None  # Will be fetched lazily (from the email cache when it has it)
+
+    # Store in session state
+    session_state.fetched_emails = email_list
+    session_state.current_email_index = 0
+
+    # Warm the newest bodies in the background, so the first clicks don't wait on Gmail
+    body_prefetcher.new_list(session_state.session_id)
+    prefetch_email_bodies(session_state, range(prefetch_top_k), PRIORITY_LIST)
+    # Bodies cached earlier but never read for job postings (prefetched ones are queued as they arrive)
+    job_extractor.schedule(email['id'] for email in email_list if email_cache.has_body(email['id']))
+
+
+email_sync_seconds = float(os.getenv('PP_EMAIL_SYNC_SECONDS', '30'))
+
+
+def prefetch_email_bodies(session_state: SessionData, indices, priority: int) -> None:
+    '''Queue the bodies of the session's fetched emails at these indices for background fetching (ui_email_prefetch.py).'''
+    ids = [session_state.fetched_emails[i]['id'] for i in indices
+           if 0 <= i < len(session_state.fetched_emails) and not email_cache.has_body(session_state.fetched_emails[i]['id'])]
+    if not ids:
+        return
+    body_prefetcher.schedule(session_state.session_id, ids, priority, get_message_body, gmail_pool.client,
+                             email_cache.has_body, store_email_body)
+
+
+def store_email_body(message_id: str, body: str) -> None:
+    '''Keep a fetched body in the email cache and the search index, and queue the email for job extraction.'''
+    email_cache.put_body(message_id, body)
+    email_search.add_body(message_id, body)
+    job_extractor.schedule([message_id])
+
+
+def sync_email_history(session_state: SessionData) -> None:
+    '''Apply the messages added and removed since the cache's history id, then move the history id forward. Messages
+    moved to the trash or spam are removed like deleted ones, and come back if they are moved out again. Skipped
+    if the cache was synced less than email_sync_seconds ago, or has never listed a day.'''
+    start_history_id = email_cache.history_id()
+    if start_history_id is None or time.time() - email_cache.last_history_sync() < email_sync_seconds:
+        return
+
+    started = time.perf_counter()
+    try:
+        with gmail_pool.client() as service:
+            added, removed, latest = list_history_changes(service, start_history_id)
+    except HistoryExpired:
+        email_cache.forget_synced_days()  # too old to replay: days are listed again as they are fetched
+        return
+
+    latency_stats.record("gmail_history_ms", (time.perf_counter() - started) * 1000)
+
+    if removed:
+        email_cache.delete_messages(removed)
+        email_search.remove(removed)
+    if added:
+        added_metadata = fetch_metadata_concurrently(added, gmail_pool.client, get_message_metadata)
+        # Filed under the local date they arrived on; a full listing of that day corrects it if Gmail disagrees
+        for metadata in added_metadata:
+            day = datetime.fromtimestamp(int(metadata['internal_date']) / 1000).strftime('%Y-%m-%d')
+            email_cache.put_metadata([metadata], day=day)
+            email_search.add(metadata)
+    email_cache.set_history_id(latest)
+
+
+def list_email_day(session_state: SessionData, date_str: str) -> List[dict]:
+    '''List a day that isn't in the email cache yet. Only metadata of messages the cache doesn't already have is downloaded.'''
+    for _ in stream_email_day(date_str):
+        pass
+    # The day's rows in the cache are now exactly its listing, newest first
+    return email_cache.messages_for_day(date_str)
+
+
+def stream_email_day(date_str: str):
+    '''
+    Generator behind list_email_day: lists the day a page at a time and yields each message's metadata as soon as
+    it is known - straight away for messages already in the cache, as the download completes for the rest.
+    Downloads for a page start while the next page is being listed. Once it is exhausted the cache has the
+    complete day.
+    '''
+    listing_ms = 0.0
+    message_ids = []
+    new_metadata = []
+    # Fetch metadata only (lazy load bodies when user views each email)
+    # Concurrently, borrowing services from the Gmail client pool, rate limited and retried (see ui_gmail_fetch.py)
+    downloads = MetadataStream(gmail_pool.client, get_message_metadata)
+    with gmail_pool.client() as service:
+        # Taken before listing, so anything that arrives while we list is replayed by the next history sync
+        history_id = call_with_retries(lambda: get_history_id(service)) if email_cache.history_id() is None else None
+
+        # Generate query for the specified date
+        query = generate_gmail_search_query(date_str, date_str)
+
+        pages = list_message_pages(service, query)
+        while True:
+            started = time.perf_counter()
+            page = next(pages, None)
+            listing_ms += (time.perf_counter() - started) * 1000
+            if page is None:
+                break
+            page_ids = [msg['id'] for msg in page]
+            message_ids.extend(page_ids)
+            cached = email_cache.metadata_for(page_ids)
+            downloads.add([i for i in page_ids if i not in cached])
+            yield from cached.values()
+            for metadata in downloads.completed():
+                new_metadata.append(metadata)
+                yield metadata
+    latency_stats.record("gmail_list_ms", listing_ms)
+
+    for metadata in downloads.remaining():
+        new_metadata.append(metadata)
+        yield metadata
+
+    email_cache.put_metadata(new_metadata, day=date_str)
+    email_cache.mark_day_synced(date_str, message_ids)
+    for metadata in new_metadata:
+        email_search.add(metadata)
+    if history_id is not None:
+        email_cache.set_history_id(history_id)
+
+
+####################################
+# Email Search Handler
+####################################
+
+def handle_search_emails(session_state: SessionData, query: str, limit: int = 20, scope: str = 'day'):
+    """
+    Search the cached emails (ui_email_search.py), best match first.
+
+    Args:
+        session_state: Current session state
+        query: Words to look for in the sender, subject and body
+        limit: Most results to return
+        scope: 'day' searches the session's fetched emails, 'all' every email in the cache
+
+    Returns:
+        dict with the matching emails' metadata, score, and index in the fetched list (None if not in it)
+    """
+    fetched = getattr(session_state, 'fetched_emails', None) or []
+    positions = {email['id']: i for i, email in enumerate(fetched)}
+    if scope == 'day' and not fetched:
+        return {"success": True, "query": query, "count": 0, "results": [], "complete": email_search.loaded}
+
+    ranked = email_search.search(query, limit, within=positions if scope == 'day' else None)
+    # The cache may have dropped some since they were indexed (a day re-listed without them)
+    metadata = email_cache.metadata_for(message_id for message_id, _ in ranked)
+    email_search.remove(message_id for message_id, _ in ranked if message_id not in metadata)
+
+    results = []
+    for message_id, score in ranked:
+        if message_id in metadata:
+            results.append(dict(email_row(metadata[message_id]), score=round(score, 3),
+                                index=positions.get(message_id)))
+    return {"success": True, "query": query, "count": len(results), "results": results,
+            "complete": email_search.loaded}
+
+
 # Old sequential navigation removed - replaced with direct email selection via handle_select_email()
 # Users now click any email in the sidebar to select it
 
@@ -770,11 +1520,15 @@ def handle_select_email(session_state: SessionData, email_index: int):
     # Fetch body if not already loaded
     if email['body'] is None:
         try:
-            service = session_state.gmail_service
-            email['body'] = get_message_body(service, email['id'])
+            email['body'] = fetched_email_body(email)
         except Exception as e:
             email['body'] = f"[Error fetching body: {str(e)}]"
 
+    # The user tends to read the emails around this one next
+    prefetch_email_bodies(session_state,
+                          [email_index + d for d in range(-prefetch_neighbours, prefetch_neighbours + 1) if d],
+                          PRIORITY_SELECTION)
+
     # Update current index
     session_state.current_email_index = email_index
 
@@ -789,8 +1543,23 @@ def handle_select_email(session_state: SessionData, email_index: int):
     }
 
 
-# Note: Email context is now injected client-side in script.js before sending queries
-# See handleQuerySubmit() function which prepends email body, sender, subject, and date
+def fetched_email_body(email: dict) -> str:
+    '''The body of one of the session's fetched emails: already loaded, from the email cache (kept across restarts,
+    warmed by the prefetcher), from a prefetch already in flight, or from Gmail now.'''
+    if email['body'] is not None:
+        return email['body']
+
+    def fetch_now():
+        with gmail_pool.client() as service:
+            body = get_message_body(service, email['id'])
+        store_email_body(email['id'], body)
+        return body
+    email['body'] = body_prefetcher.get_body(email['id'], email_cache.get_body, fetch_now)
+    return email['body']
+
+
+# Note: Email context is built server-side for /api/chat from the email the page refers to (email_query above,
+# ui_email_context.py); script.js no longer prepends the body to the question
 
 
 ####################################
@@ -798,37 +1567,16 @@ def handle_select_email(session_state: SessionData, email_index: int):
 ####################################
 
 def handle_clear_button_click(session_state, user_id):
-    '''Clear the conversation by resetting memory, policy data, and chain state.The key to clearing the conversation is to clear the memory. But  we should also clear the policy instructions and the policy content. We recreate the chain itself to insure that all values, including history and input are reset. Finally, session state values are reinitialized by setting the selected policy to the str "None" and the selected policy's index to None.
+    '''Clear the conversation by resetting this session's memory and policy selection. The key to clearing the conversation is to clear the memory. The policy instructions and policy content are rebuilt from the selected policy on every query, and the shared chain holds no per-session state, so neither needs resetting here. Finally, session state values are reinitialized by setting the selected policy to the str "None" and the selected policy's index to None.
     '''
-    global memory, chain, policy_instructions, policy_extracted_content
-    
-
-    
-    global memory, chain, policy_instructions, policy_extracted_content
-    
-    # Log memory state before clearing
-    initial_history = memory.load_memory_variables({})["history"]
-
-    
-    # Clear the Langchain conversation memory
-    memory.clear()
+    # Clear the Langchain conversation memory for this session only
+    if session_state.memory is not None:
+        session_state.memory.clear()
 
-    # Verify memory is cleared
-    cleared_history = memory.load_memory_variables({})["history"]
-
-    
-
-    # Clear policy instructions and policy content
-    policy_instructions = ""
-    policy_extracted_content = ""
-  
-    # Recreate chain to ensure completely fresh state
-    chain = create_chain()
-
-    
     # Reset the selected policy
     session_state.selected_policy = "None"
     session_state.selected_policy_index = None
+    prefix_cache.invalidate_session(session_state.session_id)
 
 
     
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from handlers.ui_email_context import email_body_text
+from handlers.ui_latency_stats import latency_stats
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Background job posting extraction
+####################################
+# The system prompt is about finding AI Product Management / Strategy jobs in an email, so every question about an
+# email used to make the model re-read the whole body and work out its job list again. Here each email whose body
+# reaches the email cache is queued for one extraction pass: a summary and its job postings (title, employer,
+# remote/hybrid/onsite, location, ...) as JSON. A worker thread takes up to PP_JOB_EXTRACTION_BATCH queued emails
+# at a time and runs them through model.batch with at most PP_JOB_EXTRACTION_CONCURRENCY calls in flight
+# (defaults 8 and 4). Results are kept in the email cache by message id, so they survive restarts.
+#
+# Questions about an email that has postings are then answered from those records instead of the raw body
+# (email mode "jobs" in /api/stats), a much smaller prompt. Emails without postings, emails longer than
+# PP_JOB_EXTRACTION_MAX_CHARS (default 30000, read only in part) and emails not extracted yet still send the body.
+# PP_JOB_EXTRACTION=off turns the pass off.
+
+WORK_MODES = ("remote", "hybrid", "onsite", "unknown")
+
+job_extraction_template = """Extract the job postings from the email below, for an assistant that helps the user find jobs.
+Answer with JSON only, no other text, in exactly this shape:
+{{"summary": "one or two sentences on what the email is", "jobs": [{{"title": "", "employer": "", "work_mode": "remote|hybrid|onsite|unknown", "location": "", "summary": "one line on the role and its main requirements", "link": ""}}]}}
+List every job posting in the email, not only relevant ones, in the order they appear. Use "" for anything the email doesn't say, and "unknown" if it doesn't say where the job is done. If the email has no job postings, "jobs" is [].
+
+Email from {sender}, subject "{subject}":
+{body}"""
+
+
+def parse_extraction(text: str) -> Optional[Dict]:
+    '''The {"summary", "jobs"} object in a model reply, cleaned up, or None if there isn't a usable one.'''
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("jobs"), list):
+        return None
+    jobs = []
+    for job in data["jobs"]:
+        if not isinstance(job, dict) or not job.get("title"):
+            continue
+        record = {key: str(job.get(key) or "").strip() for key in ("title", "employer", "location", "summary", "link")}
+        mode = str(job.get("work_mode") or "").strip().lower()
+        record["work_mode"] = mode if mode in WORK_MODES else "unknown"
+        jobs.append(record)
+    return {"summary": str(data.get("summary") or "").strip(), "jobs": jobs}
+
+
+def format_jobs(extraction: Dict) -> str:
+    '''The compact context sent in place of the body of an email with job postings.'''
+    lines = [f"Summary: {extraction['summary']}" if extraction['summary'] else "",
+             f"Job postings in this email ({len(extraction['jobs'])}, extracted from the full text):"]
+    for n, job in enumerate(extraction['jobs'], 1):
+        where = job['work_mode'] if not job['location'] else f"{job['work_mode']}, {job['location']}"
+        line = f"{n}. {job['title']}" + (f" - {job['employer']}" if job['employer'] else "") + f" ({where})"
+        if job['summary']:
+            line += f": {job['summary']}"
+        if job['link']:
+            line += f" <{job['link']}>"
+        lines.append(line)
+    return "\n".join(line for line in lines if line)
+
+
+class JobExtractor:
+
+    def __init__(self, batch_size: int = 8, concurrency: int = 4, max_chars: int = 30000, enabled: bool = True):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_chars = max_chars
+        self.enabled = enabled
+        self.run_batch: Callable[[List[str], int], list] = None  # model.batch(prompts, max_concurrency)
+        self.load_email: Callable[[str], Optional[tuple]] = None  # message id -> (metadata, body) or None
+        self.has_jobs: Callable[[str], bool] = None
+        self.store_jobs: Callable[[str, str, List[Dict], bool], None] = None
+        self._queue: "queue.Queue" = queue.Queue()
+        self._queued = set()
+        self._retry_after: Dict[str, float] = {}  # message id -> when a failed extraction may be tried again
+        self._lock = threading.Lock()
+        self._thread = None
+        self.extracted = 0
+        self.failed = 0
+        self.jobs_found = 0
+        self.batches = 0
+
+    def configure(self, run_batch, load_email, has_jobs, store_jobs) -> None:
+        self.run_batch = run_batch
+        self.load_email = load_email
+        self.has_jobs = has_jobs
+        self.store_jobs = store_jobs
+
+    def schedule(self, message_ids) -> None:
+        '''Queue emails for extraction, skipping any already extracted or queued.'''
+        if not self.enabled or self.run_batch is None:
+            return
+        with self._lock:
+            if self._thread is None:  # started lazily so importing the module doesn't start threads
+                self._thread = threading.Thread(target=self._work, name='job-extraction', daemon=True)
+                self._thread.start()
+            now = time.time()
+            for message_id in message_ids:
+                if message_id in self._queued or self._retry_after.get(message_id, 0) > now:
+                    continue
+                if not self.has_jobs(message_id):
+                    self._queued.add(message_id)
+                    self._queue.put(message_id)
+
+    def _work(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            # a list fetch or a burst of prefetches queues many at once: give them a moment to gather
+            deadline = time.monotonic() + 0.2
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._extract(batch)
+            except Exception as e:
+                logger.warning(f"Job extraction batch failed: {e}")
+                with self._lock:
+                    self.failed += len(batch)
+                    for message_id in batch:
+                        self._retry_after[message_id] = time.time() + 600
+            finally:
+                with self._lock:
+                    self._queued.difference_update(batch)
+
+    def _extract(self, message_ids: List[str]) -> None:
+        started = time.perf_counter()
+        items = []
+        for message_id in message_ids:
+            loaded = self.load_email(message_id)
+            if loaded is None:
+                continue
+            metadata, body = loaded
+            text = email_body_text(body)
+            items.append((message_id, len(text) <= self.max_chars,
+                          job_extraction_template.format(sender=metadata.get('sender', ''),
+                                                         subject=metadata.get('subject', ''),
+                                                         body=text[:self.max_chars])))
+        if not items:
+            return
+
+        responses = self.run_batch([prompt for _, _, prompt in items], self.concurrency)
+        for (message_id, complete, _), response in zip(items, responses):
+            extraction = None if isinstance(response, Exception) else parse_extraction(str(response.content))
+            if extraction is None:
+                logger.info(f"No usable job extraction for email {message_id}: {str(response)[:200]}")
+                with self._lock:
+                    self.failed += 1
+                    self._retry_after[message_id] = time.time() + 600  # don't ask again on every question
+                continue
+            self.store_jobs(message_id, extraction['summary'], extraction['jobs'], complete)
+            with self._lock:
+                self._retry_after.pop(message_id, None)
+                self.extracted += 1
+                self.jobs_found += len(extraction['jobs'])
+        with self._lock:
+            self.batches += 1
+        latency_stats.record("job_extraction_batch_ms", (time.perf_counter() - started) * 1000)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "queued": len(self._queued),
+                "batches": self.batches,
+                "extracted": self.extracted,
+                "failed": self.failed,
+                "jobs_found": self.jobs_found,
+            }
+
+
+job_extractor = JobExtractor(batch_size=int(os.getenv('PP_JOB_EXTRACTION_BATCH', '8')),
+                             concurrency=int(os.getenv('PP_JOB_EXTRACTION_CONCURRENCY', '4')),
+                             max_chars=int(os.getenv('PP_JOB_EXTRACTION_MAX_CHARS', '30000')),
+                             enabled=os.getenv('PP_JOB_EXTRACTION', 'on').strip().lower() not in ('off', '0', 'false'))
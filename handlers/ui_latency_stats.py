@@ -0,0 +1,45 @@
+import threading
+from collections import defaultdict, deque
+from typing import Dict
+
+
+####################################
+# Latency recording for /api/stats
+####################################
+# Named series of recent samples (milliseconds). Used to compare modes side by side, e.g.
+# "ttft_ms[policy_context=full]" vs "ttft_ms[policy_context=retrieval]".
+
+
+class LatencyRecorder:
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._series: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self._counts: Dict[str, int] = defaultdict(int)
+
+    def record(self, series: str, value_ms: float) -> None:
+        with self._lock:
+            self._series[series].append(value_ms)
+            self._counts[series] += 1
+
+    def snapshot(self) -> dict:
+        """count (all time) and mean/p50/p95/p99 over the most recent max_samples samples, per series."""
+        with self._lock:
+            series = {name: sorted(samples) for name, samples in self._series.items()}
+            counts = dict(self._counts)
+        result = {}
+        for name, ordered in series.items():
+            if not ordered:
+                continue
+            result[name] = {
+                "count": counts[name],
+                "mean": round(sum(ordered) / len(ordered), 2),
+                "p50": round(ordered[int(0.50 * (len(ordered) - 1))], 2),
+                "p95": round(ordered[int(0.95 * (len(ordered) - 1))], 2),
+                "p99": round(ordered[int(0.99 * (len(ordered) - 1))], 2),
+            }
+        return result
+
+
+latency_stats = LatencyRecorder()
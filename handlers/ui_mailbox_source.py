@@ -0,0 +1,303 @@
+import bisect
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from email import policy
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from handlers.ui_gmail_fetch import HistoryExpired
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Local mailbox email source
+####################################
+# Stand-ins for the Gmail functions (the same set ui_fake_gmail.py provides) that read a local mbox file or Maildir
+# directory instead, for offline work on real archives (a Google Takeout export, a mail client's mbox) and for
+# benchmarks without network access. Selected with PP_EMAIL_SOURCE=mbox or maildir, reading PP_MAILBOX_PATH.
+#
+# The archive is scanned once: for every message, where it is (mbox byte offsets, or its Maildir file), its id and
+# its From/Subject/Date headers, sorted by date. The index is saved next to the archive (PP_MAILBOX_INDEX, default
+# <archive>.ppindex.json) and reused while the archive's size and mtime are unchanged. A day is then two bisects
+# over the sorted dates instead of a scan, metadata comes straight from the index, and a body is parsed from an
+# mmap slice of just that message.
+#
+# Message ids are a hash of the Message-ID header (or of the headers, if it has none), so they stay the same when
+# the archive is re-indexed and the persistent email cache stays valid. When the archive changes on disk,
+# list_history_changes re-indexes it and reports the history as expired, so cached days are listed again.
+
+_FROM_LINE = re.compile(rb"From \S+ .*\d\d:\d\d")  # mbox separator: "From sender Mon Jan  1 00:00:00 2024"
+_FROM_QUOTE = re.compile(rb"(?m)^>(>*From )")
+_HEADER_LIMIT = 64 * 1024
+_INDEX_FORMAT = 2  # saved indexes of an older format are rebuilt (1 counted mbox's separating blank line in the body)
+
+
+class MailboxIndex:
+    '''Sorted message index over an mbox file or Maildir directory.'''
+
+    def __init__(self, path: str, index_path: Optional[str] = None):
+        self.path = path
+        self.is_maildir = os.path.isdir(path)
+        self.index_path = index_path or path.rstrip(os.sep) + '.ppindex.json'
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._file = None
+        self.version = None
+        self._dates: List[int] = []    # internal dates (ms), ascending
+        self._entries: List[tuple] = []  # (id, location, start, end, internal_date, sender, subject, date), same order
+        self._by_id: Dict[str, int] = {}
+        self.load()
+
+    # --- indexing ---
+
+    def _signature(self) -> List[int]:
+        '''Changes whenever the archive does: size and mtime of the file, or of the Maildir's new/ and cur/.'''
+        if not self.is_maildir:
+            stat = os.stat(self.path)
+            return [stat.st_size, stat.st_mtime_ns]
+        signature = []
+        for sub in ('new', 'cur'):
+            folder = os.path.join(self.path, sub)
+            if os.path.isdir(folder):
+                stat = os.stat(folder)
+                signature += [stat.st_mtime_ns, len(os.listdir(folder))]
+        return signature
+
+    def changed(self) -> bool:
+        return self._signature() != self.version
+
+    def load(self) -> None:
+        '''Use the saved index if it matches the archive, else scan the archive and save a new one.'''
+        signature = self._signature()
+        entries = self._read_saved(signature)
+        if entries is None:
+            entries = self._scan_maildir() if self.is_maildir else self._scan_mbox()
+            entries.sort(key=lambda entry: entry[4])
+            self._save(signature, entries)
+        with self._lock:
+            self._close_mmap()
+            self._entries = entries
+            self._dates = [entry[4] for entry in entries]
+            self._by_id = {entry[0]: n for n, entry in enumerate(entries)}
+            self.version = signature
+
+    def _read_saved(self, signature) -> Optional[List[tuple]]:
+        try:
+            with open(self.index_path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('format', 1) != _INDEX_FORMAT or saved.get('signature') != signature:
+            return None
+        return [tuple(entry) for entry in saved['entries']]
+
+    def _save(self, signature, entries) -> None:
+        try:
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump({'format': _INDEX_FORMAT, 'signature': signature, 'entries': entries}, f)
+            os.replace(self.index_path + '.tmp', self.index_path)
+        except OSError as e:
+            logger.info(f"Could not save the mailbox index {self.index_path}: {e}")  # it is rebuilt next start
+
+    def _scan_mbox(self) -> List[tuple]:
+        entries = []
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return entries
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                starts = [0] if _FROM_LINE.match(mm, 0) else []
+                pos = mm.find(b"\nFrom ")
+                while pos >= 0:
+                    if _FROM_LINE.match(mm, pos + 1):
+                        starts.append(pos + 1)
+                    pos = mm.find(b"\nFrom ", pos + 1)
+                for n, start in enumerate(starts):
+                    end = starts[n + 1] if n + 1 < len(starts) else len(mm)
+                    start = mm.find(b"\n", start, end) + 1  # the message starts after the From_ line
+                    if end - start >= 2 and mm[end - 2:end] == b"\n\n":
+                        end -= 1  # the blank line before the next From_ line separates messages, it isn't the body's
+                    entry = _index_entry(mm[start:min(end, start + _HEADER_LIMIT)], '', start, end)
+                    if entry is not None:
+                        entries.append(entry)
+        return entries
+
+    def _scan_maildir(self) -> List[tuple]:
+        entries = []
+        for sub in ('new', 'cur'):
+            folder = os.path.join(self.path, sub)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                location = os.path.join(sub, name)
+                try:
+                    with open(os.path.join(self.path, location), 'rb') as f:
+                        head = f.read(_HEADER_LIMIT)
+                        size = os.fstat(f.fileno()).st_size
+                except OSError:
+                    continue
+                entry = _index_entry(head, location, 0, size)
+                if entry is not None:
+                    entries.append(entry)
+        return entries
+
+    # --- lookups ---
+
+    def ids_between(self, start_ms: int, end_ms: int) -> List[str]:
+        '''Ids of messages dated in [start_ms, end_ms), oldest first.'''
+        with self._lock:
+            first = bisect.bisect_left(self._dates, start_ms)
+            last = bisect.bisect_left(self._dates, end_ms)
+            return [entry[0] for entry in self._entries[first:last]]
+
+    def entry(self, message_id: str) -> Optional[tuple]:
+        with self._lock:
+            n = self._by_id.get(message_id)
+            return self._entries[n] if n is not None else None
+
+    def raw_message(self, entry: tuple) -> bytes:
+        _, location, start, end = entry[:4]
+        if location:  # Maildir: one file per message
+            with open(os.path.join(self.path, location), 'rb') as f:
+                if end == 0:
+                    return b''
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return mm[start:end]
+        with self._lock:
+            if self._mmap is None:
+                self._file = open(self.path, 'rb')
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            raw = self._mmap[start:end]
+        return _FROM_QUOTE.sub(rb"\1", raw)  # mbox stores body lines starting with "From " as ">From "
+
+    def _close_mmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _index_entry(head: bytes, location: str, start: int, end: int) -> Optional[tuple]:
+    header_end = head.find(b"\n\n")
+    try:
+        headers = BytesHeaderParser(policy=policy.default).parsebytes(head[:header_end] if header_end >= 0 else head)
+        date = str(headers.get('Date', ''))
+        try:
+            internal_date = int(parsedate_to_datetime(date).timestamp() * 1000)
+        except (TypeError, ValueError, IndexError):
+            internal_date = 0
+        key = str(headers.get('Message-ID', '')).strip() or head[:header_end if header_end >= 0 else len(head)]
+        if isinstance(key, str):
+            key = key.encode('utf-8', 'replace')
+        message_id = hashlib.sha1(key).hexdigest()[:16]
+        return (message_id, location, start, end, internal_date,
+                str(headers.get('From', '')), str(headers.get('Subject', '')), date)
+    except Exception as e:
+        logger.info(f"Skipping unreadable message at {location or start}: {e}")
+        return None
+
+
+def _message_text(raw: bytes) -> str:
+    '''The message's text/plain body, else its text/html one (ui_email_context.py reduces HTML to text).'''
+    try:
+        message = BytesParser(policy=policy.default).parsebytes(raw)
+        part = message.get_body(preferencelist=('plain', 'html'))
+        if part is not None:
+            return part.get_content()
+        payload = message.get_payload(decode=True)
+        return payload.decode('utf-8', 'replace') if payload else ''
+    except Exception:
+        header_end = raw.find(b"\n\n")
+        return raw[header_end + 2 if header_end >= 0 else 0:].decode('utf-8', 'replace')
+
+
+####################################
+# Gmail function stand-ins
+####################################
+# The "service" is the shared MailboxIndex: it is read-only between re-indexes, so any number of threads can use it.
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def mailbox_index() -> MailboxIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            path = os.getenv('PP_MAILBOX_PATH')
+            if not path:
+                raise RuntimeError("PP_MAILBOX_PATH must point at an mbox file or Maildir directory")
+            _index = MailboxIndex(path, os.getenv('PP_MAILBOX_INDEX') or None)
+            logger.info(f"Mailbox {path}: {len(_index)} messages indexed")
+        return _index
+
+
+def gmail_authenticate():
+    return None  # nothing to authenticate: the archive is read straight from disk
+
+
+def build_gmail_service(creds):
+    return mailbox_index()
+
+
+def generate_gmail_search_query(start_date, end_date):
+    end = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)
+    return f"after:{start_date.replace('-', '/')} before:{end.strftime('%Y/%m/%d')}"
+
+
+def _query_range(query: str) -> Tuple[int, int]:
+    '''after: (inclusive) and before: (exclusive) dates of a query as local-time epoch ms, like Gmail's day filing.'''
+    dates = re.findall(r"(\d{4})/(\d{2})/(\d{2})", query)
+    first = datetime(*map(int, dates[0]))
+    last = datetime(*map(int, dates[1])) if len(dates) > 1 else first + timedelta(days=1)
+    return int(first.timestamp() * 1000), int(last.timestamp() * 1000)
+
+
+def list_message_pages(service, query, page_size=100) -> Iterator[List[dict]]:
+    ids = service.ids_between(*_query_range(query))
+    ids.reverse()  # newest first, like Gmail
+    for page_start in range(0, len(ids), page_size):
+        yield [{'id': i, 'threadId': i} for i in ids[page_start:page_start + page_size]]
+
+
+def fetch_messages(service, query):
+    return [message for page in list_message_pages(service, query) for message in page]
+
+
+def get_message_metadata(service, message_id):
+    entry = service.entry(message_id)
+    if entry is None:
+        raise KeyError(f"Message {message_id} is not in the mailbox")
+    return {'id': entry[0], 'sender': entry[5], 'subject': entry[6], 'date': entry[7], 'internal_date': str(entry[4])}
+
+
+def get_message_body(service, message_id):
+    entry = service.entry(message_id)
+    if entry is None:
+        raise KeyError(f"Message {message_id} is not in the mailbox")
+    return _message_text(service.raw_message(entry))
+
+
+def get_history_id(service):
+    return json.dumps(service.version)
+
+
+def list_history_changes(service, start_history_id):
+    '''No per-message history for a file: unchanged means no changes, changed means re-index and list days again.'''
+    if service.changed():
+        with _index_lock:
+            service.load()
+        raise HistoryExpired(f"{service.path} changed on disk")
+    if json.dumps(service.version) != start_history_id:
+        raise HistoryExpired(f"{service.path} was re-indexed")
+    return [], [], start_history_id
@@ -0,0 +1,92 @@
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from handlers.ui_prefix_cache import PrefixRegistrar
+
+
+####################################
+# Model backends
+####################################
+# The chat model used to be a ChatGoogleGenerativeAI built at import time. Backends are now registered by name
+# and chosen with PP_MODEL_BACKEND (or the --model server option):
+#     gemini (default)  ChatGoogleGenerativeAI, model PP_GEMINI_MODEL (default gemini-2.5-pro)
+#     fake              FakeStreamingChatModel (ui_fake_model.py), local and deterministic, for offline measurements
+# A backend may also provide a PrefixRegistrar for its provider's context cache (see ui_prefix_cache.py).
+# PP_PREFIX_CACHE_MIN_TOKENS overrides the backend's minimum prefix size for registration.
+
+
+@dataclass
+class ModelBackend:
+    name: str
+    create_model: Callable[[], object]  # returns a Langchain chat model
+    create_prefix_registrar: Optional[Callable[[object], PrefixRegistrar]] = None  # called with the model
+
+
+_model_backends: Dict[str, ModelBackend] = {}
+
+
+def register_model_backend(name: str, create_model: Callable[[], object],
+                           create_prefix_registrar: Optional[Callable[[object], PrefixRegistrar]] = None) -> None:
+    _model_backends[name] = ModelBackend(name, create_model, create_prefix_registrar)
+
+
+def model_backend_names():
+    return sorted(_model_backends)
+
+
+def get_model_backend(name: str) -> ModelBackend:
+    backend = _model_backends.get(name)
+    if backend is None:
+        raise ValueError(f"Unknown model backend '{name}'. Use one of: {', '.join(model_backend_names())}")
+    return backend
+
+
+def _min_prefix_tokens(default: int) -> int:
+    return int(os.getenv('PP_PREFIX_CACHE_MIN_TOKENS', str(default)))
+
+
+def _create_gemini_model():
+    # Imported here so the fake backend works without the Google packages
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model=os.getenv('PP_GEMINI_MODEL', 'gemini-2.5-pro'),
+        temperature=0.7,
+        convert_messages_to_prompt=False, # We are managing the convo history ourselves
+        streaming=True
+    )
+
+
+def _create_gemini_registrar(model) -> PrefixRegistrar:
+    from handlers.ui_prefix_cache import GeminiContextCacheRegistrar
+    return GeminiContextCacheRegistrar(model.model, min_tokens=_min_prefix_tokens(4096))
+
+
+def _create_fake_model():
+    from handlers.ui_fake_model import FakeStreamingChatModel
+    return FakeStreamingChatModel(
+        ttft_ms=float(os.getenv('PP_FAKE_TTFT_MS', '300')),
+        token_ms=float(os.getenv('PP_FAKE_TOKEN_MS', '20')),
+        reply_tokens=int(os.getenv('PP_FAKE_REPLY_TOKENS', '200')),
+        failure_rate=float(os.getenv('PP_FAKE_FAILURE_RATE', '0')),
+        seed=int(os.getenv('PP_FAKE_SEED', '0')),
+        prefill_ms_per_kb=float(os.getenv('PP_FAKE_PREFILL_MS_PER_KB', '0')),
+    )
+
+
+def _create_fake_registrar(model) -> PrefixRegistrar:
+    from handlers.ui_fake_model import FakeContextCacheRegistrar
+    return FakeContextCacheRegistrar(min_tokens=_min_prefix_tokens(0))
+
+
+register_model_backend('gemini', _create_gemini_model, _create_gemini_registrar)
+register_model_backend('fake', _create_fake_model, _create_fake_registrar)
+
+
+def create_model(name: str):
+    return get_model_backend(name).create_model()
+
+
+def create_prefix_registrar(name: str, model) -> Optional[PrefixRegistrar]:
+    backend = get_model_backend(name)
+    return backend.create_prefix_registrar(model) if backend.create_prefix_registrar else None
@@ -0,0 +1,330 @@
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional
+
+from handlers.ui_latency_stats import latency_stats
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Background PDF extraction
+####################################
+# A policy that hadn't been extracted to text yet used to be extracted inside the first chat request about it:
+# handle_query built a PDFProcessingService and ran the extraction (OCR for scanned policies) right there, so the
+# question stalled for as long as that took and the request's worker thread was tied up with it.
+#
+# Extractions now run in a pool of worker processes (PP_PDF_EXTRACTION_WORKERS, default 2), so OCR's CPU time doesn't
+# compete with the server's threads. A policy is queued as soon as it is selected, and /api/chat sends "extracting"
+# events while the question waits on it instead of blocking silently. Requests for a PDF that is already queued or
+# being extracted share that job, and a finished job is reused while its text file is there and the PDF is unchanged.
+# Jobs are dispatched most urgent first: one a question is waiting on, then the selected policy, then the warm-up of
+# the user's other policies; asking for a queued job at a higher priority moves it up. /api/extraction_status
+# reports the jobs.
+#
+# PDFProcessingService is only imported in the worker processes, on their first job, so the server starts without
+# the OCR stack.
+#
+# With PP_PDF_EXTRACTION_MODE=pages, PDFs are extracted page by page with pdfplumber instead (pages without a text
+# layer are OCRed with Tesseract if pytesseract and pdf2image are installed). Each page is appended to the text file
+# as soon as it is extracted, followed by a form feed, and the job's PageTable reads the pages in as they arrive, so
+# a question can be answered provisionally from the first pages (usually the declarations) while the rest of a long
+# scanned policy is still being read.
+
+
+def extract_pdf_in_worker(pdf_path: str, txt_file_path: str) -> dict:
+    '''Runs in a pool process: extract pdf_path to txt_file_path with PDFProcessingService.'''
+    from pdf_processor_service.pdf_processor import PDFProcessingService  # heavy, and only needed here
+
+    pdf_service = PDFProcessingService(base_temp_dir="processing_tmp")
+    if not pdf_service.check_dependencies():
+        return {"success": False, "error": "Missing PDF processing dependencies"}
+
+    result = pdf_service.process_document(pdf_path=pdf_path, output_file=txt_file_path, languages=["eng"])
+    # Clean up temporary files when done
+    if "job_id" in result:
+        pdf_service.cleanup_job(result["job_id"])
+    return {key: result.get(key) for key in ("success", "error", "document_type", "text_file_path")}
+
+
+def extract_pdf_pages_in_worker(pdf_path: str, txt_file_path: str) -> dict:
+    '''Runs in a pool process: extract pdf_path to txt_file_path a page at a time, each page followed by a form
+    feed and flushed, so the server can read the pages done so far.'''
+    try:
+        import pdfplumber
+    except ImportError:
+        return {"success": False, "error": "pdfplumber is not installed"}
+
+    ocr_pages = 0
+    has_text = False
+    with pdfplumber.open(pdf_path) as pdf, open(txt_file_path, 'w', encoding='utf-8') as out:
+        for number, page in enumerate(pdf.pages, start=1):
+            text = page.extract_text() or ""
+            if not text.strip():  # no text layer: a scanned page
+                text = ocr_page(pdf_path, number)
+                if text is None:
+                    # Writing it as a blank page would store a policy missing its scanned pages for good
+                    return {"success": False, "document_type": "scanned",
+                            "error": f"Page {number} is scanned and OCR isn't available (install pytesseract and pdf2image)"}
+                ocr_pages += 1
+            has_text = has_text or bool(text.strip())
+            out.write(text.replace('\f', '\n') + '\f')
+            out.flush()
+            page.close()  # pdfplumber keeps each page's parsed objects otherwise
+        pages = len(pdf.pages)
+    if not has_text:
+        return {"success": False, "error": "No text could be extracted from the PDF"}
+    document_type = "text" if not ocr_pages else ("scanned" if ocr_pages == pages else "mixed")
+    return {"success": True, "error": None, "document_type": document_type, "text_file_path": txt_file_path}
+
+
+def ocr_page(pdf_path: str, number: int) -> Optional[str]:
+    '''OCR one page of pdf_path, or None if pytesseract or pdf2image isn't installed.'''
+    try:
+        import pytesseract
+        from pdf2image import convert_from_path
+    except ImportError:
+        return None
+    images = convert_from_path(pdf_path, first_page=number, last_page=number)
+    return "\n".join(pytesseract.image_to_string(image) for image in images)
+
+
+class PageTable:
+    '''The pages of a text file that an extraction worker is still writing, read in as they are completed.'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pages: List[str] = []
+        self._read = 0  # bytes of the file already split into pages
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        '''Read any pages completed since the last call. The number of pages done.'''
+        with self._lock:
+            try:
+                with open(self.path, 'rb') as file:
+                    file.seek(self._read)
+                    data = file.read()
+            except FileNotFoundError:  # the worker hasn't started on it yet
+                return len(self.pages)
+            end = data.rfind(b'\f')  # a form feed byte is never part of a multi-byte UTF-8 character
+            if end >= 0:
+                self.pages.extend(page.decode('utf-8', errors='replace') for page in data[:end].split(b'\f'))
+                self._read += end + 1
+            return len(self.pages)
+
+    def text(self) -> str:
+        with self._lock:
+            return '\f'.join(self.pages)
+
+
+EXTRACTION_PRIORITY_QUERY = 0       # a question is waiting on it
+EXTRACTION_PRIORITY_SELECTION = 1   # the policy the user just selected
+EXTRACTION_PRIORITY_FOCUS = 2       # the user's other policies, warmed up when the chatbot gets focus (ui_policy_warmup.py)
+
+
+class ExtractionJob:
+
+    def __init__(self, job_id: str, key: tuple, pdf_path: str, txt_file_path: str, priority: int):
+        self.job_id = job_id
+        self.key = key
+        self.pdf_path = pdf_path
+        self.txt_file_path = txt_file_path
+        self.priority = priority
+        self.status = "queued"  # queued, running, done or failed
+        self.error = None
+        self.document_type = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.done = threading.Event()
+        self.page_table: Optional[PageTable] = None  # while a page-streaming extraction runs
+        self.pages = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def pages_done(self) -> int:
+        table = self.page_table
+        if table is not None:
+            self.pages = table.refresh()
+        return self.pages
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "pdf_path": self.pdf_path,
+            "status": self.status,
+            "priority": self.priority,
+            "error": self.error,
+            "document_type": self.document_type,
+            "pages": self.pages_done(),
+            "elapsed_s": round((self.finished_at or time.time()) - self.submitted_at, 2),
+        }
+
+
+class PDFExtractionQueue:
+    '''Jobs wait here, most urgent first, and are handed to the process pool only as workers free up, so a job
+    whose priority is raised while it waits (a warmed-up policy that gets selected) jumps ahead of the rest.'''
+
+    def __init__(self, workers: int = 2, extract: Callable[[str, str], dict] = extract_pdf_in_worker,
+                 streams_pages: bool = False):
+        self.workers = workers
+        self.extract = extract
+        self.streams_pages = streams_pages  # extract writes the text a page at a time (extract_pdf_pages_in_worker)
+        self._pool = None
+        self._jobs: Dict[tuple, ExtractionJob] = {}  # latest job per key: (pdf path, mtime, size) unless the caller gives one
+        self._by_id: Dict[str, ExtractionJob] = {}
+        self._by_path: Dict[str, ExtractionJob] = {}  # latest job asked for each pdf path
+        self._waiting = []  # heap of (priority, sequence, job); entries left behind by a priority bump are skipped
+        self._running = 0
+        self._sequence = itertools.count()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.on_done: List[Callable[[ExtractionJob], None]] = []  # called with each job that finishes successfully
+        self.submitted = 0
+        self.deduplicated = 0
+        self.reprioritized = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        # Created on first use, so importing the module doesn't start processes. spawn rather than fork: the server
+        # has threads (stream loop, prefetchers) that a forked child would inherit in whatever state they were in.
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def submit(self, pdf_path: str, txt_file_path: str, priority: int = EXTRACTION_PRIORITY_QUERY,
+               key: Optional[tuple] = None) -> ExtractionJob:
+        '''The job extracting pdf_path: one already queued, running or done for this version of the file (moved up
+        to priority if it is still waiting at a lower one), else a new one. Jobs are shared by key, (path, mtime,
+        size) by default; a content hash makes copies of the same PDF at different paths share one.'''
+        if key is None:
+            stat = os.stat(pdf_path)
+            key = (os.path.abspath(pdf_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and (not job.finished or (job.status == "done" and os.path.exists(job.txt_file_path))):
+                self.deduplicated += 1
+                self._by_path[os.path.abspath(pdf_path)] = job
+                if job.status == "queued" and priority < job.priority:
+                    job.priority = priority
+                    heapq.heappush(self._waiting, (priority, next(self._sequence), job))
+                    self.reprioritized += 1
+                return job
+            job = ExtractionJob(f"x{next(self._ids)}", key, pdf_path, txt_file_path, priority)
+            if self.streams_pages:
+                try:
+                    os.remove(txt_file_path)  # what a failed attempt left, or its pages would be read as this job's
+                except FileNotFoundError:
+                    pass
+                job.page_table = PageTable(txt_file_path)
+            self._jobs[key] = job
+            self._by_id[job.job_id] = job
+            self._by_path[os.path.abspath(pdf_path)] = job
+            self.submitted += 1
+            heapq.heappush(self._waiting, (priority, next(self._sequence), job))
+            started = self._dispatch()
+        self._watch(started)
+        return job
+
+    def _dispatch(self) -> List[tuple]:
+        '''Hand waiting jobs to the pool while it has idle workers. Called with the lock held; returns the (job, future)
+        pairs handed over, for the caller to _watch once it has released the lock.'''
+        started = []
+        while self._running < self.workers and self._waiting:
+            priority, _, job = heapq.heappop(self._waiting)
+            if job.status != "queued" or priority != job.priority:
+                continue  # already handed over, or queued again at a higher priority
+            try:
+                future = self._executor().submit(self.extract, job.pdf_path, job.txt_file_path)
+            except BrokenProcessPool:  # a worker died (out of memory, killed): start a fresh pool
+                self._pool = None
+                future = self._executor().submit(self.extract, job.pdf_path, job.txt_file_path)
+            job.status = "running"
+            self._running += 1
+            started.append((job, future))
+        return started
+
+    def _watch(self, started: List[tuple]) -> None:
+        # Outside the lock: a future that has finished already runs its callback right here, and _finished takes the lock
+        for job, future in started:
+            future.add_done_callback(lambda future, job=job: self._finished(job, future))
+
+    def wait(self, job: ExtractionJob, timeout: Optional[float] = None) -> bool:
+        '''Wait up to timeout seconds for the job to finish. True once it has (done or failed).'''
+        job.done.wait(timeout)
+        return job.finished
+
+    def _finished(self, job: ExtractionJob, future) -> None:
+        try:
+            result = future.result()
+            error = None if result.get("success") else (result.get("error") or "Extraction failed")
+        except Exception as e:  # the worker raised, or its process died
+            result, error = {}, f"{type(e).__name__}: {e}"
+        with self._lock:
+            job.document_type = result.get("document_type")
+            job.error = error
+            job.status = "failed" if error else "done"
+            job.finished_at = time.time()
+            job.pages_done()
+            job.page_table = None  # the whole text is in the file now
+            self._running -= 1
+            if error:
+                self.failed += 1
+            else:
+                self.completed += 1
+            started = self._dispatch()
+        self._watch(started)
+        if error:
+            logger.warning(f"Extraction of {job.pdf_path} failed: {error}")
+        else:
+            latency_stats.record("pdf_extraction_ms", (job.finished_at - job.submitted_at) * 1000)
+            for callback in self.on_done:
+                try:
+                    callback(job)
+                except Exception as e:
+                    logger.warning(f"After extracting {job.pdf_path}: {e}")
+        job.done.set()  # after on_done, so the text's warm-up is already queued when a waiting question moves on
+
+    def job(self, job_id: str) -> Optional[ExtractionJob]:
+        with self._lock:
+            return self._by_id.get(job_id)
+
+    def job_for(self, pdf_path: str) -> Optional[ExtractionJob]:
+        '''The latest job asked for pdf_path, whatever version of the file it was for.'''
+        with self._lock:
+            return self._by_path.get(os.path.abspath(pdf_path))
+
+    def stats(self) -> dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+            return {
+                "workers": self.workers,
+                "submitted": self.submitted,
+                "deduplicated": self.deduplicated,
+                "reprioritized": self.reprioritized,
+                "completed": self.completed,
+                "failed": self.failed,
+                "queued": sum(job.status == "queued" for job in jobs),
+                "running": self._running,
+            }
+
+
+extraction_progress_seconds = float(os.getenv('PP_PDF_EXTRACTION_PROGRESS_SECONDS', '1'))
+provisional_after_seconds = float(os.getenv('PP_PDF_PROVISIONAL_AFTER_SECONDS', '5'))
+extraction_mode = os.getenv('PP_PDF_EXTRACTION_MODE', 'service').strip().lower()
+if extraction_mode not in ('service', 'pages'):
+    raise ValueError(f"Unknown PP_PDF_EXTRACTION_MODE '{extraction_mode}'. Use service or pages")
+pdf_extraction_queue = PDFExtractionQueue(workers=int(os.getenv('PP_PDF_EXTRACTION_WORKERS', '2')),
+                                          extract=extract_pdf_pages_in_worker if extraction_mode == 'pages'
+                                          else extract_pdf_in_worker,
+                                          streams_pages=extraction_mode == 'pages')
@@ -0,0 +1,222 @@
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+from handlers.ui_text_utils import estimate_tokens, tokenize
+
+
+####################################
+# Policy retrieval
+####################################
+# Multi-hundred-page policies used to go into the {policy_content} slot of the prompt in full, on every turn.
+# Instead, each extracted policy is split into sections once, indexed with BM25 (all in-process, no network),
+# and only the sections that best match the user's question are sent, in document order, under a token budget.
+# Policies that already fit the budget are sent whole.
+#
+# Configured per deployment:
+#     PP_POLICY_CONTEXT        retrieval (default) or full - full restores the old behaviour, for latency comparisons
+#     PP_POLICY_TOKEN_BUDGET   most policy tokens to send per turn in retrieval mode (default 8000)
+#     PP_POLICY_TOP_K          most sections to send per turn (default 12)
+
+SECTION_TARGET_CHARS = 1500
+SECTION_SEPARATOR = "\n\n[...]\n\n"  # marks the gaps between non-adjacent sections for the model
+USER_QUESTION_MARKER = "[USER QUESTION]"
+
+
+@dataclass
+class PolicySection:
+    text: str
+    start: int  # character offset of the section in the extracted text
+    spans: List[Tuple[int, int]] = field(default_factory=list)  # (start, end) of the pieces of text joined into it
+
+
+class BM25Index:
+
+    def __init__(self, documents: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_lengths = [len(doc) for doc in documents]
+        self.avg_doc_length = (sum(self.doc_lengths) / len(documents)) if documents else 0.0
+        self.postings = {}  # term -> [(document index, term frequency)]
+        for i, doc in enumerate(documents):
+            for term, tf in Counter(doc).items():
+                self.postings.setdefault(term, []).append((i, tf))
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in self.postings.items()}
+
+    def search(self, query_terms: List[str], k: int) -> List[Tuple[float, int]]:
+        """Return up to k (score, document index) pairs, best first. Documents matching no term are left out."""
+        scores = Counter()
+        for term in set(query_terms):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self.postings[term]:
+                norm = 1 - self.b + self.b * self.doc_lengths[i] / (self.avg_doc_length or 1)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return [(score, i) for i, score in scores.most_common(k)]
+
+
+class PolicyIndex:
+    def __init__(self, text: str, sections: Optional[List[PolicySection]] = None):
+        self.sections = sections if sections is not None else chunk_policy_text(text)
+        self.bm25 = BM25Index([tokenize(section.text) for section in self.sections])
+
+
+def chunk_policy_text(text: str, target_chars: int = SECTION_TARGET_CHARS) -> List[PolicySection]:
+    '''Split extracted policy text into sections of about target_chars, on paragraph boundaries where possible.
+    Paragraphs longer than target_chars (common in OCR output) are split on line breaks, then hard-wrapped.'''
+    pieces = []
+    paragraph_start = 0
+    for separator in list(re.finditer(r"\n[ \t\r\f\v]*\n\s*", text)) + [None]:
+        paragraph_end = separator.start() if separator else len(text)
+        paragraph, start = text[paragraph_start:paragraph_end], paragraph_start
+        paragraph_start = separator.end() if separator else len(text)
+        if not paragraph.strip():
+            continue
+        if len(paragraph) <= target_chars:
+            pieces.append((paragraph, start))
+            continue
+        offset = 0
+        for line in paragraph.splitlines(keepends=True):
+            while len(line) > target_chars:
+                pieces.append((line[:target_chars], start + offset))
+                line = line[target_chars:]
+                offset += target_chars
+            pieces.append((line, start + offset))
+            offset += len(line)
+
+    sections: List[PolicySection] = []
+    current, current_start, current_spans = [], 0, []
+    current_len = 0
+    for piece, start in pieces:
+        if current and current_len + len(piece) > target_chars:
+            sections.append(PolicySection("\n\n".join(current).strip(), current_start, current_spans))
+            current, current_len, current_spans = [], 0, []
+        if not current:
+            current_start = start
+        current.append(piece)
+        current_spans.append((start, start + len(piece)))
+        current_len += len(piece)
+    if current:
+        sections.append(PolicySection("\n\n".join(current).strip(), current_start, current_spans))
+    return [section for section in sections if section.text]
+
+
+def sections_from_spans(text: str, section_spans: List[List[Tuple[int, int]]]) -> List[PolicySection]:
+    """The sections chunk_policy_text returned for text, rebuilt from their spans without chunking it again."""
+    return [PolicySection("\n\n".join(text[start:end] for start, end in spans).strip(), spans[0][0], spans)
+            for spans in section_spans if spans]
+
+
+class PolicyIndexCache:
+    '''Indexes keyed by (path, mtime, size), so each version of an extracted file is chunked and indexed once.
+    stored_sections, if configured, looks up the section spans saved with a file (see ui_text_store.py), which
+    saves chunking it again.'''
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.stored_sections: Callable[[str, str, int], Optional[List[List[Tuple[int, int]]]]] = None  # (path, text, section chars) -> spans
+        self._indexes: "OrderedDict[tuple, PolicyIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.hits = 0
+
+    def get(self, path: str, text: str) -> PolicyIndex:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                self.hits += 1
+                return index
+
+        spans = self.stored_sections(path, text, SECTION_TARGET_CHARS) if self.stored_sections is not None else None
+        index = PolicyIndex(text, sections_from_spans(text, spans) if spans else None)
+        with self._lock:
+            self._indexes[key] = index
+            self.builds += 1
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+        return index
+
+    def configure(self, stored_sections) -> None:
+        self.stored_sections = stored_sections
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"indexes": len(self._indexes), "builds": self.builds, "hits": self.hits}
+
+
+policy_index_cache = PolicyIndexCache()
+
+policy_context_mode = os.getenv('PP_POLICY_CONTEXT', 'retrieval').strip().lower()
+policy_token_budget = int(os.getenv('PP_POLICY_TOKEN_BUDGET', '8000'))
+policy_top_k = int(os.getenv('PP_POLICY_TOP_K', '12'))
+
+
+def set_policy_context_mode(mode: str) -> None:
+    """Switch between 'retrieval' and 'full' (used by the --policy-context server option)."""
+    global policy_context_mode
+    if mode not in ('retrieval', 'full'):
+        raise ValueError(f"Unknown policy context mode '{mode}'. Use retrieval or full")
+    policy_context_mode = mode
+
+
+def warm_policy_index(path: str, text: str) -> bool:
+    """Build the retrieval index select_policy_content will use for this text, if it will use one. True if it did."""
+    if policy_context_mode == 'full' or estimate_tokens(text) <= policy_token_budget:
+        return False
+    policy_index_cache.get(path, text)
+    return True
+
+
+def question_from_query(user_input: str) -> str:
+    """The user's own question, without any email context the browser prepended to it."""
+    marker = user_input.rfind(USER_QUESTION_MARKER)
+    return user_input[marker + len(USER_QUESTION_MARKER):] if marker >= 0 else user_input
+
+
+def select_policy_content(path: str, text: str, question: str,
+                          previous_question: Optional[str] = None, cache: bool = True) -> Tuple[str, str]:
+    '''
+    Choose the policy text to send for one turn. cache=False indexes text for this turn only, for text that is
+    still growing (the pages of a policy extracted so far).
+
+    Returns:
+        (content, mode) where mode is "full" if the whole text is sent, or "retrieval" if only selected sections are.
+    '''
+    if policy_context_mode == 'full' or estimate_tokens(text) <= policy_token_budget:
+        return text, "full"
+
+    index = policy_index_cache.get(path, text) if cache else PolicyIndex(text)
+    query_terms = tokenize(question)
+    if previous_question:
+        query_terms += tokenize(previous_question)  # follow-ups like "what about the second one?" lean on the last question
+
+    ranked = [i for _, i in index.bm25.search(query_terms, policy_top_k)]
+    if not ranked:
+        ranked = list(range(min(policy_top_k, len(index.sections))))  # nothing matched: the opening pages (declarations) are the best guess
+
+    chosen, used_tokens = [], 0
+    for i in ranked:
+        section_tokens = estimate_tokens(index.sections[i].text)
+        if chosen and used_tokens + section_tokens > policy_token_budget:
+            continue
+        chosen.append(i)
+        used_tokens += section_tokens
+
+    chosen.sort()  # keep document order so definitions read before the clauses that use them
+    parts = []
+    for n, i in enumerate(chosen):
+        if n and chosen[n - 1] != i - 1:
+            parts.append(SECTION_SEPARATOR)
+        elif n:
+            parts.append("\n\n")
+        parts.append(index.sections[i].text)
+    return ''.join(parts), "retrieval"
@@ -0,0 +1,139 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from handlers.ui_latency_stats import latency_stats
+from handlers.ui_pdf_extraction import PDFExtractionQueue, ExtractionJob, pdf_extraction_queue
+from handlers.ui_policy_retrieval import warm_policy_index
+from handlers.ui_text_cache import extracted_text_cache
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Policy warm-up
+####################################
+# Policies that weren't extracted yet (LincolnPol2.pdf and Condo_Policy_1.pdf for user3) were only extracted once
+# they were selected, and often only finished after the first question had been typed. Everything else a question
+# needs was cold too: the extracted text was read from disk and a long policy was chunked and indexed for retrieval
+# inside that first request.
+#
+# Now handle_focus queues every unextracted policy the user owns for extraction at the lowest priority, and
+# handle_policy_selection moves the selected one ahead of them (see ui_pdf_extraction.py). Once a policy's text is
+# there, one background thread warms it: the text is read into the extracted text cache and, when the policy is too
+# long to send whole, its retrieval index is built. Policies that were extracted already are warmed straight away.
+#
+# /api/stats reports, for the first question about each policy in a session, whether its text was warm (hit),
+# still being extracted (extraction_wait), or neither (miss), and the warm hit rate.
+
+class PolicyWarmup:
+
+    def __init__(self, extraction_queue: PDFExtractionQueue):
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._queued: Dict[str, int] = {}       # text path -> priority of its latest queue entry
+        self._warm: Set[tuple] = set()          # (text path, mtime, size) of each version of a file warmed
+        self._asked: Set[Tuple[str, str]] = set()  # (session id, policy path) of policies already asked about
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.warmed = 0
+        self.indexed = 0
+        self.failed = 0
+        self.hits = 0
+        self.extraction_waits = 0
+        self.misses = 0
+        extraction_queue.on_done.append(self._extracted)
+
+    def _extracted(self, job: ExtractionJob) -> None:
+        self.warm(job.txt_file_path, job.priority)
+
+    def warm(self, txt_file_path: str, priority: int) -> None:
+        '''Queue an extracted text file to be loaded and indexed, unless that version of it already is. A file
+        already queued at a lower priority is moved up.'''
+        path = os.path.abspath(txt_file_path)
+        if self.is_warm(path):
+            return
+        with self._lock:
+            if path in self._queued and self._queued[path] <= priority:
+                return
+            self._queued[path] = priority
+            if self._thread is None:  # started lazily so importing the module doesn't start threads
+                self._thread = threading.Thread(target=self._work, name='policy-warmup', daemon=True)
+                self._thread.start()
+        self._queue.put((priority, next(self._order), path))
+
+    def _work(self) -> None:
+        while True:
+            priority, _, path = self._queue.get()
+            with self._lock:
+                if self._queued.get(path) != priority:
+                    continue  # queued again at a higher priority, and already warmed from that entry
+                del self._queued[path]
+            started = time.perf_counter()
+            try:
+                key = _version(path)
+                text = extracted_text_cache.read(path)
+                indexed = warm_policy_index(path, text)
+            except Exception as e:
+                logger.warning(f"Warming up {path} failed: {e}")
+                with self._lock:
+                    self.failed += 1
+                continue
+            with self._lock:
+                self._warm.add(key)
+                self.warmed += 1
+                self.indexed += indexed
+            latency_stats.record("policy_warmup_ms", (time.perf_counter() - started) * 1000)
+
+    def is_warm(self, txt_file_path: str) -> bool:
+        try:
+            key = _version(txt_file_path)
+        except OSError:
+            return False
+        with self._lock:
+            return key in self._warm
+
+    def record_first_query(self, session_id: str, policy_path: str, txt_file_path: Optional[str],
+                           extracting: bool) -> None:
+        '''Count the session's first question about a policy as a hit, an extraction wait or a miss. Later questions
+        about the same policy aren't counted: by then it is warm either way.'''
+        key = (session_id, os.path.abspath(policy_path))
+        with self._lock:
+            if key in self._asked:
+                return
+            self._asked.add(key)
+        warm = not extracting and txt_file_path is not None and self.is_warm(txt_file_path)
+        with self._lock:
+            if extracting:
+                self.extraction_waits += 1
+            elif warm:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            first_queries = self.hits + self.extraction_waits + self.misses
+            return {
+                "warmed": self.warmed,
+                "indexed": self.indexed,
+                "failed": self.failed,
+                "queued": len(self._queued),
+                "first_queries": first_queries,
+                "hits": self.hits,
+                "extraction_waits": self.extraction_waits,
+                "misses": self.misses,
+                "warm_hit_rate": round(self.hits / first_queries, 3) if first_queries else None,
+            }
+
+
+def _version(path: str) -> tuple:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+policy_warmup = PolicyWarmup(pdf_extraction_queue)
@@ -0,0 +1,247 @@
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple
+
+from langchain.schema import HumanMessage
+
+from handlers.ui_text_utils import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+####################################
+# Prompt prefix caching
+####################################
+# The first message of every prompt (system instructions + policy instructions + policy content) is identical
+# from turn to turn while the selected policy doesn't change. PrefixCache keeps that message prepared, shared by
+# every session with the same prefix, and - when the model provider has a context cache and the prefix is big
+# enough to qualify - registers it there in the background. Turns that find a live provider cache entry send
+# only the history and the new question, with the cache name, instead of re-sending the prefix.
+# A prefix is only registered once a second turn uses it: in retrieval mode the policy sections in the prefix
+# follow the question, so most prefixes are used once, and paying for a provider cache entry nobody reads again
+# would cost more than re-sending them.
+#
+# PP_PREFIX_CACHE selects the mode:
+#     auto (default)  use the provider's context cache when one is available, else only the in-process cache
+#     local           in-process cache only; the prefix is re-sent every turn
+#     off             no caching at all (every turn formats and sends the prefix)
+# PP_PREFIX_CACHE_MIN_TOKENS overrides the provider's minimum prefix size for registration (Gemini: 4096).
+# A session's entry is dropped by handle_policy_selection and handle_clear_button_click.
+
+_registration_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefix-cache')
+
+
+class PrefixRegistrar(ABC):
+    """Registers prefixes with a model provider's context cache. Subclass per provider."""
+
+    min_tokens = 0  # providers refuse to cache content below some size
+
+    @abstractmethod
+    def register(self, prefix_text: str) -> Tuple[str, float]:
+        """Create a provider cache entry for prefix_text. Returns (cache name, expiry as a time.time() value)."""
+
+    def release(self, handle: str) -> None:
+        pass
+
+
+class GeminiContextCacheRegistrar(PrefixRegistrar):
+    '''Gemini explicit context caching (google-generativeai). The cache is tied to one model, so the model used for
+    a cached turn must be the one named here.'''
+
+    def __init__(self, model_name: str, ttl_seconds: int = 3600, min_tokens: int = 4096):
+        self.model_name = model_name if model_name.startswith('models/') else f"models/{model_name}"
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+
+    def register(self, prefix_text):
+        import google.generativeai as genai
+        from google.generativeai import caching
+        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+        cache = caching.CachedContent.create(
+            model=self.model_name,
+            display_name="prompt-playground-prefix",
+            contents=[{"role": "user", "parts": [{"text": prefix_text}]}],
+            ttl=datetime.timedelta(seconds=self.ttl_seconds),
+        )
+        return cache.name, time.time() + self.ttl_seconds
+
+    def release(self, handle):
+        from google.generativeai import caching
+        caching.CachedContent.get(handle).delete()
+
+
+@dataclass
+class PreparedPrefix:
+    key: str
+    message: HumanMessage
+    size_bytes: int
+    sessions: Set[str] = field(default_factory=set)
+    provider_handle: Optional[str] = None
+    provider_expires_at: float = 0.0
+    uses: int = 0  # turns the prefix was prepared for
+    registering: bool = False
+    retry_after: float = 0.0
+
+    def live_handle(self) -> Optional[str]:
+        # stop using an entry a minute before the provider expires it, rather than race the expiry
+        if self.provider_handle and time.time() < self.provider_expires_at - 60:
+            return self.provider_handle
+        return None
+
+
+@dataclass
+class _SessionPrefix:
+    prefix: PreparedPrefix
+    parts: tuple  # the objects the prefix was built from, for the identity fast path
+
+
+class PrefixCache:
+
+    def __init__(self, registrar: Optional[PrefixRegistrar] = None, mode: str = 'auto'):
+        self.registrar = registrar
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._prefixes: Dict[str, PreparedPrefix] = {}
+        self._sessions: Dict[str, _SessionPrefix] = {}
+        self.turns = 0
+        self.reused = 0
+        self.built = 0
+        self.provider_turns = 0
+        self.provider_registrations = 0
+        self.provider_failures = 0
+        self.prefix_bytes_sent = 0
+        self.prefix_bytes_saved = 0
+
+    def prepare(self, session_id: str, template: str, **parts: str) -> Tuple[HumanMessage, Optional[str]]:
+        '''
+        Return (prefix message, provider cache name or None) for one turn.
+        When a cache name is returned the prefix is already on the provider's side and must not be sent again.
+        '''
+        if self.mode == 'off':
+            message = HumanMessage(content=template.format(**parts))
+            self._count_turn(len(message.content.encode('utf-8')), None)
+            return message, None
+
+        part_values = tuple(parts[name] for name in sorted(parts))
+        with self._lock:
+            current = self._sessions.get(session_id)
+            # Fast path: same objects as last turn (e.g. the full policy text from the text cache), nothing to hash
+            if current is not None and len(current.parts) == len(part_values) and all(
+                    a is b for a, b in zip(current.parts, part_values)):
+                prefix = current.prefix
+                prefix.uses += 1
+                self.reused += 1
+            else:
+                prefix = None
+
+        if prefix is None:
+            text = template.format(**parts)
+            key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            with self._lock:
+                prefix = self._prefixes.get(key)
+                if prefix is None:
+                    prefix = PreparedPrefix(key, HumanMessage(content=text), len(text.encode('utf-8')))
+                    self._prefixes[key] = prefix
+                    self.built += 1
+                else:
+                    self.reused += 1
+                prefix.uses += 1
+                self._attach_locked(session_id, prefix, part_values)
+
+        handle = prefix.live_handle()
+        if handle is None:
+            self._maybe_register(prefix)
+        self._count_turn(prefix.size_bytes, handle)
+        return prefix.message, handle
+
+    def _count_turn(self, size_bytes: int, handle: Optional[str]) -> None:
+        with self._lock:
+            self.turns += 1
+            if handle:
+                self.provider_turns += 1
+                self.prefix_bytes_saved += size_bytes
+            else:
+                self.prefix_bytes_sent += size_bytes
+
+    def _attach_locked(self, session_id: str, prefix: PreparedPrefix, part_values: tuple) -> None:
+        previous = self._sessions.get(session_id)
+        if previous is not None and previous.prefix is not prefix:
+            self._detach_locked(session_id, previous.prefix)
+        prefix.sessions.add(session_id)
+        self._sessions[session_id] = _SessionPrefix(prefix, part_values)
+
+    def _detach_locked(self, session_id: str, prefix: PreparedPrefix) -> None:
+        prefix.sessions.discard(session_id)
+        if not prefix.sessions:
+            self._prefixes.pop(prefix.key, None)
+            if prefix.provider_handle and self.registrar is not None:
+                _registration_executor.submit(self._release, prefix.provider_handle)
+
+    def _maybe_register(self, prefix: PreparedPrefix) -> None:
+        if self.mode != 'auto' or self.registrar is None:
+            return
+        if estimate_tokens(prefix.message.content) < self.registrar.min_tokens:
+            return
+        with self._lock:
+            if (prefix.uses < 2 or prefix.registering or prefix.key not in self._prefixes
+                    or time.time() < prefix.retry_after):
+                return
+            prefix.registering = True
+        _registration_executor.submit(self._register, prefix)
+
+    def _register(self, prefix: PreparedPrefix) -> None:
+        # Runs in the background: turns keep sending the prefix themselves until the provider entry exists
+        try:
+            handle, expires_at = self.registrar.register(prefix.message.content)
+        except Exception as e:
+            logger.warning(f"Provider context cache registration failed: {e}")
+            with self._lock:
+                self.provider_failures += 1
+                prefix.registering = False
+                prefix.retry_after = time.time() + 600  # don't retry on every turn
+            return
+        with self._lock:
+            self.provider_registrations += 1
+            prefix.registering = False
+            if prefix.key in self._prefixes:
+                prefix.provider_handle, prefix.provider_expires_at = handle, expires_at
+                return
+        self._release(handle)  # invalidated while we were registering
+
+    def _release(self, handle: str) -> None:
+        try:
+            self.registrar.release(handle)
+        except Exception as e:
+            logger.warning(f"Provider context cache release failed: {e}")
+
+    def invalidate_session(self, session_id: str) -> None:
+        """Forget the session's prefix (its policy selection changed or the conversation was cleared)."""
+        with self._lock:
+            current = self._sessions.pop(session_id, None)
+            if current is not None:
+                self._detach_locked(session_id, current.prefix)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "prefixes": len(self._prefixes),
+                "turns": self.turns,
+                "reused": self.reused,
+                "built": self.built,
+                "provider_turns": self.provider_turns,
+                "provider_registrations": self.provider_registrations,
+                "provider_failures": self.provider_failures,
+                "prefix_bytes_sent": self.prefix_bytes_sent,
+                "prefix_bytes_saved": self.prefix_bytes_saved,
+            }
+
+
+prefix_cache = PrefixCache(mode=os.getenv('PP_PREFIX_CACHE', 'auto').strip().lower())
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Iterator, List, Optional
+
+
+####################################
+# SSE flush coalescing
+####################################
+# Model chunks arrive in whatever sizes the provider picks. Each SSE event we send costs a socket write
+# (one syscall, since the handler's wfile is unbuffered), so small chunks are coalesced into fewer events.
+# A FlushPolicy decides when the pending text goes out; SSECoalescer holds the pending text in a list,
+# so adding a chunk is O(1) and the text is joined exactly once, when it is sent.
+#
+# The policy is set per deployment with the PP_FLUSH_POLICY environment variable (or --flush-policy):
+#     passthrough           one event per model chunk, lowest latency, most writes
+#     threshold:<chars>     send once at least <chars> characters are pending (default: threshold:50)
+#     latency:<ms>[:<max>]  send the first chunk immediately, then whatever is pending every <ms> milliseconds,
+#                           or sooner if <max> characters pile up (default max 4096)
+
+
+class FlushPolicy(ABC):
+    """Decides whether the pending text should be sent now. Policies hold no per-stream state."""
+
+    # Seconds after the first pending character by which it must be sent, or None if only size matters.
+    max_latency: Optional[float] = None
+
+    @abstractmethod
+    def should_flush(self, pending_chars: int, pending_age: float, events_sent: int) -> bool:
+        ...
+
+
+class PassThroughFlushPolicy(FlushPolicy):
+    def should_flush(self, pending_chars, pending_age, events_sent):
+        return pending_chars > 0
+
+    def __repr__(self):
+        return "passthrough"
+
+
+class ThresholdFlushPolicy(FlushPolicy):
+    def __init__(self, min_chars: int = 50):
+        self.min_chars = min_chars
+
+    def should_flush(self, pending_chars, pending_age, events_sent):
+        return pending_chars >= self.min_chars
+
+    def __repr__(self):
+        return f"threshold:{self.min_chars}"
+
+
+class LatencyFlushPolicy(FlushPolicy):
+    def __init__(self, window_ms: float = 30, max_chars: int = 4096):
+        self.window_ms = window_ms
+        self.max_latency = window_ms / 1000.0
+        self.max_chars = max_chars
+
+    def should_flush(self, pending_chars, pending_age, events_sent):
+        if pending_chars == 0:
+            return False
+        return events_sent == 0 or pending_age >= self.max_latency or pending_chars >= self.max_chars
+
+    def __repr__(self):
+        return f"latency:{self.window_ms:g}:{self.max_chars}"
+
+
+def flush_policy_from_spec(spec: str) -> FlushPolicy:
+    '''Parse a policy spec such as "passthrough", "threshold:50" or "latency:30:4096".'''
+    name, _, params = spec.strip().lower().partition(':')
+    values = [float(v) for v in params.split(':') if v]
+    try:
+        if name == 'passthrough':
+            return PassThroughFlushPolicy()
+        if name == 'threshold':
+            return ThresholdFlushPolicy(int(values[0]) if values else 50)
+        if name == 'latency':
+            window_ms = values[0] if values else 30
+            max_chars = int(values[1]) if len(values) > 1 else 4096
+            return LatencyFlushPolicy(window_ms, max_chars)
+    except (ValueError, IndexError):
+        pass
+    raise ValueError(f"Unknown flush policy '{spec}'. Use passthrough, threshold:<chars> or latency:<ms>[:<max chars>]")
+
+
+_flush_policy: FlushPolicy = flush_policy_from_spec(os.getenv('PP_FLUSH_POLICY', 'threshold:50'))
+
+
+def get_flush_policy() -> FlushPolicy:
+    return _flush_policy
+
+
+def set_flush_policy(spec: str) -> FlushPolicy:
+    """Set the deployment-wide flush policy (used by the --flush-policy server option)."""
+    global _flush_policy
+    _flush_policy = flush_policy_from_spec(spec)
+    return _flush_policy
+
+
+class SSECoalescer:
+    '''Pending text for one stream, released according to a FlushPolicy. Payloads have newlines escaped for SSE.'''
+
+    def __init__(self, policy: Optional[FlushPolicy] = None, clock=time.monotonic):
+        self.policy = policy or get_flush_policy()
+        self.clock = clock
+        self.pending: List[str] = []
+        self.pending_chars = 0
+        self.pending_since = 0.0
+        self.events_sent = 0
+
+    def push(self, text: str) -> Optional[str]:
+        """Add a model chunk. Returns a payload to send if the policy says it is time, else None."""
+        if not text:
+            return None
+        if not self.pending:
+            self.pending_since = self.clock()
+        self.pending.append(text)
+        self.pending_chars += len(text)
+        if self.policy.should_flush(self.pending_chars, self.clock() - self.pending_since, self.events_sent):
+            return self.flush()
+        return None
+
+    def time_until_flush(self) -> Optional[float]:
+        """Seconds until pending text is due under a latency policy, or None if nothing is waiting on a clock."""
+        if not self.pending or self.policy.max_latency is None:
+            return None
+        return max(0.0, self.policy.max_latency - (self.clock() - self.pending_since))
+
+    def flush(self) -> Optional[str]:
+        """Release everything pending, regardless of the policy (used at end of stream and when a window expires)."""
+        if not self.pending:
+            return None
+        payload = ''.join(self.pending).replace('\n', '\\n')
+        self.pending = []
+        self.pending_chars = 0
+        self.events_sent += 1
+        return payload
+
+
+def coalesce(contents: Iterator[str], coalescer: Optional[SSECoalescer] = None) -> Iterator[str]:
+    '''Coalesce a stream of model text into SSE payloads. In the sync path the latency window is only checked
+    when a chunk arrives, so a payload can wait at most one inter-chunk gap longer than the window.'''
+    coalescer = coalescer or SSECoalescer()
+    for content in contents:
+        payload = coalescer.push(content)
+        if payload is not None:
+            yield payload
+    payload = coalescer.flush()
+    if payload is not None:
+        yield payload
+
+
+async def acoalesce(contents: AsyncIterator[str], coalescer: Optional[SSECoalescer] = None) -> AsyncIterator[str]:
+    '''Async version of coalesce. Waits on the next chunk with a timeout, so a latency window is honoured even
+    while the model is silent. Cancelling the consumer cancels the pending read from `contents`.'''
+    coalescer = coalescer or SSECoalescer()
+    contents = contents.__aiter__()
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(contents.__anext__())
+            done, _ = await asyncio.wait({next_chunk}, timeout=coalescer.time_until_flush())
+            if not done:
+                payload = coalescer.flush()  # window expired with the model still talking
+                if payload is not None:
+                    yield payload
+                continue
+
+            finished, next_chunk = next_chunk, None
+            try:
+                content = finished.result()
+            except StopAsyncIteration:
+                break
+            payload = coalescer.push(content)
+            if payload is not None:
+                yield payload
+
+        payload = coalescer.flush()
+        if payload is not None:
+            yield payload
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+            await asyncio.gather(next_chunk, return_exceptions=True)
+        aclose = getattr(contents, 'aclose', None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,159 @@
+import mmap
+import os
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Union
+
+
+####################################
+# Extracted policy text cache
+####################################
+# read_from_extracted_file used to open and read the whole extracted .txt on every query while a policy
+# was selected, and the same file is shared by several users (LincolnPol1 belongs to user1, user2 and user3).
+# This process-wide LRU keeps each file's text keyed by path, and checks it against the file's mtime and size
+# on every read, so a re-extracted file is picked up straight away. Files larger than mmap_threshold are kept
+# as a read-only memory map instead of a Python string, so the OS can page them out under memory pressure.
+# The total size of all cached files is kept under max_bytes by evicting the least recently used.
+# Decoding a mapped file on every read would cost as much as reading it again, so the decoded text of the
+# max_decoded most recently read mapped files is kept too; the rest are decoded again when they are next read.
+# A decoded copy counts towards max_bytes along with its file, and is evicted with it.
+#
+# Sizes are configurable with PP_TEXT_CACHE_MB (default 256), PP_TEXT_CACHE_MMAP_KB (default 1024) and
+# PP_TEXT_CACHE_DECODED (default 4).
+
+
+@dataclass
+class _CachedText:
+    mtime_ns: int
+    size: int
+    content: Union[str, mmap.mmap]
+    decoded: Optional[str] = None  # text of a mapped file, while it is among the most recently read
+    decoded_bytes: int = 0         # memory the decoded text takes, counted in current_bytes
+
+
+def _decode(data: bytes) -> str:
+    # Match what open(path, 'r', encoding='utf-8') returns, including universal newline translation
+    text = data.decode('utf-8')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+class ExtractedTextCache:
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, mmap_threshold: int = 1024 * 1024, max_decoded: int = 4):
+        self.max_bytes = max_bytes
+        self.mmap_threshold = mmap_threshold
+        self.max_decoded = max_decoded
+        self._entries: "OrderedDict[str, _CachedText]" = OrderedDict()
+        self._decoded: "OrderedDict[str, _CachedText]" = OrderedDict()  # mapped entries holding their decoded text
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def read(self, path: str) -> str:
+        """Return the text of path, from the cache if the file hasn't changed since it was cached."""
+        stat = os.stat(path)  # raises FileNotFoundError like open() would
+        key = os.path.abspath(path)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if isinstance(entry.content, str):
+                    return entry.content
+                if entry.decoded is not None:
+                    self._decoded.move_to_end(key)
+                    return entry.decoded
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is not None:
+            return self._decode_mapped(key, entry)
+
+        entry = self._load(path, stat)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget_locked(key, old)
+            if entry.size <= self.max_bytes:
+                self._entries[key] = entry
+                self.current_bytes += entry.size
+                self._evict_locked()
+        return entry.content if isinstance(entry.content, str) else self._decode_mapped(key, entry)
+
+    def _decode_mapped(self, key: str, entry: _CachedText) -> str:
+        text = _decode(entry.content[:])
+        with self._lock:
+            if entry.decoded is not None:  # another thread got there first: return the same object it did
+                return entry.decoded
+            decoded_bytes = sys.getsizeof(text)
+            if (self._entries.get(key) is entry and self.max_decoded > 0
+                    and entry.size + decoded_bytes <= self.max_bytes):
+                entry.decoded, entry.decoded_bytes = text, decoded_bytes
+                self._decoded[key] = entry
+                self.current_bytes += decoded_bytes
+                while len(self._decoded) > self.max_decoded:
+                    _, oldest = self._decoded.popitem(last=False)
+                    self._drop_decoded_locked(oldest)
+                self._evict_locked()  # entry is the most recently used, so it is evicted last
+        return text
+
+    def _drop_decoded_locked(self, entry: _CachedText) -> None:
+        self.current_bytes -= entry.decoded_bytes
+        entry.decoded, entry.decoded_bytes = None, 0
+
+    def _load(self, path: str, stat: os.stat_result) -> _CachedText:
+        if stat.st_size > 0 and stat.st_size >= self.mmap_threshold:  # empty files cannot be mapped
+            with open(path, 'rb') as file:
+                # the mapping stays valid after the file is closed; it is unmapped when the last reference goes
+                content = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            with open(path, 'r', encoding='utf-8') as file:
+                content = file.read()
+        return _CachedText(stat.st_mtime_ns, stat.st_size, content)
+
+    def _evict_locked(self) -> None:
+        while self.current_bytes > self.max_bytes and self._entries:
+            key, evicted = self._entries.popitem(last=False)
+            self._forget_locked(key, evicted)
+            self.evictions += 1
+
+    def _forget_locked(self, key: str, entry: _CachedText) -> None:
+        self.current_bytes -= entry.size
+        if self._decoded.get(key) is entry:
+            del self._decoded[key]
+            self._drop_decoded_locked(entry)
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            key = os.path.abspath(path)
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._forget_locked(key, entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "mapped_entries": sum(1 for e in self._entries.values() if not isinstance(e.content, str)),
+                "decoded_entries": len(self._decoded),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+extracted_text_cache = ExtractedTextCache(
+    max_bytes=int(float(os.getenv('PP_TEXT_CACHE_MB', '256')) * 1024 * 1024),
+    mmap_threshold=int(float(os.getenv('PP_TEXT_CACHE_MMAP_KB', '1024')) * 1024),
+    max_decoded=int(os.getenv('PP_TEXT_CACHE_DECODED', '4')),
+)
@@ -0,0 +1,29 @@
+import re
+
+
+####################################
+# Small text helpers shared by the handler modules
+####################################
+
+CHARS_PER_TOKEN = 4  # rough average for English text with Gemini/GPT tokenizers
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (about 4 characters per token). Good enough for budgets and stats, not for billing."""
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+STOPWORDS = frozenset("""
+a an and are as at be been but by can did do does for from had has have how i if in into is it its me my no not
+of on or our please so than that the their them then there these they this to was we were what when where which
+who why will with would you your about any all also am could should may might must
+""".split())
+
+
+def tokenize(text: str):
+    """Lowercase word tokens with stopwords removed, for the lexical indexes (policy retrieval, email search)."""
+    return [w for w in _WORD_RE.findall(text.lower()) if w not in STOPWORDS]
@@ -0,0 +1,227 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+####################################
+# Persistent email cache
+####################################
+# Every Fetch used to re-authenticate, re-list and re-download the metadata for the whole day, and bodies fetched
+# by handle_select_email were lost on restart. This SQLite cache keeps metadata and bodies keyed by Gmail message
+# id, plus which days have been fully listed and the Gmail history id they are current as of. handle_fetch_emails
+# brings the cache up to date from the Gmail history (only messages added since are downloaded; deleted, trashed
+# and spam messages are dropped), and a day that was listed before is then served from disk. The job postings
+# extracted from each email (ui_job_extraction.py) are kept here too, by message id.
+#
+#     PP_EMAIL_CACHE_PATH   database file (default persistent_data/email_cache.sqlite3)
+#
+# One connection per thread (sqlite3 connections can't be shared between threads), WAL mode so readers never
+# wait for the writer.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    day TEXT,
+    sender TEXT,
+    subject TEXT,
+    date TEXT,
+    internal_date INTEGER,
+    body TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_day ON messages (day, internal_date);
+CREATE TABLE IF NOT EXISTS synced_days (
+    day TEXT PRIMARY KEY,
+    synced_at REAL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS job_postings (
+    id TEXT PRIMARY KEY,
+    extracted_at REAL,
+    complete INTEGER,
+    summary TEXT,
+    jobs TEXT
+);
+"""
+
+
+class EmailCache:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self.day_hits = 0
+        self.day_misses = 0
+        self.body_hits = 0
+        self.body_misses = 0
+        with self._write_lock:
+            self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- sync bookkeeping ---
+
+    def history_id(self) -> Optional[str]:
+        """The Gmail history id the cache is current as of, or None before the first sync."""
+        row = self._connection().execute("SELECT value FROM sync_state WHERE key = 'history_id'").fetchone()
+        return row['value'] if row else None
+
+    def last_history_sync(self) -> float:
+        row = self._connection().execute("SELECT value FROM sync_state WHERE key = 'history_synced_at'").fetchone()
+        return float(row['value']) if row else 0.0
+
+    def set_history_id(self, history_id: str) -> None:
+        with self._write_lock, self._connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                             [('history_id', str(history_id)), ('history_synced_at', str(time.time()))])
+
+    def is_day_synced(self, day: str) -> bool:
+        synced = self._connection().execute("SELECT 1 FROM synced_days WHERE day = ?", (day,)).fetchone() is not None
+        if synced:
+            self.day_hits += 1
+        else:
+            self.day_misses += 1
+        return synced
+
+    def forget_synced_days(self) -> None:
+        '''Called when the history can't be replayed (Gmail keeps about a week of it): every day is listed afresh.
+        Cached bodies are kept, so re-listing a day still doesn't download them again.'''
+        with self._write_lock, self._connection() as conn:
+            conn.execute("DELETE FROM synced_days")
+            conn.execute("DELETE FROM sync_state")
+
+    # --- messages ---
+
+    def metadata_for(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        """Cached metadata of whichever of ids the cache has, by id."""
+        ids = list(ids)
+        found = {}
+        conn = self._connection()
+        for start in range(0, len(ids), 500):  # stay under SQLite's bound variable limit
+            chunk = ids[start:start + 500]
+            rows = conn.execute("SELECT id, sender, subject, date, internal_date FROM messages "
+                                f"WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            found.update((r['id'], _metadata(r)) for r in rows)
+        return found
+
+    def put_metadata(self, metadata: Iterable[dict], day: Optional[str] = None) -> None:
+        '''Insert or update metadata rows, keeping any cached body. day is the listing the rows came from, if any.'''
+        rows = [(m['id'], day, m['sender'], m['subject'], m['date'], int(m.get('internal_date') or 0))
+                for m in metadata]
+        with self._write_lock, self._connection() as conn:
+            conn.executemany(
+                """INSERT INTO messages (id, day, sender, subject, date, internal_date) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET day = COALESCE(excluded.day, messages.day), sender = excluded.sender,
+                   subject = excluded.subject, date = excluded.date, internal_date = excluded.internal_date""",
+                rows)
+
+    def mark_day_synced(self, day: str, ids: List[str]) -> None:
+        '''Record that ids is the complete listing of day: they are assigned to it, anything else is dropped from it.'''
+        with self._write_lock, self._connection() as conn:
+            conn.execute("DELETE FROM messages WHERE day = ? AND id NOT IN (SELECT value FROM json_each(?))",
+                         (day, _json_list(ids)))
+            conn.execute("UPDATE messages SET day = ? WHERE id IN (SELECT value FROM json_each(?))", (day, _json_list(ids)))
+            conn.execute("INSERT OR REPLACE INTO synced_days (day, synced_at) VALUES (?, ?)", (day, time.time()))
+
+    def delete_messages(self, ids: Iterable[str]) -> None:
+        ids = _json_list(ids)
+        with self._write_lock, self._connection() as conn:
+            conn.execute("DELETE FROM messages WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+            conn.execute("DELETE FROM job_postings WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+
+    def messages_for_day(self, day: str) -> List[Dict]:
+        """Metadata of the day's messages, newest first (bodies are left out, see get_body)."""
+        rows = self._connection().execute(
+            "SELECT id, sender, subject, date, internal_date FROM messages WHERE day = ? ORDER BY internal_date DESC",
+            (day,))
+        return [_metadata(r) for r in rows]
+
+    def iter_messages(self, chunk: int = 500) -> Iterator[Tuple[Dict, Optional[str]]]:
+        """(metadata, body or None) of every cached message, a chunk at a time so the writer isn't held up."""
+        last = ''
+        while True:
+            rows = self._connection().execute(
+                "SELECT id, sender, subject, date, internal_date, body FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                (last, chunk)).fetchall()
+            if not rows:
+                return
+            for r in rows:
+                yield _metadata(r), r['body']
+            last = rows[-1]['id']
+
+    def get_body(self, message_id: str, count: bool = True) -> Optional[str]:
+        row = self._connection().execute("SELECT body FROM messages WHERE id = ?", (message_id,)).fetchone()
+        body = row['body'] if row else None
+        if count:  # selections count towards the hit rate, background readers don't
+            if body is None:
+                self.body_misses += 1
+            else:
+                self.body_hits += 1
+        return body
+
+    def has_body(self, message_id: str) -> bool:
+        """Like get_body(...) is not None, without counting towards the hit/miss stats."""
+        return self._connection().execute(
+            "SELECT 1 FROM messages WHERE id = ? AND body IS NOT NULL", (message_id,)).fetchone() is not None
+
+    def put_body(self, message_id: str, body: str) -> None:
+        with self._write_lock, self._connection() as conn:
+            conn.execute("UPDATE messages SET body = ? WHERE id = ?", (body, message_id))
+
+    # --- extracted job postings ---
+
+    def get_jobs(self, message_id: str) -> Optional[Dict]:
+        '''{'summary', 'jobs', 'complete'} extracted from the email, or None if it hasn't been yet.'''
+        row = self._connection().execute("SELECT summary, jobs, complete FROM job_postings WHERE id = ?",
+                                         (message_id,)).fetchone()
+        if row is None:
+            return None
+        return {'summary': row['summary'], 'jobs': json.loads(row['jobs']), 'complete': bool(row['complete'])}
+
+    def has_jobs(self, message_id: str) -> bool:
+        return self._connection().execute("SELECT 1 FROM job_postings WHERE id = ?", (message_id,)).fetchone() is not None
+
+    def put_jobs(self, message_id: str, summary: str, jobs: List[Dict], complete: bool) -> None:
+        with self._write_lock, self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO job_postings (id, extracted_at, complete, summary, jobs) VALUES (?, ?, ?, ?, ?)",
+                         (message_id, time.time(), int(complete), summary, json.dumps(jobs)))
+
+    def stats(self) -> dict:
+        conn = self._connection()
+        return {
+            "messages": conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+            "bodies": conn.execute("SELECT COUNT(*) FROM messages WHERE body IS NOT NULL").fetchone()[0],
+            "synced_days": conn.execute("SELECT COUNT(*) FROM synced_days").fetchone()[0],
+            "job_extractions": conn.execute("SELECT COUNT(*) FROM job_postings").fetchone()[0],
+            "day_hits": self.day_hits,
+            "day_misses": self.day_misses,
+            "body_hits": self.body_hits,
+            "body_misses": self.body_misses,
+        }
+
+
+def _metadata(row: sqlite3.Row) -> Dict:
+    return {'id': row['id'], 'sender': row['sender'], 'subject': row['subject'], 'date': row['date'],
+            'internal_date': str(row['internal_date'])}
+
+
+def _json_list(values: Iterable[str]) -> str:
+    return json.dumps(list(values))
+
+
+email_cache = EmailCache(os.getenv('PP_EMAIL_CACHE_PATH',
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'email_cache.sqlite3')))
@@ -2,20 +2,17 @@ from dataclasses import dataclass # decorator that automatically adds special me
 from typing import List, Optional, Dict # Optional is used for type hinting to indicate that a value might be of a certain type or None.
 
 from pathlib import Path
+import threading
 
 
-# Singleton class to manage the overall session state
-### ----->>>>> VERSION AS OF 7/24/2024 IS NOT THREAD SAFE
+# Class to manage the state of a single user session.
+# One instance exists per session; instances are created and looked up by SessionStore (ui_session_store.py),
+# keyed by the session cookie, so many users can be served by one process without sharing state.
 class SessionData:
 
-    _instance = None  # Class variable to hold the single instance
-
-    def __new__(cls):
-        # Ensure only one instance of SessionData is created
-        if cls._instance is None: # This checks if an instance of SessionData has already been created.
-            cls._instance = super(SessionData, cls).__new__(cls) #If no instance exists, this creates a new instance using the superclass's new method.
-            cls._instance._initialize()
-        return cls._instance
+    def __init__(self):
+        self._initialize()
+        self.lock = threading.RLock()  # serializes requests that mutate this session (focus, selection, clear, email fetch)
 
     def _initialize(self):
         """Initialize instance variables."""
@@ -28,6 +25,9 @@ class SessionData:
         self.policy_list: Optional[UserPolicies] = None
         self.selected_policy: Optional[Policy] = None # used whenever user selects a new policy
         self.selected_policy_index = None # ints can be initialized to None
+        self.memory = None # this session's conversation memory, created by handle_focus
+        self.fetched_emails: List[Dict] = [] # emails fetched for this session by handle_fetch_emails
+        self.current_email_index = 0
         
 
     def __repr__(self) -> str:
@@ -44,6 +44,9 @@ class SessionData:
         self.policy_list: Optional[UserPolicies] = None
         self.selected_policy: Optional[Policy] = None 
         self.selected_policy_index = None
+        self.memory = None
+        self.fetched_emails = []
+        self.current_email_index = 0
        
     def set_initialized_to_true(self):
         """Set the session as initialized."""
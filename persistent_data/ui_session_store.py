@@ -0,0 +1,122 @@
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from persistent_data.ui_session_data_mgmt import SessionData
+
+
+# Process-wide store of per-session state, keyed by the session id carried in the browser's session cookie.
+# Sessions are spread over a fixed number of shards, each with its own lock, so requests from different
+# users only contend when their ids hash to the same shard, and never while a chat stream is running
+# (the lock is held only to look up, insert or evict an entry, not while the session is being used or built:
+# building one runs handle_focus, which can hash and queue PDFs, and on_remove runs after the lock is released).
+
+
+@dataclass
+class _SessionEntry:
+    session: SessionData
+    last_seen: float
+
+
+class _SessionShard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, _SessionEntry] = {}
+        self.last_eviction = time.monotonic()
+
+
+class SessionStore:
+
+    def __init__(self,
+                 session_factory: Callable[[str], SessionData],
+                 num_shards: int = 16,
+                 max_idle_seconds: float = 4 * 60 * 60,
+                 evict_interval_seconds: float = 60,
+                 on_remove: Optional[Callable[[str], None]] = None):
+        '''
+        session_factory: called with a new session id, returns a fully initialized SessionData for it
+        num_shards: number of independently locked partitions
+        max_idle_seconds: sessions not touched for this long are dropped (their memory and emails with them)
+        evict_interval_seconds: how often each shard looks for idle sessions
+        on_remove: called with the session id after a session is removed or evicted (to drop per-session caches)
+        '''
+        self.session_factory = session_factory
+        self.max_idle_seconds = max_idle_seconds
+        self.evict_interval_seconds = evict_interval_seconds
+        self.on_remove = on_remove
+        self._shards: List[_SessionShard] = [_SessionShard() for _ in range(max(1, num_shards))]
+
+    @staticmethod
+    def new_session_id() -> str:
+        return secrets.token_urlsafe(18)
+
+    def _shard_for(self, session_id: str) -> _SessionShard:
+        return self._shards[hash(session_id) % len(self._shards)]
+
+    def get(self, session_id: str) -> Optional[SessionData]:
+        """Return the session for session_id, or None if it doesn't exist (or was evicted)."""
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            entry = shard.sessions.get(session_id)
+            if entry is None:
+                return None
+            entry.last_seen = time.monotonic()
+            return entry.session
+
+    def get_or_create(self, session_id: str) -> Tuple[SessionData, bool]:
+        '''Return (session, created). The factory runs outside the shard lock; if two requests build the same
+        session at once, the first one stored is kept and returned to both.'''
+        shard = self._shard_for(session_id)
+        now = time.monotonic()
+        evicted = []
+        with shard.lock:
+            entry = shard.sessions.get(session_id)
+            if entry is not None:
+                entry.last_seen = now
+                return entry.session, False
+            if now - shard.last_eviction >= self.evict_interval_seconds:
+                evicted = self._evict_idle_locked(shard, now)
+        self._removed(evicted)
+
+        session = self.session_factory(session_id)
+        with shard.lock:
+            entry = shard.sessions.setdefault(session_id, _SessionEntry(session, time.monotonic()))
+            entry.last_seen = time.monotonic()
+        return entry.session, entry.session is session
+
+    def remove(self, session_id: str) -> bool:
+        shard = self._shard_for(session_id)
+        with shard.lock:
+            removed = shard.sessions.pop(session_id, None) is not None
+        if removed:
+            self._removed([session_id])
+        return removed
+
+    def evict_idle(self) -> int:
+        """Drop every session idle for longer than max_idle_seconds. Returns the number removed."""
+        now = time.monotonic()
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                evicted = self._evict_idle_locked(shard, now)
+            self._removed(evicted)
+            removed += len(evicted)
+        return removed
+
+    def _evict_idle_locked(self, shard: _SessionShard, now: float) -> List[str]:
+        '''Drop the shard's idle sessions and return their ids, for the caller to pass to _removed after unlocking.'''
+        shard.last_eviction = now
+        idle = [sid for sid, entry in shard.sessions.items() if now - entry.last_seen > self.max_idle_seconds]
+        for sid in idle:
+            del shard.sessions[sid]
+        return idle
+
+    def _removed(self, session_ids: List[str]) -> None:
+        if self.on_remove:
+            for sid in session_ids:
+                self.on_remove(sid)
+
+    def __len__(self) -> int:
+        return sum(len(shard.sessions) for shard in self._shards)
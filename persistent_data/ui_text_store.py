@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+####################################
+# Content-addressed extracted text store
+####################################
+# Extracted text used to be written next to the PDF and only recorded on the session's Policy object, so every new
+# session, and every user who owns the same file, extracted the PDF again. This store keeps the extracted text of
+# each PDF under the sha256 of the PDF's bytes, so identical PDFs are extracted once per deployment wherever they
+# were uploaded, along with what is derived from the text:
+#
+#     <digest[:2]>/<digest>.txt    the extracted text (the extraction worker writes it here directly)
+#     <digest[:2]>/<digest>.json   document type, character offset of each page, the retrieval sections' spans
+#
+# The .json is written last, atomically, so a digest whose .json exists is complete. A PDF's digest is remembered
+# by (path, mtime, size), so a lookup only hashes a file once per version of it and is then a dict lookup.
+#
+#     PP_TEXT_STORE_DIR   store directory (default persistent_data/extracted_text)
+
+
+@dataclass
+class StoredText:
+    digest: str
+    text_path: str
+    document_type: Optional[str]
+    text_chars: int
+    page_offsets: List[int]                 # character offset of the start of each page
+    sections: List[List[Tuple[int, int]]]   # spans of each retrieval section (see ui_policy_retrieval.py)
+    section_chars: int                      # the section size the spans were chunked for
+    stored_at: float
+
+
+class ExtractedTextStore:
+
+    def __init__(self, root: str):
+        self.root = root
+        self._digests: Dict[tuple, str] = {}          # (pdf path, mtime, size) -> sha256 of its bytes
+        self._entries: Dict[str, StoredText] = {}     # digest -> its entry, once read
+        self._lock = threading.Lock()
+        self.hashed = 0
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def digest(self, pdf_path: str) -> str:
+        stat = os.stat(pdf_path)
+        key = (os.path.abspath(pdf_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._digests.get(key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(pdf_path, 'rb') as file:
+                for block in iter(lambda: file.read(1024 * 1024), b''):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            with self._lock:
+                self._digests[key] = digest
+                self.hashed += 1
+        return digest
+
+    def text_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + '.txt')
+
+    def new_text_path(self, digest: str) -> str:
+        '''text_path(digest), with its directory created for the extraction worker to write to.'''
+        path = self.text_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _meta_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + '.json')
+
+    def get(self, digest: str) -> Optional[StoredText]:
+        with self._lock:
+            entry = self._entries.get(digest)
+        if entry is None:
+            try:
+                with open(self._meta_path(digest), encoding='utf-8') as file:
+                    meta = json.load(file)
+            except (FileNotFoundError, ValueError):
+                meta = None
+            if meta is not None and os.path.exists(self.text_path(digest)):
+                entry = StoredText(digest=digest, text_path=self.text_path(digest),
+                                   document_type=meta.get('document_type'), text_chars=meta['text_chars'],
+                                   page_offsets=meta['page_offsets'],
+                                   sections=[[tuple(span) for span in spans] for spans in meta['sections']],
+                                   section_chars=meta['section_chars'], stored_at=meta['stored_at'])
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries[digest] = entry
+                self.hits += 1
+        return entry
+
+    def lookup(self, pdf_path: str) -> Optional[StoredText]:
+        '''The stored text of the PDF at pdf_path, or None if no PDF with the same bytes has been extracted.'''
+        return self.get(self.digest(pdf_path))
+
+    def put(self, digest: str, document_type: Optional[str], text: str, sections: List[List[Tuple[int, int]]],
+            section_chars: int, page_offsets: Optional[List[int]] = None) -> StoredText:
+        '''Record the text extracted to text_path(digest). Without page_offsets, pages are taken to be separated
+        by form feeds, as pdftotext and Tesseract write them.'''
+        if page_offsets is None:
+            page_offsets = [0] + [i + 1 for i, char in enumerate(text) if char == '\f' and i + 1 < len(text)]
+        entry = StoredText(digest=digest, text_path=self.text_path(digest), document_type=document_type,
+                           text_chars=len(text), page_offsets=page_offsets, sections=sections,
+                           section_chars=section_chars, stored_at=time.time())
+        meta = {'document_type': document_type, 'text_chars': entry.text_chars, 'page_offsets': page_offsets,
+                'sections': sections, 'section_chars': section_chars, 'stored_at': entry.stored_at}
+        path = self._meta_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        with open(partial, 'w', encoding='utf-8') as file:
+            json.dump(meta, file, separators=(',', ':'))
+        os.replace(partial, path)
+        with self._lock:
+            self._entries[digest] = entry
+            self.stored += 1
+        return entry
+
+    def stored_sections(self, text_path: str, text: str, section_chars: int) -> Optional[List[List[Tuple[int, int]]]]:
+        '''The section spans stored with text_path, if it is one of the store's files, text is what it holds and the
+        spans were chunked for section_chars.'''
+        name = os.path.basename(text_path)
+        if not name.endswith('.txt') or os.path.abspath(text_path) != os.path.abspath(self.text_path(name[:-4])):
+            return None
+        entry = self.get(name[:-4])
+        if entry is None or entry.text_chars != len(text) or entry.section_chars != section_chars:
+            return None
+        return entry.sections
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hashed": self.hashed,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stored": self.stored,
+            }
+
+
+text_store = ExtractedTextStore(os.getenv('PP_TEXT_STORE_DIR',
+                                          os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_text')))
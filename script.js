@@ -11,6 +11,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const fetchEmailsButton = document.getElementById('fetchEmails');
     const emailCount = document.getElementById('emailCount');
     const emailList = document.getElementById('emailList');
+    const emailSearchInput = document.getElementById('emailSearch');
 
     console.log("submitQuery:", submitQuery);
     console.log("clearConversation:", clearConversation);
@@ -25,9 +26,12 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     let eventSource;
-    let currentEmailBody = "";  // Store the current email body for LLM context
+    let currentEmailBody = "";  // Body of the selected email (the server adds it to questions itself)
     let fetchedEmails = [];  // Store all fetched emails
     let activeEmailIndex = -1;  // Currently active email index
+    let emailStream = null;  // EventSource of the email list being fetched
+    let emailSearchTimer = null;  // Debounces searches while the user types
+    let emailSearchSeq = 0;  // Only the latest search's results are shown
 
     function initUI() {
         console.log("Initializing Prompt Playground");
@@ -57,26 +61,15 @@ document.addEventListener('DOMContentLoaded', function() {
                 eventSource.close();
             }
 
-            // Build the full query with email context if available
-            let fullQuery = query;
-            if (activeEmailIndex >= 0 && currentEmailBody) {
-                const email = fetchedEmails[activeEmailIndex];
-                // Email is loaded, prepend full context including body
-                const emailContext = `[EMAIL CONTEXT]
-From: ${email.sender}
-Subject: ${email.subject}
-Date: ${email.date}
-
-Body:
-${currentEmailBody}
-
-[USER QUESTION]
-`;
-                fullQuery = emailContext + query;
-                console.log('Injecting email context with body into query');
+            // The selected email goes by reference: the server adds its sender, subject, date and body
+            let chatUrl = '/api/chat?message=' + encodeURIComponent(query);
+            if (activeEmailIndex >= 0 && fetchedEmails[activeEmailIndex]) {
+                chatUrl += '&email_index=' + activeEmailIndex +
+                           '&email_id=' + encodeURIComponent(fetchedEmails[activeEmailIndex].id || '');
+                console.log('Asking about email', activeEmailIndex);
             }
 
-            eventSource = new EventSource('/api/chat?message=' + encodeURIComponent(fullQuery));
+            eventSource = new EventSource(chatUrl);
 
             let botMessage = document.createElement('div');
             botMessage.className = 'message bot-message';
@@ -115,6 +108,34 @@ ${currentEmailBody}
             };
             
             
+            // The selected policy is still being extracted from its PDF: the answer starts once it is done
+            let provisional = false;  // an answer from the pages read so far is on screen, the final one follows it
+            eventSource.addEventListener('extracting', function(event) {
+                const job = JSON.parse(event.data);
+                if (provisional) {
+                    return;
+                }
+                if (job.status === 'queued' || job.status === 'running') {
+                    const pages = job.pages ? `, ${job.pages} pages` : '';
+                    botMessage.innerHTML = `Reading the policy document... (${Math.round(job.elapsed_s)}s${pages})`;
+                } else if (job.status === 'done') {
+                    botMessage.innerHTML = 'Bot is typing...';
+                }
+            });
+
+            // A long policy is answered from its first pages while the rest is read
+            eventSource.addEventListener('provisional', function(event) {
+                const info = JSON.parse(event.data);
+                provisional = true;
+                accumulatedMarkdown = `*From the first ${info.pages} pages of the policy, while the rest is read:*\n\n`;
+                botMessage.innerHTML = DOMPurify.sanitize(marked.parse(accumulatedMarkdown));
+            });
+
+            eventSource.addEventListener('final', function(event) {
+                accumulatedMarkdown += '\n\n---\n\n*With the whole policy:*\n\n';
+                botMessage.innerHTML = DOMPurify.sanitize(marked.parse(accumulatedMarkdown));
+            });
+
             eventSource.onerror = function(error) {
                 console.error('EventSource failed:', error);
                 eventSource.close();
@@ -181,44 +202,94 @@ ${currentEmailBody}
         const dateValue = emailDateInput.value || getTodayDate();
         console.log('Fetching emails for date:', dateValue);
 
+        // A fetch still streaming in is for the old date
+        if (emailStream) {
+            emailStream.close();
+        }
+
         // Clear current list
+        if (emailSearchInput) {
+            emailSearchInput.value = '';
+        }
         emailList.innerHTML = '<div style="padding: 10px; text-align: center; color: #999;">Loading...</div>';
         emailCount.textContent = '';
+        fetchedEmails = [];
+        activeEmailIndex = -1;
+        currentEmailBody = "";
+
+        // Emails arrive one 'email' event at a time as Gmail answers, then an 'order' event ends the list
+        const stream = new EventSource('/api/fetch_emails_stream?date=' + encodeURIComponent(dateValue));
+        emailStream = stream;
+        const streamedEmails = {};  // id -> email
+        let received = 0;
+
+        stream.addEventListener('email', function(event) {
+            const email = JSON.parse(event.data);
+            if (received === 0) {
+                emailList.innerHTML = '';
+            }
+            received += 1;
+            streamedEmails[email.id] = email;
+            fetchAllEmailMetadata([email], true);
+            emailCount.textContent = `${received} email${received > 1 ? 's' : ''} so far...`;
+        });
 
-        fetch('/api/fetch_emails?date=' + encodeURIComponent(dateValue))
-            .then(response => response.json())
-            .then(data => {
-                console.log('Fetch emails response:', data);
-                if (data.success) {
-                    if (data.count > 0) {
-                        emailCount.textContent = `${data.count} email${data.count > 1 ? 's' : ''}`;
+        stream.addEventListener('order', function(event) {
+            stream.close();
+            emailStream = null;
+            const data = JSON.parse(event.data);
+            console.log('Fetch emails response:', data.message);
+            if (data.count > 0) {
+                emailCount.textContent = `${data.count} email${data.count > 1 ? 's' : ''}`;
 
-                        // Backend returns all emails sorted by date (newest first)
-                        fetchAllEmailMetadata(data.emails);
-                    } else {
-                        emailCount.textContent = data.message;
-                        emailList.innerHTML = '<div style="padding: 10px; text-align: center; color: #999;">No emails found</div>';
-                    }
-                } else {
-                    alert('Error fetching emails: ' + data.error);
-                    emailList.innerHTML = '';
-                }
-            })
-            .catch(error => {
-                console.error('Error fetching emails:', error);
+                // Backend sends the ids sorted by date (newest first); indices match the session's list from now on
+                fetchAllEmailMetadata(data.ids.map(id => streamedEmails[id]));
+            } else {
+                emailCount.textContent = data.message;
+                emailList.innerHTML = '<div style="padding: 10px; text-align: center; color: #999;">No emails found</div>';
+            }
+        });
+
+        stream.addEventListener('error', function(event) {
+            stream.close();
+            if (emailStream === stream) {
+                emailStream = null;
+            }
+            if (event.data) {
+                alert('Error fetching emails: ' + JSON.parse(event.data).error);
+            } else {
+                console.error('Error fetching emails:', event);
                 alert('Failed to fetch emails. See console for details.');
-                emailList.innerHTML = '';
-            });
+            }
+            emailList.innerHTML = '';
+        });
     }
 
-    function fetchAllEmailMetadata(emailsData) {
+    function fetchAllEmailMetadata(emailsData, partial = false) {
+        if (partial) {
+            // Still streaming in: rows are placed by date but can't be selected until the final order arrives
+            emailsData.forEach(email => addEmailToList(email));
+            return;
+        }
+
         // Backend returns all emails already sorted by date (newest first)
         fetchedEmails = emailsData;
+
+        // Rows that streamed in are moved into place; anything else is added
+        const rows = {};
+        emailList.querySelectorAll('.email-item').forEach(item => {
+            rows[item.dataset.id] = item;
+        });
         emailList.innerHTML = '';
 
-        // Add all emails to the list
         emailsData.forEach((email, index) => {
-            addEmailToList(email, index);
+            const row = rows[email.id];
+            if (row) {
+                row.dataset.index = index;
+                emailList.appendChild(row);
+            } else {
+                addEmailToList(email, index);
+            }
         });
 
         // Select first email (newest)
@@ -230,7 +301,13 @@ ${currentEmailBody}
     function addEmailToList(email, index) {
         const emailItem = document.createElement('div');
         emailItem.className = 'email-item';
-        emailItem.dataset.index = index;
+        if (index !== undefined) {
+            emailItem.dataset.index = index;
+        }
+        if (email.id) {
+            emailItem.dataset.id = email.id;
+        }
+        emailItem.dataset.internalDate = email.internal_date || 0;
 
         const sender = document.createElement('div');
         sender.className = 'email-item-sender';
@@ -248,9 +325,21 @@ ${currentEmailBody}
         emailItem.appendChild(subject);
         emailItem.appendChild(date);
 
-        emailItem.addEventListener('click', () => selectEmail(index));
+        emailItem.addEventListener('click', () => {
+            if (emailItem.dataset.index !== undefined) {
+                selectEmail(Number(emailItem.dataset.index));
+            }
+        });
+
+        if (index !== undefined) {
+            emailList.appendChild(emailItem);
+            return;
+        }
 
-        emailList.appendChild(emailItem);
+        // Streamed in: keep newest first
+        const newer = Number(emailItem.dataset.internalDate);
+        const next = Array.from(emailList.children).find(item => Number(item.dataset.internalDate) < newer);
+        emailList.insertBefore(emailItem, next || null);
     }
 
     function selectEmail(index) {
@@ -299,6 +388,49 @@ ${currentEmailBody}
         }
     }
 
+    function searchEmails() {
+        const query = emailSearchInput.value.trim();
+        const rows = Array.from(emailList.querySelectorAll('.email-item[data-index]'));
+        const seq = ++emailSearchSeq;
+
+        if (!query) {
+            // Back to the whole list, newest first
+            rows.sort((a, b) => Number(a.dataset.index) - Number(b.dataset.index));
+            rows.forEach(row => {
+                row.style.display = '';
+                emailList.appendChild(row);
+            });
+            if (fetchedEmails.length > 0) {
+                emailCount.textContent = `${fetchedEmails.length} email${fetchedEmails.length > 1 ? 's' : ''}`;
+            }
+            return;
+        }
+
+        // Ranked on the server over sender, subject and body; matches move to the top in rank order
+        fetch('/api/search_emails?scope=day&q=' + encodeURIComponent(query))
+            .then(response => response.json())
+            .then(data => {
+                if (seq !== emailSearchSeq || !data.success) {
+                    return;
+                }
+                const byIndex = {};
+                rows.forEach(row => {
+                    byIndex[row.dataset.index] = row;
+                    row.style.display = 'none';
+                });
+                data.results.forEach(result => {
+                    const row = byIndex[result.index];
+                    if (row) {
+                        row.style.display = '';
+                        emailList.appendChild(row);
+                    }
+                });
+                emailCount.textContent = `${data.count} match${data.count === 1 ? '' : 'es'}` +
+                    (data.complete ? '' : ' (still indexing)');
+            })
+            .catch(error => console.error('Error searching emails:', error));
+    }
+
     function getTodayDate() {
         const today = new Date();
         const year = today.getFullYear();
@@ -328,6 +460,12 @@ ${currentEmailBody}
 
     // Email event listeners
     if (fetchEmailsButton) fetchEmailsButton.addEventListener('click', handleFetchEmails);
+    if (emailSearchInput) {
+        emailSearchInput.addEventListener('input', function() {
+            clearTimeout(emailSearchTimer);
+            emailSearchTimer = setTimeout(searchEmails, 150);
+        });
+    }
 
     // Initialize the UI when the page loads
     initUI();
@@ -0,0 +1,36 @@
+import importlib
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+# The modules under test are imported the way the server imports them, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Importing the email cache and the text store opens their default locations; keep the tests' ones out of
+# persistent_data
+_scratch = tempfile.mkdtemp(prefix='pp-tests-')
+os.environ.setdefault('PP_EMAIL_CACHE_PATH', os.path.join(_scratch, 'email_cache.sqlite3'))
+os.environ.setdefault('PP_TEXT_STORE_DIR', os.path.join(_scratch, 'extracted_text'))
+
+
+@pytest.fixture
+def handler_functions(monkeypatch, tmp_path):
+    '''handlers.ui_handler_functions imported afresh, as a new server process has it: fake model and mailbox, and
+    nothing built yet.'''
+    for name, value in {'PP_MODEL_BACKEND': 'fake', 'PP_EMAIL_SOURCE': 'fake', 'PP_FAKE_TTFT_MS': '0',
+                        'PP_FAKE_TOKEN_MS': '0', 'PP_FAKE_GMAIL_LATENCY_MS': '0'}.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.delenv('GOOGLE_API_KEY', raising=False)
+    try:
+        importlib.import_module('config')
+    except ImportError:
+        # config.py holds each deployment's policy file locations and isn't part of the repository
+        config = types.ModuleType('config')
+        config.get_policy_file_path = lambda name: str(tmp_path / 'policies' / name)
+        monkeypatch.setitem(sys.modules, 'config', config)
+    for name in ('handlers.ui_handler_functions', 'handlers.ui_fake_gmail', 'server_data.ui_server_side_data'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    return importlib.import_module('handlers.ui_handler_functions')
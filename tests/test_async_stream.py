@@ -0,0 +1,85 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+from handlers.ui_async_stream import StreamStats, stream_sse
+import handlers.ui_async_stream as async_stream
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = StreamStats()
+    monkeypatch.setattr(async_stream, 'stream_stats', stats)
+    return stats
+
+
+def producer(chunks, cancelled, stall=False):
+    '''An answer stream like ahandle_query's; sets cancelled if it is cancelled while it waits on the "model".'''
+    async def generate():
+        try:
+            for chunk in chunks:
+                await asyncio.sleep(0.01)
+                yield chunk
+            if stall:
+                await asyncio.sleep(30)  # the model still thinking
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+    return generate()
+
+
+def test_completed_stream(stats):
+    server, client = socket.socketpair()
+    written = []
+    with server, client:
+        assert stream_sse(producer(["The deductible", " is $500.", "DONE"], threading.Event()),
+                          written.append, server)
+    assert written == ["The deductible", " is $500.", "DONE"]
+    assert (stats.completed, stats.abandoned, stats.failed) == (1, 0, 0)
+
+
+def test_disconnect_cancels_the_producer(stats):
+    server, client = socket.socketpair()
+    cancelled = threading.Event()
+    written = []
+
+    def write_event(chunk):
+        written.append(chunk)
+        if len(written) == 2:
+            client.close()  # the browser closes the EventSource mid-answer
+
+    with server:
+        completed = stream_sse(producer(["The", " deductible", " is"], cancelled, stall=True), write_event, server,
+                               poll_interval=0.05)
+
+    assert not completed
+    assert cancelled.wait(5)
+    assert (stats.completed, stats.abandoned, stats.failed) == (0, 1, 0)
+    assert stats.snapshot()["in_flight"] == 0
+
+
+def test_broken_pipe_cancels_the_producer(stats):
+    server, client = socket.socketpair()
+    cancelled = threading.Event()
+
+    def write_event(chunk):
+        raise BrokenPipeError()
+
+    with server, client:
+        assert not stream_sse(producer(["The", " deductible"], cancelled, stall=True), write_event, server)
+    assert cancelled.wait(5)
+    assert stats.abandoned == 1
+
+
+def test_producer_errors_are_counted_as_failures(stats):
+    async def failing():
+        yield "The"
+        raise RuntimeError("model unavailable")
+
+    server, client = socket.socketpair()
+    with server, client, pytest.raises(RuntimeError):
+        stream_sse(failing(), lambda chunk: None, server)
+    assert (stats.completed, stats.abandoned, stats.failed) == (0, 0, 1)
+    assert stats.snapshot()["in_flight"] == 0
@@ -0,0 +1,164 @@
+import http.client
+import importlib
+import json
+import sys
+import threading
+
+import pytest
+
+import handlers.ui_gmail_fetch as gmail_fetch
+from handlers.ui_email_context import email_body_text, email_header
+from persistent_data.ui_email_cache import email_cache
+
+
+@pytest.fixture
+def server(handler_functions, monkeypatch):
+    '''ui_Chatbot_prototype imported as a module, its MyHandler served on a free port for user1, as the benchmarks do.'''
+    monkeypatch.setattr(gmail_fetch, 'gmail_rate_limiter', gmail_fetch.RateLimiter(0))
+    monkeypatch.delitem(sys.modules, 'ui_Chatbot_prototype', raising=False)
+    chatbot = importlib.import_module('ui_Chatbot_prototype')
+    server_user_data = chatbot.create_server_user_data()
+
+    def create_session(session_id):
+        session_state = chatbot.SessionData()
+        chatbot.handle_focus(session_state, 'user1', session_id, server_user_data)
+        return session_state
+
+    monkeypatch.setattr(chatbot, 'server_user_data', server_user_data)
+    monkeypatch.setattr(chatbot, 'session_store', chatbot.SessionStore(create_session))
+    httpd = chatbot.BoundedThreadingHTTPServer(("127.0.0.1", 0), chatbot.MyHandler, max_workers=4)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield Client(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+class Client:
+    '''Requests to the test server that keep the session cookie, like the browser page.'''
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+
+    def _request(self, path):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        connection.request("GET", path, headers={"Cookie": self.cookie} if self.cookie else {})
+        response = connection.getresponse()
+        set_cookie = response.getheader('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';')[0]
+        return connection, response
+
+    def get(self, path):
+        connection, response = self._request(path)
+        body = response.read().decode('utf-8')
+        connection.close()
+        return response, body
+
+    def stream(self, path, last_events):
+        '''An event stream's frames up to the first one whose event is in last_events. The connection is kept alive
+        after a stream, so the page (and this client) stops reading there.'''
+        connection, response = self._request(path)
+        assert response.status == 200
+        assert response.getheader('Content-type') == 'text/event-stream'
+        frames, lines = [], []
+        try:
+            while True:
+                line = response.fp.readline().decode('utf-8')
+                assert line, "the stream ended without a final event"
+                if line != "\n":
+                    lines.append(line.rstrip("\n"))
+                    continue
+                fields = dict(field.split(": ", 1) for field in lines)
+                assert set(fields) <= {"event", "data"}, lines
+                lines = []
+                frames.append((fields.get("event", "message"), fields["data"]))
+                if frames[-1][0] in last_events or frames[-1][1] in last_events:
+                    return frames
+        finally:
+            connection.close()
+
+    def get_json(self, path):
+        response, body = self.get(path)
+        assert response.status == 200
+        return json.loads(body)
+
+
+def test_imported_module_serves_sessions(server):
+    first = server.get_json('/api/init')
+    assert first['firstName']
+    assert server.cookie.startswith('pp_session=')
+
+    cookie = server.cookie
+    assert server.get_json('/api/init') == first
+    assert server.cookie == cookie  # found again through the cookie, not started anew
+    assert server.get_json('/api/stats')['sessions'] == 1
+
+
+def test_email_list_streams_each_email_then_the_order(server):
+    frames = [(event, json.loads(data))
+              for event, data in server.stream('/api/fetch_emails_stream?date=2023-10-02', {'order', 'error'})]
+    *emails, (last_event, order) = frames
+    assert last_event == 'order'
+    assert emails and all(event == 'email' for event, _ in emails)
+    assert all(set(email) == {'id', 'sender', 'subject', 'date', 'internal_date'} for _, email in emails)
+
+    assert order['success'] and order['count'] == len(emails)
+    assert sorted(order['ids']) == sorted(email['id'] for _, email in emails)
+    dates = {email['id']: int(email['internal_date']) for _, email in emails}
+    assert [dates[i] for i in order['ids']] == sorted(dates.values(), reverse=True)  # newest first
+
+    # The session's list is the one in the order event, so indices mean the same on both sides
+    selected = server.get_json('/api/select_email?index=1')
+    listed = next(email for _, email in emails if email['id'] == order['ids'][1])
+    assert selected['success']
+    assert (selected['email']['sender'], selected['email']['subject']) == (listed['sender'], listed['subject'])
+
+
+def test_email_list_stream_ends_with_an_error_event(server):
+    (event, data), = server.stream('/api/fetch_emails_stream?date=not-a-date', {'order', 'error'})
+    assert event == 'error'
+    assert json.loads(data)['success'] is False
+
+
+def test_chat_about_an_email_gets_its_context_from_the_server(server, handler_functions, monkeypatch):
+    turns = []
+    email_query = handler_functions.email_query
+
+    def recording_email_query(*args):
+        turns.append(email_query(*args))
+        return turns[-1]
+
+    monkeypatch.setattr(handler_functions, 'email_query', recording_email_query)
+    *_, (_, order) = server.stream('/api/fetch_emails_stream?date=2023-10-03', {'order', 'error'})
+    ids = json.loads(order)['ids']
+
+    # The page sends only which email the question is about, by index and id
+    frames = server.stream(f'/api/chat?message=Who+sent+this%3F&email_index=0&email_id={ids[0]}', {'DONE'})
+    assert frames[-1] == ('message', 'DONE')
+    turn, = turns
+    assert turn.email['id'] == ids[0] and turn.mode == 'single'
+    body = email_body_text(email_cache.get_body(ids[0]))
+    assert body and body in turn.model_input
+    assert turn.memory_input.startswith(email_header(turn.email))
+
+    # Only the email's header is kept in the conversation history, not its body
+    history = server.get_json('/api/get_conversation_history')['history']
+    assert [message['type'] for message in history] == ['human', 'ai']
+    assert history[0]['content'] == turn.memory_input and body not in history[0]['content']
+
+
+def test_chat_email_reference_follows_the_id(server, handler_functions, monkeypatch):
+    turns = []
+    email_query = handler_functions.email_query
+    monkeypatch.setattr(handler_functions, 'email_query', lambda *args: turns.append(email_query(*args)) or turns[-1])
+    *_, (_, order) = server.stream('/api/fetch_emails_stream?date=2023-10-04', {'order', 'error'})
+    ids = json.loads(order)['ids']
+
+    # An index from an older list: the id says which email was meant
+    server.stream(f'/api/chat?message=Summarize&email_index=0&email_id={ids[1]}', {'DONE'})
+    # An email that isn't in the list any more: the question is asked on its own
+    server.stream('/api/chat?message=Summarize&email_index=999&email_id=gone', {'DONE'})
+
+    assert turns[0].email['id'] == ids[1]
+    assert (turns[1].mode, turns[1].model_input) == ('none', 'Summarize')
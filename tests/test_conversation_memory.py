@@ -0,0 +1,83 @@
+import threading
+import time
+
+from handlers.ui_conversation_memory import (SUMMARY_PREFIX, SessionConversationMemory, TokenBudgetMemory,
+                                             memory_budget_stats)
+from handlers.ui_text_utils import estimate_tokens
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def history_tokens(messages):
+    return sum(estimate_tokens(str(message.content)) for message in messages)
+
+
+def test_repeated_messages_are_sent_once():
+    memory = SessionConversationMemory()
+    memory.save_context({"input": "What is my deductible?"}, {"output": "$500."})
+    memory.save_context({"input": "What is my deductible?"}, {"output": "Still $500."})
+
+    assert [m.content for m in memory.history_messages()] == ["What is my deductible?", "$500.", "Still $500."]
+    assert len(memory.chat_memory.messages) == 4  # the transcript keeps everything
+
+
+def test_history_stays_within_the_budget_and_older_turns_are_summarized():
+    calls = []
+
+    def summarizer(previous_summary, messages, max_tokens):
+        calls.append([m.content for m in messages])
+        return "The user asked about coverage limits and deductibles. " * 10  # longer than allowed: cut to fit
+
+    memory = TokenBudgetMemory(token_budget=100, summarizer=summarizer)
+    for n in range(10):
+        memory.save_context({"input": f"Question {n}: " + "coverage " * 20}, {"output": f"Answer {n}: " + "limit " * 20})
+        assert history_tokens(memory.history_messages()) <= 100
+
+    assert wait_for(lambda: memory.summary != "" and not memory._summarizing)
+    history = memory.history_messages()
+    assert history[0].content.startswith(SUMMARY_PREFIX)
+    assert estimate_tokens(history[0].content) == memory.summary_tokens <= memory.max_summary_tokens
+    assert history_tokens(history) <= 100
+    memory.save_context({"input": "And the flood deductible?"}, {"output": "$1,000."})
+    assert history_tokens(memory.history_messages()) <= 100
+    assert history[-1].content.startswith("Answer 9: ")
+    assert calls[0][0].startswith("Question 0: ")
+    assert memory.last_tokens_saved > 0
+
+
+def test_clear_discards_a_summary_still_being_written():
+    started, release = threading.Event(), threading.Event()
+
+    def summarizer(previous_summary, messages, max_tokens):
+        started.set()
+        release.wait(5)
+        return "stale summary"
+
+    memory = TokenBudgetMemory(token_budget=20, summarizer=summarizer)
+    memory.save_context({"input": "word " * 30}, {"output": "word " * 30})
+    assert started.wait(5)
+
+    memory.clear()
+    release.set()
+    time.sleep(0.05)
+
+    assert memory.summary == ""
+    assert memory.history_messages() == []
+
+
+def test_tokens_saved_are_counted_once_per_turn():
+    memory = TokenBudgetMemory(token_budget=30, summarizer=lambda previous, messages, max_tokens: "")
+    before = memory_budget_stats.snapshot()["turns"]
+
+    for n in range(3):
+        memory.history_messages()
+        memory.history_messages()  # a provisional answer reads the history a second time
+        memory.save_context({"input": f"Question {n}: " + "word " * 30}, {"output": "Answer."})
+    memory.save_context({"input": "Saved without a prompt"}, {"output": "-"})
+
+    assert memory_budget_stats.snapshot()["turns"] - before == 3
@@ -0,0 +1,22 @@
+from handlers.ui_email_context import email_body_text, split_segments
+
+
+def test_segments_break_at_paragraphs():
+    text = "\n\n".join(["a" * 40, "b" * 40, "c" * 40])
+    assert split_segments(text, 100) == ["a" * 40 + "\n\n" + "b" * 40, "c" * 40]
+
+
+def test_paragraph_longer_than_a_segment_is_cut():
+    segments = split_segments("intro\n\n" + "x" * 250 + "\n\nend", 100)
+    assert segments == ["intro", "x" * 100, "x" * 100, "x" * 50 + "\n\nend"]
+    assert all(len(segment) <= 100 for segment in segments)
+
+
+def test_short_text_is_one_segment():
+    assert split_segments("Thanks for applying.", 100) == ["Thanks for applying."]
+    assert split_segments("", 100) == []
+
+
+def test_plain_body_whitespace_is_normalized():
+    assert email_body_text("Hi  Dana,\r\n\n\n\n\tSee below. ") == "Hi Dana,\n\nSee below."
+    assert email_body_text(None) == ""
@@ -0,0 +1,97 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from handlers.ui_email_prefetch import PRIORITY_LIST, BodyPrefetcher
+
+
+@contextmanager
+def client():
+    yield "service"
+
+
+class Mailbox:
+    '''Bodies by message id, fetched on request; fetches of ids in hold wait until release() is called.'''
+
+    def __init__(self, hold=()):
+        self.cache = {}
+        self.fetched = []
+        self.hold = set(hold)
+        self.started = threading.Event()
+        self._release = threading.Event()
+
+    def release(self):
+        self._release.set()
+
+    def fetch_body(self, service, message_id):
+        self.fetched.append(message_id)
+        if message_id in self.hold:
+            self.started.set()
+            self._release.wait(5)
+        return f"body of {message_id}"
+
+    def store_body(self, message_id, body):
+        self.cache[message_id] = body
+
+    def schedule(self, prefetcher, message_ids, session_key='session-1'):
+        prefetcher.schedule(session_key, message_ids, PRIORITY_LIST, self.fetch_body, client,
+                            lambda message_id: message_id in self.cache, self.store_body)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_prefetched_bodies_are_served_from_the_cache():
+    mailbox = Mailbox()
+    mailbox.cache['old'] = "body of old"
+    prefetcher = BodyPrefetcher(workers=2)
+
+    mailbox.schedule(prefetcher, ['old', 'a', 'b'])
+    assert wait_for(lambda: prefetcher.stats()["prefetched"] == 2)
+    assert sorted(mailbox.fetched) == ['a', 'b']  # 'old' was cached already
+
+    assert prefetcher.get_body('a', mailbox.cache.get, lambda: "fetched again") == "body of a"
+    assert prefetcher.stats()["hits"] == 1
+
+
+def test_selection_waits_for_a_prefetch_in_flight():
+    mailbox = Mailbox(hold={'a'})
+    prefetcher = BodyPrefetcher(workers=1)
+    mailbox.schedule(prefetcher, ['a'])
+    assert mailbox.started.wait(5)
+
+    threading.Timer(0.05, mailbox.release).start()
+    assert prefetcher.get_body('a', mailbox.cache.get, lambda: "fetched again") == "body of a"
+    assert mailbox.fetched == ['a']
+    assert prefetcher.stats()["inflight_waits"] == 1
+
+
+def test_new_list_drops_prefetches_queued_for_the_old_one():
+    mailbox = Mailbox(hold={'a'})
+    prefetcher = BodyPrefetcher(workers=1)
+    mailbox.schedule(prefetcher, ['a', 'b', 'c'])
+    assert mailbox.started.wait(5)  # the only worker is busy with 'a'
+
+    prefetcher.new_list('session-1')
+    mailbox.release()
+
+    assert wait_for(lambda: prefetcher.stats()["skipped_stale"] == 2)
+    assert mailbox.fetched == ['a']
+    assert prefetcher.stats()["queued"] == 0
+
+
+def test_sessions_are_forgotten_once_their_prefetches_are_taken():
+    mailbox = Mailbox()
+    prefetcher = BodyPrefetcher(workers=2)
+    for n in range(20):
+        prefetcher.new_list(f'session-{n}')
+        mailbox.schedule(prefetcher, [f'{n}-a', f'{n}-b'], session_key=f'session-{n}')
+
+    assert wait_for(lambda: prefetcher.stats()["prefetched"] == 40)
+    assert wait_for(lambda: not prefetcher._generations and not prefetcher._outstanding)
+    prefetcher.new_list('session-without-prefetches')
+    assert prefetcher._generations == {}
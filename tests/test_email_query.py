@@ -0,0 +1,67 @@
+import asyncio
+import itertools
+
+from persistent_data.ui_email_cache import email_cache
+from persistent_data.ui_session_data_mgmt import SessionData
+from handlers.ui_conversation_memory import SessionConversationMemory
+
+
+_ids = itertools.count()
+
+
+def session_with_email(body):
+    # a new id each time: the job postings extracted in the background from one test's email would be used in the next
+    email = {'id': f'long-email-{next(_ids)}', 'sender': "LinkedIn Job Alerts <jobalerts-noreply@linkedin.example>",
+             'subject': "30 new AI Product Manager jobs", 'date': "Tue, 14 Nov 2023 22:13:20 +0000",
+             'internal_date': "1700000000000"}
+    email_cache.put_metadata([email], day='2023-11-14')
+    email_cache.put_body(email['id'], body)
+    email['body'] = None  # as handle_fetch_emails lists it: the body is loaded when it is needed
+    session = SessionData()
+    session.session_id = 'session-1'
+    session.memory = SessionConversationMemory()
+    session.fetched_emails = [email]
+    return session
+
+
+LONG_BODY = "\n\n".join(f"AI Product Manager {n} - Acme (remote). " + "Own the roadmap for our assistant. " * 20
+                        for n in range(60))
+
+
+def text_of(events):
+    return [event for event in events if isinstance(event, str)]
+
+
+def test_long_email_question_in_a_fresh_process(handler_functions):
+    assert handler_functions.model is None  # built on first use
+    session = session_with_email(LONG_BODY)
+
+    events = list(handler_functions.handle_query("Which of these jobs are remote?", session, 'user1', email_index=0))
+
+    assert text_of(events)[-1] == "DONE"
+    assert "I apologize" not in "".join(text_of(events))
+    assert handler_functions.email_context.stats()["map_reduced"] >= 1
+    assert len(session.memory.chat_memory.messages) == 2
+
+
+def test_long_email_question_async(handler_functions):
+    session = session_with_email(LONG_BODY)
+
+    async def run():
+        return [event async for event in handler_functions.ahandle_query(
+            "Which of these jobs are remote?", session, 'user1', email_id=session.fetched_emails[0]['id'])]
+
+    events = asyncio.run(run())
+    assert text_of(events)[-1] == "DONE"
+    assert "I apologize" not in "".join(text_of(events))
+
+
+def test_failing_map_step_still_ends_the_stream(handler_functions, monkeypatch):
+    def fail(turn):
+        raise RuntimeError("model unavailable")
+
+    monkeypatch.setattr(handler_functions, 'map_long_email', fail)
+    session = session_with_email(LONG_BODY)
+
+    events = text_of(handler_functions.handle_query("Which of these jobs are remote?", session, 'user1', email_index=0))
+    assert events[-2:] == ["I apologize, but I encountered an error. Please try again.", "DONE"]
@@ -0,0 +1,98 @@
+from handlers.ui_email_search import EmailSearchIndex
+
+
+def build_index(messages):
+    index = EmailSearchIndex()
+    for message_id, subject, body in messages:
+        index.add({'id': message_id, 'sender': 'Someone <someone@example.com>', 'subject': subject}, body)
+    return index
+
+
+def invoices_and_acme():
+    # "invoice" is in more than half the emails, "acme" in one
+    messages = [(f"m{n}", "invoice" if n < 8 else "hello", "nothing to see") for n in range(10)]
+    messages[9] = ("m9", "hello", "a note from acme corp")
+    return build_index(messages)
+
+
+def ids(results):
+    return [message_id for message_id, _ in results]
+
+
+def test_rare_term_ranks_first_and_common_term_matches_are_kept():
+    results = ids(invoices_and_acme().search("invoice acme"))
+    assert results[0] == "m9"
+    assert sorted(results[1:]) == [f"m{n}" for n in range(8)]
+
+
+def test_common_term_within_a_day():
+    results = ids(invoices_and_acme().search("invoice acme", within=["m0", "m1", "m2"]))
+    assert sorted(results) == ["m0", "m1", "m2"]
+
+
+def test_within_excludes_other_messages():
+    assert ids(invoices_and_acme().search("acme", within=["m0", "m1"])) == []
+
+
+def test_subject_match_outranks_body_match():
+    index = build_index([("body", "weekly update", "the quarterly report is attached"),
+                         ("subject", "quarterly report", "see attached")] +
+                        [(f"filler{n}", "lunch", "sandwiches") for n in range(5)])
+    assert ids(index.search("quarterly"))[0] == "subject"
+
+
+def test_removed_messages_are_not_returned():
+    index = invoices_and_acme()
+    index.remove(["m9"])
+    assert "m9" not in ids(index.search("invoice acme"))
+    assert index.stats()["messages"] == 9
+
+
+def test_body_added_later_is_searchable():
+    index = build_index([("m1", "hello", None), ("m2", "other", None)])
+    assert ids(index.search("acme")) == []
+    index.add_body("m1", "a note from acme corp")
+    assert ids(index.search("acme")) == ["m1"]
+
+
+def test_limit():
+    index = build_index([(f"m{n}", f"invoice {n}", "text") for n in range(30)])
+    assert len(index.search("invoice", limit=5)) == 5
+
+
+def postings_size(index):
+    return sum(len(postings) for postings in index._postings.values())
+
+
+def test_searches_drop_deleted_documents_once():
+    index = invoices_and_acme()
+    before = postings_size(index)
+
+    index.remove(["m0", "m1", "m9"])
+    assert ids(index.search("acme")) == []
+    assert sorted(ids(index.search("invoice"))) == [f"m{n}" for n in range(2, 8)]
+
+    assert "acme" not in index._postings  # only deleted documents had it
+    assert len(index._postings["invoice"]) == 6
+    assert index._purged["invoice"] == len(index._dead)  # the next search doesn't look at them again
+    assert postings_size(index) < before
+
+
+def test_compaction_empties_the_dead_list_and_renumbers():
+    index = build_index([(f"m{n}", f"subject {n}", f"body {n} shared") for n in range(10)])
+    index.compact_after = 4
+    before = postings_size(index)
+
+    index.remove(["m1", "m3", "m5"])
+    assert len(index._dead) == 3
+    index.remove(["m7"])
+
+    assert index._dead == []
+    assert len(index._ids) == 6 and None not in index._ids
+    assert postings_size(index) < before
+    assert index.stats()["messages"] == 6
+    assert sorted(ids(index.search("shared"))) == ["m0", "m2", "m4", "m6", "m8", "m9"]
+    assert ids(index.search("7")) == []
+
+    index.add({'id': "m7", 'sender': "", 'subject': "subject 7"}, "body 7 shared")  # synced again
+    assert ids(index.search("7")) == ["m7"]
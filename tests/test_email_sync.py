@@ -0,0 +1,139 @@
+from datetime import date
+
+import pytest
+
+from handlers import ui_fake_gmail
+from handlers.ui_gmail_fetch import HistoryExpired, list_history_changes
+from persistent_data.ui_email_cache import EmailCache
+
+
+def message(message_id, subject="Staff Data Scientist", internal_date=1700000000000):
+    return {'id': message_id, 'sender': "Acme Recruiting <jobs@acme.example>", 'subject': subject,
+            'date': "Tue, 14 Nov 2023 22:13:20 +0000", 'internal_date': str(internal_date)}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EmailCache(str(tmp_path / "email_cache.sqlite3"))
+
+
+def test_mark_day_synced_makes_the_day_exactly_its_listing(cache):
+    cache.put_metadata([message('a', internal_date=1), message('b', internal_date=2), message('c', internal_date=3)],
+                       day='2023-11-14')
+    cache.put_body('a', "body of a")
+    cache.put_metadata([message('d', internal_date=4)], day='2023-11-13')  # filed under the wrong day by a history sync
+    assert not cache.is_day_synced('2023-11-14')
+
+    cache.mark_day_synced('2023-11-14', ['a', 'c', 'd'])
+
+    assert cache.is_day_synced('2023-11-14')
+    assert [m['id'] for m in cache.messages_for_day('2023-11-14')] == ['d', 'c', 'a']
+    assert cache.messages_for_day('2023-11-13') == []
+    assert cache.metadata_for(['b']) == {}
+    assert cache.get_body('a') == "body of a"
+
+
+def test_forget_synced_days_keeps_messages_and_bodies(cache):
+    cache.put_metadata([message('a')], day='2023-11-14')
+    cache.put_body('a', "body of a")
+    cache.mark_day_synced('2023-11-14', ['a'])
+    cache.set_history_id('1234')
+
+    cache.forget_synced_days()
+
+    assert cache.history_id() is None
+    assert not cache.is_day_synced('2023-11-14')
+    assert cache.get_body('a') == "body of a"
+
+
+def test_delete_messages_drops_their_job_postings(cache):
+    cache.put_metadata([message('a'), message('b')], day='2023-11-14')
+    cache.put_jobs('a', "one job", [{'title': "Staff Data Scientist"}], complete=True)
+
+    cache.delete_messages(['a'])
+
+    assert cache.metadata_for(['a', 'b']).keys() == {'b'}
+    assert cache.get_jobs('a') is None
+
+
+class FakeHistoryService:
+    '''Answers users().history().list(...).execute() with the given pages, in order.'''
+
+    def __init__(self, pages, error=None):
+        self.pages = list(pages)
+        self.error = error
+        self.requests = []
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def list(self, **kwargs):
+        self.requests.append(kwargs)
+        return self
+
+    def execute(self):
+        if self.error is not None:
+            raise self.error
+        return self.pages.pop(0)
+
+
+def labelled(message_id, labels, *changed):
+    return {'message': {'id': message_id, 'labelIds': list(labels)}, 'labelIds': list(changed)}
+
+
+def test_history_replay_treats_trash_and_spam_as_removal():
+    service = FakeHistoryService([
+        {'history': [
+            {'messagesAdded': [{'message': {'id': 'new', 'labelIds': ['INBOX', 'UNREAD']}}]},
+            {'messagesAdded': [{'message': {'id': 'junk', 'labelIds': ['SPAM']}}]},
+            {'labelsAdded': [labelled('trashed', ['TRASH'], 'TRASH')]},
+            {'labelsAdded': [labelled('starred', ['INBOX', 'STARRED'], 'STARRED')]},
+            {'labelsAdded': [labelled('restored', ['TRASH'], 'TRASH')]},
+         ],
+         'historyId': '110', 'nextPageToken': 'page-2'},
+        {'history': [
+            {'labelsRemoved': [labelled('restored', ['INBOX'], 'TRASH')]},
+            {'labelsRemoved': [labelled('still-spam', ['SPAM'], 'TRASH')]},
+            {'messagesAdded': [{'message': {'id': 'gone', 'labelIds': ['INBOX']}}]},
+            {'messagesDeleted': [{'message': {'id': 'gone'}}]},
+         ],
+         'historyId': '120'},
+    ])
+
+    added, removed, latest = list_history_changes(service, '100')
+
+    assert added == ['new', 'restored']
+    assert removed == ['gone', 'junk', 'still-spam', 'trashed']
+    assert latest == '120'
+    assert {'labelAdded', 'labelRemoved'} <= set(service.requests[0]['historyTypes'])
+    assert service.requests[1]['pageToken'] == 'page-2'
+
+
+def test_history_older_than_gmail_keeps_is_expired():
+    error = ui_fake_gmail.FakeHttpError(404, "Requested entity was not found.")
+    with pytest.raises(HistoryExpired):
+        list_history_changes(FakeHistoryService([], error=error), '1')
+
+
+def test_fake_mailbox_history_follows_the_trash(monkeypatch):
+    mailbox = ui_fake_gmail._FakeMailbox()
+    mailbox.latency_s = 0
+    mailbox.messages_per_day = 3
+    monkeypatch.setattr(ui_fake_gmail, 'mailbox', mailbox)
+    day = date(2023, 11, 14)
+    first, second, third = mailbox.day(day)
+    start = str(mailbox.history_id)
+
+    mailbox.trash_message(first)
+    mailbox.trash_message(second)
+    mailbox.untrash_message(second)
+    mailbox.delete_message(third)
+    delivered = mailbox.add_message(day, "Dana Whitfield <dana@startup.example>", "Coffee?", "Free on Friday?")
+
+    added, removed, _ = ui_fake_gmail.list_history_changes(None, start)
+    assert added == [second, delivered]
+    assert removed == sorted([first, third])
+    assert set(mailbox.day(day)) == {second, delivered}
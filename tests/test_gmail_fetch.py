@@ -0,0 +1,96 @@
+import time
+from contextlib import contextmanager
+from datetime import date
+
+import pytest
+
+import handlers.ui_fake_gmail as fake_gmail
+import handlers.ui_gmail_fetch as gmail_fetch
+from handlers.ui_gmail_fetch import RateLimiter, call_with_retries, fetch_metadata_concurrently
+
+
+@pytest.fixture
+def mailbox(monkeypatch):
+    mailbox = fake_gmail._FakeMailbox()
+    mailbox.latency_s = 0.005
+    mailbox.messages_per_day = 40
+    monkeypatch.setattr(fake_gmail, 'mailbox', mailbox)
+    monkeypatch.setattr(gmail_fetch, 'gmail_rate_limiter', RateLimiter(0))
+    return mailbox
+
+
+@contextmanager
+def client():
+    yield fake_gmail.FakeGmailService(fake_gmail.FakeCredentials())
+
+
+def test_rate_limiter_paces_calls_after_the_burst():
+    limiter = RateLimiter(rate=50, burst=5)
+    started = time.perf_counter()
+    for _ in range(15):
+        limiter.acquire()
+    elapsed = time.perf_counter() - started
+    assert 0.18 <= elapsed < 1.0  # 5 at once, then 10 at 50 a second
+
+
+def test_unlimited_rate_limiter_never_waits():
+    limiter = RateLimiter(rate=0)
+    started = time.perf_counter()
+    for _ in range(10000):
+        limiter.acquire()
+    assert time.perf_counter() - started < 0.5
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retryable_answers_are_retried(status):
+    answers = [fake_gmail.FakeHttpError(status, "try again"), fake_gmail.FakeHttpError(status, "try again"), "ok"]
+
+    def request():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert call_with_retries(request, limiter=RateLimiter(0), retries=3) == "ok"
+    assert answers == []
+
+
+def test_other_errors_and_exhausted_retries_are_raised():
+    calls = []
+
+    def not_found():
+        calls.append(1)
+        raise fake_gmail.FakeHttpError(404, "Requested entity was not found.")
+
+    with pytest.raises(fake_gmail.FakeHttpError):
+        call_with_retries(not_found, limiter=RateLimiter(0), retries=3)
+    assert len(calls) == 1
+
+    def busy():
+        calls.append(1)
+        raise fake_gmail.FakeHttpError(429, "Too many concurrent requests for user")
+
+    with pytest.raises(fake_gmail.FakeHttpError):
+        call_with_retries(busy, limiter=RateLimiter(0), retries=1)
+    assert len(calls) == 3
+
+
+def test_concurrent_fetch_keeps_the_listing_order_through_rate_limit_retries(mailbox):
+    mailbox.max_inflight = 3  # fewer than the fetch workers, so some requests are answered with 429
+    message_ids = list(reversed(mailbox.day(date(2023, 11, 14))))
+
+    results = fetch_metadata_concurrently(message_ids, client, fake_gmail.get_message_metadata)
+
+    assert [metadata['id'] for metadata in results] == message_ids
+    assert all(set(metadata) == {'id', 'sender', 'subject', 'date', 'internal_date'} for metadata in results)
+    assert mailbox.rate_limited > 0
+
+
+def test_metadata_stream_yields_every_message_once(mailbox):
+    message_ids = mailbox.day(date(2023, 11, 15))
+    stream = gmail_fetch.MetadataStream(client, fake_gmail.get_message_metadata)
+    stream.add(message_ids[:20])
+    stream.add(message_ids[20:])
+
+    fetched = stream.completed() + list(stream.remaining())
+    assert sorted(metadata['id'] for metadata in fetched) == sorted(message_ids)
@@ -0,0 +1,39 @@
+from handlers.ui_gmail_pool import GmailClientPool
+
+
+class Credentials:
+    def __init__(self):
+        self.valid = True
+        self.refresh_token = "refresh-token"
+
+
+def make_pool(authenticate):
+    pool = GmailClientPool()
+    pool.configure(authenticate, lambda creds: object(), refresh=lambda creds: setattr(creds, 'valid', True))
+    return pool
+
+
+def test_backend_without_credentials_authenticates_once():
+    pool = make_pool(lambda: None)  # mbox and Maildir archives need no credentials
+
+    for _ in range(3):
+        with pool.client() as service:
+            assert service is not None
+
+    stats = pool.stats()
+    assert (stats["authentications"], stats["services_built"], stats["services_reused"]) == (1, 1, 2)
+
+
+def test_expired_credentials_are_refreshed_in_place():
+    creds = Credentials()
+    pool = make_pool(lambda: creds)
+    with pool.client():
+        pass
+
+    creds.valid = False
+    assert pool.credentials() is creds
+    with pool.client():
+        pass
+
+    stats = pool.stats()
+    assert (stats["authentications"], stats["refreshes"], stats["services_reused"]) == (1, 1, 1)
@@ -0,0 +1,37 @@
+from handlers.ui_job_extraction import format_jobs, parse_extraction
+
+
+def test_reply_with_prose_around_the_json_is_parsed():
+    reply = '''Here are the postings:
+```json
+{"summary": "A weekly job alert.", "jobs": [
+  {"title": "AI Product Manager", "employer": "Acme", "work_mode": "Remote", "location": "US", "summary": " Own the roadmap "},
+  {"title": "Strategy Lead", "work_mode": "in the office"},
+  {"employer": "No title, so not a posting"}
+]}
+```'''
+    assert parse_extraction(reply) == {"summary": "A weekly job alert.", "jobs": [
+        {"title": "AI Product Manager", "employer": "Acme", "location": "US", "summary": "Own the roadmap", "link": "",
+         "work_mode": "remote"},
+        {"title": "Strategy Lead", "employer": "", "location": "", "summary": "", "link": "", "work_mode": "unknown"},
+    ]}
+
+
+def test_unusable_replies_are_rejected():
+    assert parse_extraction("I couldn't find any jobs.") is None
+    assert parse_extraction('{"summary": "no jobs key"}') is None
+    assert parse_extraction('{"summary": "cut off", "jobs": [{"title": "AI PM"') is None
+
+
+def test_email_without_postings_parses_to_an_empty_list():
+    assert parse_extraction('{"summary": "A receipt.", "jobs": []}') == {"summary": "A receipt.", "jobs": []}
+
+
+def test_formatted_jobs_list_each_posting_on_one_line():
+    extraction = parse_extraction('{"summary": "Two roles.", "jobs": [{"title": "AI PM", "employer": "Acme", '
+                                  '"work_mode": "hybrid", "location": "Boston, MA", "link": "https://acme.example/1"}, '
+                                  '{"title": "Strategy Lead", "work_mode": "remote"}]}')
+    assert format_jobs(extraction) == ("Summary: Two roles.\n"
+                                       "Job postings in this email (2, extracted from the full text):\n"
+                                       "1. AI PM - Acme (hybrid, Boston, MA) <https://acme.example/1>\n"
+                                       "2. Strategy Lead (remote)")
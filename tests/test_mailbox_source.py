@@ -0,0 +1,153 @@
+import mailbox
+import sys
+import uuid
+from datetime import datetime
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+import pytest
+
+import handlers.ui_mailbox_source as mailbox_source
+from handlers.ui_gmail_fetch import HistoryExpired
+from persistent_data.ui_session_data_mgmt import SessionData
+
+GMAIL_METADATA_KEYS = {'id', 'sender', 'subject', 'date', 'internal_date'}  # what get_message_metadata returns for Gmail
+
+
+def email(when, subject, plain=None, html=None, sender="Acme Recruiting <jobs@acme.example>"):
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = "me@example.com"
+    message['Subject'] = subject
+    message['Date'] = format_datetime(when.astimezone())  # local time, as Gmail files days
+    message['Message-ID'] = f"<{uuid.uuid4()}@acme.example>"
+    if plain is not None:
+        message.set_content(plain)
+    if html is not None:
+        if plain is None:
+            message.set_content(html, subtype='html')
+        else:
+            message.add_alternative(html, subtype='html')
+    return message
+
+
+def archive_messages():
+    return [
+        email(datetime(2019, 3, 5, 8, 30), "Staff Data Scientist", plain="Remote role.\nApply by Friday.\n"),
+        email(datetime(2019, 3, 5, 12, 0), "Weekly digest", html="<html><body><p>Three new jobs</p></body></html>"),
+        email(datetime(2019, 3, 5, 17, 45), "Résumé received – next steps",
+              plain="Thanks for applying.\n", html="<p>Thanks for <b>applying</b>.</p>"),
+        email(datetime(2019, 3, 5, 23, 59), "Forwarded", plain="Intro line.\nFrom the hiring manager: hello\n"),
+        email(datetime(2019, 3, 6, 0, 1), "Next day"),
+    ]
+
+
+def write_archive(kind, path, messages):
+    box = mailbox.mbox(str(path)) if kind == 'mbox' else mailbox.Maildir(str(path))
+    box.lock()
+    for message in messages:
+        box.add(message)
+    box.flush()
+    box.unlock()
+    box.close()
+
+
+@pytest.fixture
+def messages():
+    return archive_messages()
+
+
+@pytest.fixture(params=['mbox', 'maildir'])
+def archive(request, tmp_path, messages):
+    path = tmp_path / ('inbox.mbox' if request.param == 'mbox' else 'Maildir')
+    write_archive(request.param, path, messages)
+    return mailbox_source.MailboxIndex(str(path))
+
+
+def list_day(service, day):
+    query = mailbox_source.generate_gmail_search_query(day, day)
+    return [message['id'] for message in mailbox_source.fetch_messages(service, query)]
+
+
+def test_a_day_is_listed_newest_first_with_gmail_metadata(archive, messages):
+    ids = list_day(archive, '2019-03-05')
+    metadata = [mailbox_source.get_message_metadata(archive, message_id) for message_id in ids]
+
+    assert all(set(row) == GMAIL_METADATA_KEYS for row in metadata)
+    assert [row['id'] for row in metadata] == ids
+    assert [row['subject'] for row in metadata] == [str(message['Subject']) for message in reversed(messages[:4])]
+    assert all(row['sender'] == "Acme Recruiting <jobs@acme.example>" for row in metadata)
+    assert [row['date'] for row in metadata] == [str(message['Date']) for message in reversed(messages[:4])]
+    dates = [row['internal_date'] for row in metadata]
+    assert all(isinstance(date, str) for date in dates)  # Gmail's internalDate is a string of epoch ms
+    assert [int(date) for date in dates] == sorted((int(date) for date in dates), reverse=True)
+    assert int(dates[0]) == int(datetime(2019, 3, 5, 23, 59).timestamp() * 1000)
+
+    assert len(list_day(archive, '2019-03-06')) == 1
+    assert list_day(archive, '2019-03-07') == []
+
+
+def test_bodies_are_the_text_gmail_would_give(archive):
+    bodies = {mailbox_source.get_message_metadata(archive, message_id)['subject']:
+              mailbox_source.get_message_body(archive, message_id) for message_id in list_day(archive, '2019-03-05')}
+
+    assert bodies["Staff Data Scientist"] == "Remote role.\nApply by Friday.\n"
+    assert "<p>Three new jobs</p>" in bodies["Weekly digest"]  # HTML only: the HTML, reduced to text later
+    assert bodies["Résumé received – next steps"] == "Thanks for applying.\n"  # the plain part is preferred
+    assert bodies["Forwarded"] == "Intro line.\nFrom the hiring manager: hello\n"  # mbox's ">From " is undone
+
+    with pytest.raises(KeyError):
+        mailbox_source.get_message_body(archive, "not-a-message")
+
+
+def test_mbox_and_maildir_give_the_same_ids_and_metadata(tmp_path, messages):
+    write_archive('mbox', tmp_path / 'inbox.mbox', messages)
+    write_archive('maildir', tmp_path / 'Maildir', messages)
+    mbox = mailbox_source.MailboxIndex(str(tmp_path / 'inbox.mbox'))
+    maildir = mailbox_source.MailboxIndex(str(tmp_path / 'Maildir'))
+
+    ids = list_day(mbox, '2019-03-05')
+    assert list_day(maildir, '2019-03-05') == ids  # ids come from Message-ID, not from where the message is stored
+    for message_id in ids:
+        assert mailbox_source.get_message_metadata(mbox, message_id) == mailbox_source.get_message_metadata(maildir, message_id)
+        assert mailbox_source.get_message_body(mbox, message_id) == mailbox_source.get_message_body(maildir, message_id)
+
+
+def test_saved_index_is_reused_until_the_archive_changes(tmp_path, messages, monkeypatch):
+    path = tmp_path / 'inbox.mbox'
+    write_archive('mbox', path, messages)
+    index = mailbox_source.MailboxIndex(str(path))
+    history_id = mailbox_source.get_history_id(index)
+    assert (tmp_path / 'inbox.mbox.ppindex.json').exists()
+
+    def no_scan(self):
+        raise AssertionError("the saved index should have been used")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(mailbox_source.MailboxIndex, '_scan_mbox', no_scan)
+        assert list_day(mailbox_source.MailboxIndex(str(path)), '2019-03-05') == list_day(index, '2019-03-05')
+    assert mailbox_source.list_history_changes(index, history_id) == ([], [], history_id)
+
+    write_archive('mbox', path, [email(datetime(2019, 3, 5, 6, 0), "Arrived later", plain="New.\n")])
+    with pytest.raises(HistoryExpired):
+        mailbox_source.list_history_changes(index, history_id)
+    assert len(list_day(index, '2019-03-05')) == 5  # re-indexed: cached days are listed again
+
+
+def test_the_server_reads_an_mbox_like_gmail(handler_functions, tmp_path, messages, monkeypatch):
+    path = tmp_path / 'inbox.mbox'
+    write_archive('mbox', path, messages)
+    monkeypatch.setenv('PP_EMAIL_SOURCE', 'mbox')
+    monkeypatch.setenv('PP_MAILBOX_PATH', str(path))
+    monkeypatch.setattr(mailbox_source, '_index', None)
+    monkeypatch.delitem(sys.modules, 'handlers.ui_handler_functions')
+    import handlers.ui_handler_functions as handler_functions
+
+    session = SessionData()
+    session.session_id = 'mbox-session'
+    result = handler_functions.handle_fetch_emails(session, '2019-03-05')
+
+    assert result['success'] and result['count'] == 4
+    assert [row['subject'] for row in result['emails']] == [str(message['Subject']) for message in reversed(messages[:4])]
+    selected = handler_functions.handle_select_email(session, 0)
+    assert selected['success'] and selected['email']['body'] == "Intro line.\nFrom the hiring manager: hello\n"
@@ -0,0 +1,180 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import threading
+import types
+from concurrent.futures import Future
+
+import handlers.ui_pdf_extraction as pdf_extraction
+from handlers.ui_pdf_extraction import PageTable, PDFExtractionQueue, extract_pdf_pages_in_worker
+
+
+def test_page_table_reads_completed_pages_as_they_are_written(tmp_path):
+    path = tmp_path / "policy.txt"
+    table = PageTable(str(path))
+    assert table.refresh() == 0  # the worker hasn't created the file yet
+
+    with open(path, 'w', encoding='utf-8') as out:
+        out.write("Declarations\fCoverage A")
+        out.flush()
+        assert table.refresh() == 1
+        assert table.text() == "Declarations"
+
+        out.write(" continued\fExclusions – résumé\f")
+        out.flush()
+        assert table.refresh() == 3
+        assert table.pages == ["Declarations", "Coverage A continued", "Exclusions – résumé"]
+        assert table.refresh() == 3  # nothing new
+
+
+def test_page_table_keeps_an_unfinished_multibyte_character_for_later(tmp_path):
+    path = tmp_path / "policy.txt"
+    data = "première page\f".encode('utf-8')
+    path.write_bytes(data[:3])  # "pr" and half of "è"
+    table = PageTable(str(path))
+    assert table.refresh() == 0
+    path.write_bytes(data)
+    assert table.refresh() == 1
+    assert table.pages == ["première page"]
+
+
+class FakePage:
+    def __init__(self, text):
+        self.text = text
+
+    def extract_text(self):
+        return self.text
+
+    def close(self):
+        pass
+
+
+def fake_pdfplumber(monkeypatch, page_texts):
+    pdf = types.SimpleNamespace(pages=[FakePage(text) for text in page_texts])
+    module = types.ModuleType("pdfplumber")
+
+    class Opened:
+        def __enter__(self):
+            return pdf
+
+        def __exit__(self, *exc):
+            return False
+
+    module.open = lambda path: Opened()
+    monkeypatch.setitem(sys.modules, "pdfplumber", module)
+
+
+def test_pages_are_written_with_form_feeds(tmp_path, monkeypatch):
+    fake_pdfplumber(monkeypatch, ["Declarations", "Coverage"])
+    txt = tmp_path / "policy.txt"
+    result = extract_pdf_pages_in_worker("policy.pdf", str(txt))
+    assert result["success"] and result["document_type"] == "text"
+    assert txt.read_text(encoding='utf-8') == "Declarations\fCoverage\f"
+
+
+def test_scanned_page_without_ocr_fails_the_job(tmp_path, monkeypatch):
+    fake_pdfplumber(monkeypatch, ["Declarations", ""])
+    monkeypatch.setattr(pdf_extraction, "ocr_page", lambda pdf_path, number: None)
+    result = extract_pdf_pages_in_worker("policy.pdf", str(tmp_path / "policy.txt"))
+    assert not result["success"]
+    assert "Page 2" in result["error"]
+
+
+def test_scanned_page_is_ocred(tmp_path, monkeypatch):
+    fake_pdfplumber(monkeypatch, ["Declarations", ""])
+    monkeypatch.setattr(pdf_extraction, "ocr_page", lambda pdf_path, number: f"scanned page {number}")
+    txt = tmp_path / "policy.txt"
+    result = extract_pdf_pages_in_worker("policy.pdf", str(txt))
+    assert result["success"] and result["document_type"] == "mixed"
+    assert txt.read_text(encoding='utf-8') == "Declarations\fscanned page 2\f"
+
+
+class ImmediateExecutor:
+    '''Runs each extraction in submit, so its future has finished before the queue can add a callback to it.'''
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def test_jobs_that_finish_at_once_do_not_deadlock_the_queue(tmp_path):
+    def extract(pdf_path, txt_file_path):
+        if pdf_path.endswith("broken.pdf"):
+            raise ValueError("not a PDF")
+        with open(txt_file_path, 'w', encoding='utf-8') as out:
+            out.write("Declarations")
+        return {"success": True, "document_type": "text"}
+
+    queue = PDFExtractionQueue(workers=1, extract=extract)
+    queue._pool = ImmediateExecutor()
+    finished = []
+    queue.on_done.append(finished.append)
+
+    def submit_all():
+        for name in ("broken.pdf", "first.pdf", "second.pdf"):
+            (tmp_path / name).write_bytes(name.encode())
+            queue.submit(str(tmp_path / name), str(tmp_path / (name + ".txt")))
+
+    worker = threading.Thread(target=submit_all, daemon=True)
+    worker.start()
+    worker.join(5)
+    assert not worker.is_alive(), "submit deadlocked"
+
+    stats = queue.stats()
+    assert (stats["completed"], stats["failed"], stats["running"]) == (2, 1, 0)
+    assert [job.pdf_path for job in finished] == [str(tmp_path / "first.pdf"), str(tmp_path / "second.pdf")]
+
+
+def tiny_pdf(text):
+    '''A one-page PDF with text on it, built by hand so the test needs no PDF writer.'''
+    stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+               b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R"
+               b" /Resources << /Font << /F1 5 0 R >> >> >>",
+               b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    pdf, offsets = b"%PDF-1.4\n", []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+
+def test_a_tiny_pdf_goes_through_the_spawned_process_pool(tmp_path):
+    pdf = tmp_path / "policy.pdf"
+    pdf.write_bytes(tiny_pdf("Declarations page"))
+    txt = tmp_path / "policy.txt"
+    queue = PDFExtractionQueue(workers=1, extract=extract_pdf_pages_in_worker, streams_pages=True)
+    try:
+        job = queue.submit(str(pdf), str(txt))
+        assert queue.wait(job, timeout=60)
+    finally:
+        queue._pool.shutdown()
+
+    if importlib.util.find_spec("pdfplumber") is not None:
+        assert job.status == "done", job.error
+        assert "Declarations page" in txt.read_text(encoding='utf-8')
+    else:  # the worker process still ran the job and reported back
+        assert job.status == "failed"
+        assert job.error == "pdfplumber is not installed"
+    assert queue.stats()["running"] == 0
+
+
+def test_spawned_workers_skip_the_server_imports():
+    # What a spawned pool process does with the server's main module before its first job
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    check = ("import runpy, sys; runpy.run_path('ui_Chatbot_prototype.py', run_name='__mp_main__'); "
+             "print(sorted(name for name in sys.modules if name.startswith(('handlers', 'persistent_data'))))")
+    result = subprocess.run([sys.executable, "-c", check], cwd=root, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,95 @@
+import math
+
+import pytest
+
+import handlers.ui_policy_retrieval as policy_retrieval
+from handlers.ui_policy_retrieval import (BM25Index, PolicyIndex, SECTION_SEPARATOR, chunk_policy_text,
+                                          select_policy_content, sections_from_spans)
+from handlers.ui_text_utils import tokenize
+
+FILLER = "The terms of this part apply as written in the schedule. " * 14  # ~800 characters every section shares
+
+POLICY_PARTS = [
+    "DECLARATIONS. Named insured Jane Doe. Policy period March 1 2024 to March 1 2025. Premium 1,240 dollars.",
+    "SECTION I COVERAGE A DWELLING. We cover the dwelling on the residence premises against direct physical loss.",
+    "SECTION I COVERAGE C PERSONAL PROPERTY. We cover personal property owned or used by an insured, anywhere in "
+    "the world.",
+    "SECTION I EXCLUSIONS. We do not insure for loss caused by flood, surface water, waves or overflow of a body of "
+    "water. Flood damage is excluded whether or not a covered peril contributes to it.",
+    "SECTION II LIABILITY. We pay damages for bodily injury or property damage for which an insured is legally "
+    "liable.",
+    "CONDITIONS. Deductible: we pay only the part of the loss over the deductible of 1,000 dollars.",
+]
+POLICY = "\n\n".join(part + " " + FILLER for part in POLICY_PARTS)
+
+
+def test_bm25_scores_a_document_by_the_formula():
+    index = BM25Index([["flood", "water"], ["fire"], ["flood", "flood", "fire", "theft"]])
+
+    idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))  # "flood" is in 2 of the 3 documents
+
+    def score(tf, length, k1=1.5, b=0.75, average_length=7 / 3):
+        return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+
+    # flood twice beats flood once, despite the longer document
+    assert index.search(["flood"], k=5) == [(pytest.approx(score(2, 4)), 2), (pytest.approx(score(1, 2)), 0)]
+
+
+def test_bm25_favours_rare_terms_and_leaves_out_documents_matching_nothing():
+    documents = [tokenize(text) for text in ("hail damage to the roof", "roof repairs and roof coverings",
+                                             "water backup from a sewer", "the roof of the garage")]
+    index = BM25Index(documents)
+
+    assert [i for _, i in index.search(tokenize("hail on the roof"), k=10)] == [0, 1, 3]  # hail is in one document only
+    assert [i for _, i in index.search(tokenize("roof"), k=1)] == [1]
+    assert index.search(tokenize("earthquake"), k=10) == []
+    assert BM25Index([]).search(["roof"], k=3) == []
+
+
+def test_the_policy_section_answering_the_question_ranks_first():
+    index = PolicyIndex(POLICY)
+    assert len(index.sections) == len(POLICY_PARTS)  # one section per part at the default section size
+
+    def top(question):
+        return index.bm25.search(tokenize(question), k=1)[0][1]
+
+    assert top("Is flood damage covered?") == 3
+    assert top("What is my deductible?") == 5
+    assert top("Who is the named insured and when does the policy period end?") == 0
+    assert top("Am I liable for bodily injury to a guest?") == 4
+
+
+def test_stored_spans_rebuild_the_same_sections():
+    sections = chunk_policy_text(POLICY, target_chars=600)
+    assert len(sections) > len(POLICY_PARTS)  # parts longer than 600 characters are split
+    assert sections_from_spans(POLICY, [section.spans for section in sections]) == sections
+
+
+@pytest.fixture
+def small_budget(monkeypatch):
+    monkeypatch.setattr(policy_retrieval, 'policy_context_mode', 'retrieval')
+    monkeypatch.setattr(policy_retrieval, 'policy_token_budget', 520)  # room for two of the ~250 token sections
+    monkeypatch.setattr(policy_retrieval, 'policy_top_k', 3)
+
+
+def test_selected_sections_are_sent_in_document_order(small_budget):
+    sections = PolicyIndex(POLICY).sections
+
+    content, mode = select_policy_content("policy.txt", POLICY, "Is flood damage covered, and what is the deductible?",
+                                          cache=False)
+    assert mode == "retrieval"
+    assert content == sections[3].text + SECTION_SEPARATOR + sections[5].text
+
+    content, _ = select_policy_content("policy.txt", POLICY, "And what about the deductible?",
+                                       previous_question="Does it cover personal property?", cache=False)
+    assert content == sections[2].text + SECTION_SEPARATOR + sections[5].text  # the follow-up leans on the last question
+
+
+def test_no_match_sends_the_opening_sections_and_a_small_policy_goes_whole(small_budget):
+    sections = PolicyIndex(POLICY).sections
+
+    content, mode = select_policy_content("policy.txt", POLICY, "zzz qqq", cache=False)
+    assert (content, mode) == (sections[0].text + "\n\n" + sections[1].text, "retrieval")
+
+    short = POLICY_PARTS[3]
+    assert select_policy_content("short.txt", short, "Is flood damage covered?", cache=False) == (short, "full")
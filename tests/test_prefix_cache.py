@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from handlers.ui_prefix_cache import PrefixCache, PrefixRegistrar
+
+TEMPLATE = "{system_template}\n{policy_instructions}\n{policy_content}"
+
+
+class RecordingRegistrar(PrefixRegistrar):
+
+    def __init__(self):
+        self.registered = []
+
+    def register(self, prefix_text):
+        self.registered.append(prefix_text)
+        return f"cachedContents/{len(self.registered)}", time.time() + 3600
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def prepare(cache, session_id, policy_content):
+    return cache.prepare(session_id, TEMPLATE, system_template="You answer questions about insurance.",
+                         policy_instructions="Use the policy.", policy_content=policy_content)
+
+
+def test_prefix_is_registered_once_a_second_turn_uses_it():
+    registrar = RecordingRegistrar()
+    cache = PrefixCache(registrar)
+
+    message, handle = prepare(cache, 'session-1', "Coverage A: dwelling")
+    assert handle is None
+    time.sleep(0.05)
+    assert registrar.registered == []  # used once: not worth a provider cache entry yet
+
+    _, handle = prepare(cache, 'session-2', "Coverage A: dwelling")
+    assert handle is None  # registration runs in the background
+    assert wait_for(lambda: prepare(cache, 'session-1', "Coverage A: dwelling")[1] == "cachedContents/1")
+    assert registrar.registered == [message.content]
+
+
+def test_prefixes_used_for_one_turn_each_are_never_registered():
+    registrar = RecordingRegistrar()
+    cache = PrefixCache(registrar)
+
+    # Retrieval mode: the sections sent follow the question
+    for n in range(5):
+        prepare(cache, 'session-1', f"Sections for question {n}")
+    time.sleep(0.05)
+
+    assert registrar.registered == []
+    assert cache.stats()["built"] == 5
+
+
+def test_registrar_must_implement_register():
+    class Incomplete(PrefixRegistrar):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
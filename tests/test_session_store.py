@@ -0,0 +1,89 @@
+import threading
+import time
+
+from persistent_data.ui_session_data_mgmt import SessionData
+from persistent_data.ui_session_store import SessionStore
+
+
+def new_session(session_id):
+    session = SessionData()
+    session.session_id = session_id
+    return session
+
+
+def test_slow_session_creation_does_not_block_the_shard():
+    building, release = threading.Event(), threading.Event()
+
+    def factory(session_id):
+        if session_id == 'slow':
+            building.set()
+            release.wait(5)
+        return new_session(session_id)
+
+    store = SessionStore(factory, num_shards=1)  # every session on the same shard
+    store.get_or_create('existing')
+    slow = threading.Thread(target=store.get_or_create, args=('slow',), daemon=True)
+    slow.start()
+    assert building.wait(5)
+
+    started = time.perf_counter()
+    assert store.get('existing') is not None
+    session, created = store.get_or_create('fast')
+    assert created and session.session_id == 'fast'
+    assert time.perf_counter() - started < 1
+
+    release.set()
+    slow.join(5)
+    assert store.get('slow') is not None
+
+
+def test_concurrent_creation_of_one_session_keeps_the_first():
+    barrier = threading.Barrier(8)
+
+    def factory(session_id):
+        barrier.wait(5)  # every caller is building at once
+        return new_session(session_id)
+
+    store = SessionStore(factory)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get_or_create('shared'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len({id(session) for session, _ in results}) == 1
+    assert [created for _, created in results].count(True) == 1
+    assert results[0][0] is store.get('shared')
+    assert len(store) == 1
+
+
+def test_idle_sessions_are_evicted_and_reported_outside_the_lock():
+    removed = []
+
+    def on_remove(session_id):
+        removed.append(session_id)
+        store.get(session_id)  # would deadlock if called with the shard lock held
+
+    store = SessionStore(new_session, num_shards=1, max_idle_seconds=0.05, evict_interval_seconds=0, on_remove=on_remove)
+    store.get_or_create('idle')
+    store.get_or_create('active')
+    time.sleep(0.1)
+    store.get('active')
+
+    store.get_or_create('new')  # creating a session evicts the shard's idle ones
+
+    assert removed == ['idle']
+    assert store.get('idle') is None and store.get('active') is not None
+    time.sleep(0.1)
+    assert store.evict_idle() == 2
+    assert sorted(removed) == ['active', 'idle', 'new']
+    assert len(store) == 0
+
+
+def test_remove_calls_on_remove_once():
+    removed = []
+    store = SessionStore(new_session, on_remove=removed.append)
+    store.get_or_create('a')
+    assert store.remove('a') and not store.remove('a')
+    assert removed == ['a']
@@ -0,0 +1,33 @@
+import pytest
+
+from handlers.ui_stream_flush import (FlushPolicy, LatencyFlushPolicy, SSECoalescer, ThresholdFlushPolicy, coalesce,
+                                      flush_policy_from_spec)
+
+
+def test_flush_policy_is_abstract():
+    with pytest.raises(TypeError):
+        FlushPolicy()
+
+
+def test_policies_round_trip_through_their_spec():
+    for spec in ("passthrough", "threshold:20", "latency:30:4096"):
+        assert repr(flush_policy_from_spec(spec)) == spec
+    with pytest.raises(ValueError):
+        flush_policy_from_spec("sometimes")
+
+
+def test_threshold_coalesces_small_chunks_and_escapes_newlines():
+    payloads = list(coalesce(["The ", "deductible\n", "is ", "$500."], SSECoalescer(ThresholdFlushPolicy(10))))
+    assert payloads == ["The deductible\\n", "is $500."]
+
+
+def test_latency_policy_sends_the_first_chunk_then_waits_for_the_window():
+    now = [0.0]
+    coalescer = SSECoalescer(LatencyFlushPolicy(window_ms=30), clock=lambda: now[0])
+    assert coalescer.push("Hello") == "Hello"
+    assert coalescer.push(", ") is None
+    now[0] = 0.02
+    assert coalescer.time_until_flush() == pytest.approx(0.01)  # ", " has waited 20 of its 30 ms
+    assert coalescer.push("world") is None
+    now[0] = 0.031
+    assert coalescer.push("!") == ", world!"
@@ -0,0 +1,66 @@
+import os
+import sys
+
+from handlers.ui_text_cache import ExtractedTextCache
+
+
+def write(path, text):
+    path.write_text(text, encoding='utf-8')
+
+
+def test_mapped_file_is_decoded_once_while_it_is_recent(tmp_path):
+    cache = ExtractedTextCache(mmap_threshold=1, max_decoded=1)
+    first, second = tmp_path / "first.txt", tmp_path / "second.txt"
+    write(first, "Coverage A – dwelling\r\n")
+    write(second, "Coverage B")
+
+    text = cache.read(str(first))
+    assert text == "Coverage A – dwelling\n"
+    assert cache.read(str(first)) is text  # the same object, so the prefix cache's identity check holds
+    assert cache.stats()["mapped_entries"] == 1
+
+    cache.read(str(second))  # only one decoded text is kept
+    assert cache.stats()["decoded_entries"] == 1
+    again = cache.read(str(first))
+    assert again == text and again is not text
+
+
+def test_changed_file_is_read_again(tmp_path):
+    cache = ExtractedTextCache(mmap_threshold=1)
+    path = tmp_path / "policy.txt"
+    write(path, "old text")
+    assert cache.read(str(path)) == "old text"
+
+    write(path, "new text, longer")
+    os.utime(path, ns=(0, 1))
+    assert cache.read(str(path)) == "new text, longer"
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["decoded_entries"] == 1
+
+    cache.invalidate(str(path))
+    stats = cache.stats()
+    assert (stats["entries"], stats["decoded_entries"], stats["bytes"]) == (0, 0, 0)
+
+
+def test_decoded_copies_count_towards_max_bytes(tmp_path):
+    paths = []
+    for n in range(3):
+        path = tmp_path / f"policy{n}.txt"
+        write(path, f"Policy {n}. " + "Coverage applies to the dwelling. " * 100)
+        paths.append(str(path))
+    size = os.path.getsize(paths[0])
+    decoded = sys.getsizeof(open(paths[0], encoding='utf-8').read())
+    cache = ExtractedTextCache(max_bytes=2 * (size + decoded), mmap_threshold=1, max_decoded=4)
+
+    for path in paths:
+        cache.read(path)
+        stats = cache.stats()
+        assert stats["bytes"] <= stats["max_bytes"]
+
+    # room for two files with their decoded copies: the least recently read one went
+    stats = cache.stats()
+    assert (stats["entries"], stats["decoded_entries"], stats["evictions"]) == (2, 2, 1)
+    assert stats["bytes"] == 2 * (size + decoded)
+
+    cache.invalidate(paths[2])
+    assert cache.stats()["bytes"] == size + decoded
@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import pytest
+
+from persistent_data.ui_text_store import ExtractedTextStore
+
+TEXT = "Declarations\nPolicy number 123\fCoverage A - Dwelling\fExclusions\f"
+SECTIONS = [[(0, 30)], [(30, 52), (52, 63)]]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ExtractedTextStore(str(tmp_path / "store"))
+
+
+@pytest.fixture
+def pdf(tmp_path):
+    path = tmp_path / "policy.pdf"
+    path.write_bytes(b"%PDF-1.4 a policy")
+    return path
+
+
+def extracted(store, pdf, text=TEXT):
+    '''What an extraction does: the worker writes the text file, then the server records it.'''
+    digest = store.digest(str(pdf))
+    with open(store.new_text_path(digest), 'w', encoding='utf-8') as out:
+        out.write(text)
+    return digest, store.put(digest, "text", text, SECTIONS, 1500)
+
+
+def test_put_then_get_round_trips_through_the_files(store, pdf):
+    digest, entry = extracted(store, pdf)
+    assert entry.page_offsets == [0, 31, 53]  # pages separated by form feeds; the last one ends the text
+    assert entry.text_path == store.text_path(digest)
+
+    reread = ExtractedTextStore(store.root).get(digest)  # a new server process
+    assert reread == entry
+    assert reread.sections == [[(0, 30)], [(30, 52), (52, 63)]]
+    with open(reread.text_path, encoding='utf-8') as file:
+        assert file.read() == TEXT
+
+
+def test_identical_pdfs_share_one_entry_and_are_hashed_once_per_version(store, pdf, tmp_path):
+    digest, entry = extracted(store, pdf)
+    copy = tmp_path / "uploaded again.pdf"
+    shutil.copyfile(pdf, copy)
+
+    assert store.lookup(str(copy)) == entry
+    assert store.lookup(str(pdf)) == entry
+    assert store.stats()["hashed"] == 2  # the original, then its copy; the second lookup was a dict hit
+
+    pdf.write_bytes(b"%PDF-1.4 a new version of the policy")
+    assert store.lookup(str(pdf)) is None
+    assert store.digest(str(pdf)) != digest
+
+
+def test_a_digest_is_complete_only_once_its_json_is_written(store, pdf, monkeypatch):
+    digest = store.digest(str(pdf))
+    with open(store.new_text_path(digest), 'w', encoding='utf-8') as out:
+        out.write(TEXT)  # the worker has written the text, the server hasn't recorded it yet
+    assert store.get(digest) is None
+
+    def crash(src, dst):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'replace', crash)
+        with pytest.raises(OSError):
+            store.put(digest, "text", TEXT, SECTIONS, 1500)
+    assert ExtractedTextStore(store.root).get(digest) is None  # a half-written .json is never read as the entry
+
+    store.put(digest, "text", TEXT, SECTIONS, 1500)
+    assert ExtractedTextStore(store.root).get(digest) is not None
+
+    os.remove(store.text_path(digest))
+    assert ExtractedTextStore(store.root).get(digest) is None  # its text is gone
+
+
+def test_stored_sections_only_for_the_same_file_text_and_section_size(store, pdf, tmp_path):
+    digest, _ = extracted(store, pdf)
+    text_path = store.text_path(digest)
+
+    assert store.stored_sections(text_path, TEXT, 1500) == SECTIONS
+    assert store.stored_sections(text_path, TEXT + "more", 1500) is None     # the text has changed
+    assert store.stored_sections(text_path, TEXT, 800) is None               # chunked for another section size
+    elsewhere = tmp_path / os.path.basename(text_path)
+    shutil.copyfile(text_path, elsewhere)
+    assert store.stored_sections(str(elsewhere), TEXT, 1500) is None         # not one of the store's files
+    assert store.stored_sections(text_path[:-4] + ".json", TEXT, 1500) is None
+    unknown = store.text_path("ab" + "0" * 62)
+    assert store.stored_sections(unknown, TEXT, 1500) is None
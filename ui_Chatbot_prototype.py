@@ -1,9 +1,11 @@
 import http.server
 import socketserver
+import threading
 import json
 import argparse
 import sys
 from urllib.parse import urlparse, parse_qs
+from http.cookies import SimpleCookie
 
 from dotenv import load_dotenv
 import os
@@ -22,36 +24,167 @@ google_api_key = os.getenv('GOOGLE_API_KEY')
 
 langchain_api_key = os.getenv('LANGCHAIN_API_KEY')
 
-from persistent_data.ui_session_data_mgmt import SessionData
-from handlers.ui_handler_functions import (
-    handle_focus, handle_query, handle_clear_button_click, handle_policy_selection,
-    handle_fetch_emails, handle_select_email,
-    memory, HumanMessage, AIMessage
-)
-from server_data.ui_server_side_data import create_server_user_data, ServerUserDataCollection
+# The PDF extraction pool (ui_pdf_extraction.py) starts its worker processes with spawn, and each of them runs this
+# file's top level again as __mp_main__: behind this guard they skip importing the handlers (Gmail, SQLite, LangChain,
+# the model), which only the server needs. Importing the module (tests, benchmarks) still gets all of them.
+if __name__ != "__mp_main__":
+    from persistent_data.ui_session_data_mgmt import SessionData
+    from persistent_data.ui_session_store import SessionStore
+    from handlers.ui_handler_functions import (
+        handle_focus, handle_query, ahandle_query, handle_clear_button_click, handle_policy_selection,
+        handle_fetch_emails, handle_fetch_emails_stream, handle_select_email, handle_search_emails,
+        handle_extraction_status,
+        HumanMessage, AIMessage
+    )
+    from handlers.ui_async_stream import stream_sse, stream_stats, sse_message
+    from handlers.ui_stream_flush import get_flush_policy, set_flush_policy
+    from handlers.ui_text_cache import extracted_text_cache
+    from handlers.ui_policy_retrieval import policy_index_cache, set_policy_context_mode
+    from handlers.ui_latency_stats import latency_stats
+    from handlers.ui_conversation_memory import memory_budget_stats
+    from handlers.ui_prefix_cache import prefix_cache
+    from handlers.ui_model_backends import model_backend_names
+    from handlers.ui_fake_model import fake_model_stats
+    from persistent_data.ui_email_cache import email_cache
+    from persistent_data.ui_text_store import text_store
+    from handlers.ui_email_prefetch import body_prefetcher
+    from handlers.ui_gmail_pool import gmail_pool
+    from handlers.ui_email_context import email_context
+    from handlers.ui_job_extraction import job_extractor
+    from handlers.ui_email_search import email_search
+    from handlers.ui_pdf_extraction import pdf_extraction_queue
+    from handlers.ui_policy_warmup import policy_warmup
+    import handlers.ui_handler_functions as handler_functions
+    from server_data.ui_server_side_data import create_server_user_data, ServerUserDataCollection
+
+SESSION_COOKIE = 'pp_session'
+
+# Set from the command line when the server starts; tests and benchmarks that serve MyHandler set them directly
+chat_mode = 'async'          # 'async' streams /api/chat with chain.astream, 'sync' with the blocking loop
+session_store = None         # SessionStore of the browsers' SessionData, found through SESSION_COOKIE
+server_user_data = None      # ServerUserDataCollection that /api/handle_focus reloads the session from
 
-global session_state
-
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description='Start the Insurance Portal Chat Demo')
-parser.add_argument('--user', type=str, required=True, help='Simulated user to load (user0, user1, user2, or user3)')
-args = parser.parse_args()
-
-# Validate the user argument
-valid_users = ['user0', 'user1', 'user2', 'user3']
-if args.user not in valid_users:
-    print(f"Error: '{args.user}' is not a valid user. Please choose from {', '.join(valid_users)}.")
-    sys.exit(1)
+if __name__ == "__main__":
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description='Start the Insurance Portal Chat Demo')
+    parser.add_argument('--user', type=str, required=True, help='Simulated user to load (user0, user1, user2, or user3)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to serve on (default 8000)')
+    parser.add_argument('--no-browser', action='store_true', help="Don't open the chatbot page in a browser (benchmarks, headless runs)")
+    parser.add_argument('--server-mode', type=str, default='threaded', choices=['threaded', 'single'],
+                        help='threaded serves each request on its own worker thread; single is the original one-request-at-a-time TCPServer')
+    parser.add_argument('--max-workers', type=int, default=32, help='Maximum number of requests served concurrently in threaded mode')
+    parser.add_argument('--max-streams', type=int, default=None,
+                        help='Maximum number of concurrent /api/chat streams (defaults to half of --max-workers), so fast endpoints always have free workers')
+    parser.add_argument('--chat-mode', type=str, default='async', choices=['async', 'sync'],
+                        help='async streams /api/chat with chain.astream and cancels generation when the browser disconnects; sync is the original blocking loop')
+    parser.add_argument('--flush-policy', type=str, default=None,
+                        help='How streamed text is coalesced into SSE events: passthrough, threshold:<chars> or latency:<ms>[:<max chars>] (default: $PP_FLUSH_POLICY or threshold:50)')
+    parser.add_argument('--policy-context', type=str, default=None, choices=['retrieval', 'full'],
+                        help='retrieval sends only the policy sections relevant to each question; full sends the whole policy every turn (default: $PP_POLICY_CONTEXT or retrieval)')
+    parser.add_argument('--memory-mode', type=str, default=None, choices=['buffer', 'budget'],
+                        help='buffer sends the whole conversation every turn; budget keeps recent turns verbatim and summarizes older ones to stay under --memory-token-budget (default: $PP_MEMORY_MODE or buffer)')
+    parser.add_argument('--memory-token-budget', type=int, default=None, help='History tokens sent per turn in budget memory mode (default: $PP_MEMORY_TOKEN_BUDGET or 4000)')
+    parser.add_argument('--model', type=str, default=None, choices=model_backend_names(),
+                        help='Model backend: gemini, or fake for offline measurements (default: $PP_MODEL_BACKEND or gemini)')
+    parser.add_argument('--prefix-cache', type=str, default=None, choices=['auto', 'local', 'off'],
+                        help="Prompt prefix caching: auto also uses the provider's context cache (default: $PP_PREFIX_CACHE or auto)")
+    args = parser.parse_args()
+
+    # Validate the user argument
+    valid_users = ['user0', 'user1', 'user2', 'user3']
+    if args.user not in valid_users:
+        print(f"Error: '{args.user}' is not a valid user. Please choose from {', '.join(valid_users)}.")
+        sys.exit(1)
+
+    if args.max_workers < 2:
+        print("Error: --max-workers must be at least 2 (one chat stream plus one fast request).")
+        sys.exit(1)
+
+    if args.flush_policy:
+        try:
+            set_flush_policy(args.flush_policy)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+
+    if args.policy_context:
+        set_policy_context_mode(args.policy_context)
+
+    if args.memory_mode:
+        handler_functions.memory_mode = args.memory_mode
+    if args.memory_token_budget:
+        handler_functions.memory_token_budget = args.memory_token_budget
+    if args.prefix_cache:
+        prefix_cache.mode = args.prefix_cache
+    if args.model and args.model != handler_functions.model_backend:
+        handler_functions.set_model_backend(args.model)
+    chat_mode = args.chat_mode
+
+
+class BoundedThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''HTTP server that handles every request on its own thread, with at most max_workers threads alive at once.
+    When all workers are busy the accept loop waits for one to free up, so extra connections queue in the listen
+    backlog instead of spawning unbounded threads. Long /api/chat streams are further capped at max_streams so
+    they can never occupy every worker and starve /api/init, /api/handle_focus, /api/select_email or static files.
+    '''
+    daemon_threads = True       # don't let an open SSE stream block Ctrl+C
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers: int = 32, max_streams: int = None):
+        super().__init__(server_address, handler_class)
+        self.max_workers = max_workers
+        self.max_streams = max_streams if max_streams is not None else max(1, max_workers // 2)
+        self.max_streams = min(self.max_streams, max_workers - 1)
+        self.worker_slots = threading.BoundedSemaphore(max_workers)
+        self.stream_slots = threading.BoundedSemaphore(self.max_streams)
+
+    def process_request(self, request, client_address):
+        self.worker_slots.acquire()
+        try:
+            super().process_request(request, client_address)  # starts process_request_thread on a new thread
+        except Exception:
+            self.worker_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.worker_slots.release()
 
-# If we get here, the user is valid
 
 class MyHandler(http.server.SimpleHTTPRequestHandler):
 
+    new_session_id = None  # set when this request started a new session, so end_headers can send the cookie
+
     def log_message(self, format, *args):
         # Override to suppress logging
         pass
 
+    def end_headers(self):
+        if self.new_session_id:
+            self.send_header('Set-Cookie', f"{SESSION_COOKIE}={self.new_session_id}; Path=/; HttpOnly; SameSite=Lax")
+            self.new_session_id = None
+        super().end_headers()
+
+    def get_session(self) -> "SessionData":
+        """Return the caller's session from its cookie, starting a new one if the cookie is missing or has expired."""
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        if SESSION_COOKIE in cookie:
+            session_state = session_store.get(cookie[SESSION_COOKIE].value)
+            if session_state is not None:
+                return session_state
+
+        session_id = SessionStore.new_session_id()
+        session_state, _ = session_store.get_or_create(session_id)
+        self.new_session_id = session_id
+        return session_state
+
     def do_GET(self):
+        if self.path.startswith('/api/'):
+            session_state = self.get_session()
+
         if self.path == '/' or self.path == '//':
             self.path = '/home.html'  # Redirect root to home.html
             try:
@@ -77,16 +210,44 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.wfile.write(response.encode())
         
         elif self.path.startswith('/api/chat'):
-            self.send_response(200)
-            self.send_header('Content-type', 'text/event-stream')
-            self.send_header('Cache-Control', 'no-cache')
-            self.send_header('Connection', 'keep-alive')
-            self.end_headers()
+            # Chat streams hold a worker for as long as the model is talking, so cap how many can run at once
+            stream_slots = getattr(self.server, 'stream_slots', None)
+            if stream_slots is not None and not stream_slots.acquire(blocking=False):
+                self.send_response(503)
+                self.send_header('Content-type', 'application/json')
+                self.send_header('Retry-After', '1')
+                self.end_headers()
+                self.wfile.write(json.dumps({"success": False, "error": "Too many open chat streams"}).encode())
+                return
+
+            try:
+                self.send_response(200)
+                self.send_header('Content-type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Connection', 'keep-alive')
+                self.end_headers()
 
-            query = parse_qs(urlparse(self.path).query).get('message', [''])[0]
-            for chunk in handle_query(query, session_state, session_state.user_id):
-                self.wfile.write(f"data: {chunk}\n\n".encode('utf-8'))
-                self.wfile.flush()
+                query_params = parse_qs(urlparse(self.path).query)
+                query = query_params.get('message', [''])[0]
+                # The email the question is about, by reference: its context is built server-side from the cached body
+                email_index = query_params.get('email_index', [''])[0]
+                email_index = int(email_index) if email_index.lstrip('-').isdigit() else None
+                email_id = query_params.get('email_id', [''])[0] or None
+                if chat_mode == 'async':
+                    def write_event(chunk):
+                        self.wfile.write(sse_message(chunk))
+                        self.wfile.flush()
+
+                    stream_sse(ahandle_query(query, session_state, session_state.user_id, email_index, email_id),
+                               write_event, self.connection)
+                else:
+                    # Answer chunks are data: lines; "extracting" events report a policy extraction the answer waits on
+                    for chunk in handle_query(query, session_state, session_state.user_id, email_index, email_id):
+                        self.wfile.write(sse_message(chunk))
+                        self.wfile.flush()
+            finally:
+                if stream_slots is not None:
+                    stream_slots.release()
 
             return
         
@@ -95,7 +256,8 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             policy = query_params.get('policy', [''])[0]
             if policy:
                 try:
-                    handle_policy_selection(session_state, session_state.user_id, policy)
+                    with session_state.lock:
+                        handle_policy_selection(session_state, session_state.user_id, policy)
                     self.send_response(200)
                     self.send_header('Content-type', 'application/json')
                     self.end_headers()
@@ -116,7 +278,8 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                 self.wfile.write(error_response.encode())
                 
         elif self.path == '/api/clear':
-            handle_clear_button_click(session_state, session_state.user_id)
+            with session_state.lock:
+                handle_clear_button_click(session_state, session_state.user_id)
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
@@ -128,13 +291,14 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.end_headers()
             history = [
                 {"type": "human" if isinstance(msg, HumanMessage) else "ai", "content": msg.content}
-                for msg in memory.chat_memory.messages
+                for msg in session_state.memory.chat_memory.messages
             ]
             response = json.dumps({"history": history})
             self.wfile.write(response.encode())
 
         elif self.path == '/api/handle_focus':
-            handle_focus(session_state, session_state.user_id, session_state.session_id, server_user_data)
+            with session_state.lock:
+                handle_focus(session_state, session_state.user_id, session_state.session_id, server_user_data)
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
@@ -150,6 +314,33 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             response = json.dumps(response_data)
             self.wfile.write(response.encode())
 
+        elif self.path.startswith('/api/fetch_emails_stream'):
+            # Same as /api/fetch_emails, but each email is sent as an SSE 'email' event as soon as its metadata is in,
+            # then an 'order' event with the ids newest first (or an 'error' event)
+            query_params = parse_qs(urlparse(self.path).query)
+            date_str = query_params.get('date', [''])[0]
+
+            if not date_str:
+                from datetime import datetime
+                date_str = datetime.now().strftime('%Y-%m-%d')
+
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'keep-alive')
+            self.end_headers()
+
+            events = handle_fetch_emails_stream(session_state, date_str)
+            try:
+                for event, data in events:
+                    self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                pass  # the page started another fetch or went away; the session's list is left as it was
+            finally:
+                events.close()
+            return
+
         elif self.path.startswith('/api/fetch_emails'):
             # Extract date parameter from query string
             query_params = parse_qs(urlparse(self.path).query)
@@ -160,7 +351,8 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                 from datetime import datetime
                 date_str = datetime.now().strftime('%Y-%m-%d')
 
-            result = handle_fetch_emails(session_state, date_str)
+            with session_state.lock:
+                result = handle_fetch_emails(session_state, date_str)
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
@@ -173,7 +365,8 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
 
             try:
                 email_index = int(index_str)
-                result = handle_select_email(session_state, email_index)
+                with session_state.lock:
+                    result = handle_select_email(session_state, email_index)
             except ValueError:
                 result = {"success": False, "error": "Invalid index parameter"}
 
@@ -182,6 +375,62 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps(result).encode())
 
+        elif self.path.startswith('/api/search_emails'):
+            # Ranked search over the cached emails: q=words, scope=day (the fetched list, default) or all, limit=20
+            query_params = parse_qs(urlparse(self.path).query)
+            query = query_params.get('q', [''])[0]
+            scope = query_params.get('scope', ['day'])[0]
+
+            try:
+                limit = max(1, min(100, int(query_params.get('limit', ['20'])[0])))
+                with session_state.lock:
+                    result = handle_search_emails(session_state, query, limit, scope)
+            except ValueError:
+                result = {"success": False, "error": "Invalid limit parameter"}
+
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(result).encode())
+
+        elif self.path.startswith('/api/extraction_status'):
+            # Policy PDF extraction jobs: job=<id> from an "extracting" event, or the session's policies' latest jobs
+            query_params = parse_qs(urlparse(self.path).query)
+            job_id = query_params.get('job', [''])[0] or None
+
+            result = handle_extraction_status(session_state, job_id)
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(result).encode())
+
+        elif self.path == '/api/stats':
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.end_headers()
+            response_data = {
+                "streams": stream_stats.snapshot(),
+                "flush_policy": repr(get_flush_policy()),
+                "text_cache": extracted_text_cache.stats(),
+                "policy_index": policy_index_cache.stats(),
+                "latency": latency_stats.snapshot(),
+                "memory_budget": memory_budget_stats.snapshot(),
+                "prefix_cache": prefix_cache.stats(),
+                "email_cache": email_cache.stats(),
+                "email_prefetch": body_prefetcher.stats(),
+                "gmail_clients": gmail_pool.stats(),
+                "email_context": email_context.stats(),
+                "job_extraction": job_extractor.stats(),
+                "email_search": email_search.stats(),
+                "pdf_extraction": pdf_extraction_queue.stats(),
+                "policy_warmup": policy_warmup.stats(),
+                "text_store": text_store.stats(),
+                "model": dict(backend=handler_functions.model_backend,
+                              **(fake_model_stats.snapshot() if handler_functions.model_backend == 'fake' else {})),
+                "sessions": len(session_store)
+            }
+            self.wfile.write(json.dumps(response_data).encode())
+
         elif self.path == '/favicon.ico':
             # Ignore the request for favicon.ico
             self.send_response(204)  # No Content
@@ -195,7 +444,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
 
 
 if __name__ == "__main__":
-    PORT = 8000
+    PORT = args.port
     
 
     server_user_data = create_server_user_data() 
@@ -204,19 +453,29 @@ if __name__ == "__main__":
     # There are some additional things that need to be done the first time that focus is given to the Chatbot.
 
  
-    #   Create an instance of the session_state object with default values
-    session_state = SessionData()       
-    # A single SessionData instance holds all the data required for a full session with a single user including their currently upoaded policies, if any.
-
     user_id = args.user #passed in as a command line argument
-    session_id = "sesh123ABC"  # Would be accessed from the server by TBD method   
-    handle_focus(session_state, user_id, session_id, server_user_data)
 
-    with socketserver.TCPServer(("", PORT), MyHandler) as httpd:
+    def create_session(session_id: str) -> SessionData:
+        #   Create an instance of the session_state object with default values
+        session_state = SessionData()
+        # Each SessionData instance holds all the data required for a full session with a single user including their currently upoaded policies, if any.
+        handle_focus(session_state, user_id, session_id, server_user_data)
+        return session_state
+
+    # Sessions are created on a browser's first API request and found again through its session cookie
+    session_store = SessionStore(create_session, on_remove=prefix_cache.invalidate_session)
+
+    if args.server_mode == 'threaded':
+        httpd = BoundedThreadingHTTPServer(("", PORT), MyHandler, max_workers=args.max_workers, max_streams=args.max_streams)
+    else:
+        httpd = socketserver.TCPServer(("", PORT), MyHandler)
+
+    with httpd:
         import webbrowser
-        import threading
 
         print(f"Server running at http://localhost:{PORT}")
+        if args.server_mode == 'threaded':
+            print(f"Serving concurrently: {httpd.max_workers} workers, at most {httpd.max_streams} chat streams")
         print("Press Ctrl+C to stop")
 
         # Open browser after a short delay to let server start
@@ -225,7 +484,8 @@ if __name__ == "__main__":
             time.sleep(1)
             webbrowser.open(f'http://localhost:{PORT}/chatbot.html')
 
-        threading.Thread(target=open_browser, daemon=True).start()
+        if not args.no_browser:
+            threading.Thread(target=open_browser, daemon=True).start()
         httpd.serve_forever()
 
 